@@ -15,6 +15,8 @@ from argparse import ArgumentDefaultsHelpFormatter
 from util.adb_helper import AdbHelper
 from util.adb_helper import AdbWrapper
 from util.b2g_helper import B2GHelper
+from util.backup_store import BackupStore
+from util.delta_push import DeltaPusher
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +49,8 @@ class BackupRestoreHelper(object):
         self.no_reboot = False
         self.profile_dir = 'mozilla-profile'
         self.skip_version_check = False
+        self.repository = None
+        self.snapshot = None
 
     def set_serial(self, serial):
         """
@@ -118,6 +122,22 @@ class BackupRestoreHelper(object):
         self.skip_version_check = flag
         logger.debug('Set skip_version_check: {}'.format(self.skip_version_check))
 
+    def set_repository(self, repository):
+        """
+        Setup the backup repository, which stores the deduplicated snapshots of each device.
+        @param repository: The path of repository folder.
+        """
+        self.repository = repository
+        logger.debug('Set repository: {}'.format(self.repository))
+
+    def set_snapshot(self, snapshot):
+        """
+        Setup the snapshot name for restoring from repository. Default is the latest snapshot of device.
+        @param snapshot: The snapshot name.
+        """
+        self.snapshot = snapshot
+        logger.debug('Set snapshot: {}'.format(self.snapshot))
+
     def cli(self):
         """
         Handle the argument parse, and the return the instance itself.
@@ -140,6 +160,11 @@ class BackupRestoreHelper(object):
                                 help='Do not reboot B2G after backup/restore.')
         arg_parser.add_argument('-p', '--profile-dir', action='store', dest='profile_dir', default='mozilla-profile',
                                 help='Specify the profile folder.')
+        arg_parser.add_argument('--repository', action='store', dest='repository', default=None,
+                                help='Backup into or restore from the deduplicated repository folder, '
+                                     'instead of the profile folder.')
+        arg_parser.add_argument('--snapshot', action='store', dest='snapshot', default=None,
+                                help='The snapshot of repository to restore. Default is the latest one of device.')
         arg_parser.add_argument('--skip-version-check', action='store_true', dest='skip_version_check', default=False,
                                 help='Turn off version check between backup profile and device.')
         arg_parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', default=False,
@@ -166,9 +191,40 @@ class BackupRestoreHelper(object):
         self.set_no_reboot(args.no_reboot)
         self.set_profile_dir(args.profile_dir)
         self.set_skip_version_check(args.skip_version_check)
+        self.set_repository(args.repository)
+        self.set_snapshot(args.snapshot)
         # return instance
         return self
 
+    @staticmethod
+    def _pull_folder(remote_dir, local_dir, serial=None):
+        """
+        Pull the folder from device.
+        When the local folder has the files of previous backup, only the new or changed files are pulled,
+        and the files which do not exist on device are removed.
+        """
+        device_manifest = None
+        if os.path.isdir(local_dir) and os.listdir(local_dir):
+            device_manifest = DeltaPusher.get_device_manifest(remote_dir, serial=serial)
+            if not device_manifest:
+                logger.debug('Can not get the manifest of {}, pull all files.'.format(remote_dir))
+                shutil.rmtree(local_dir)
+                os.makedirs(local_dir)
+        if not device_manifest:
+            AdbWrapper.adb_pull_archive(remote_dir, local_dir, serial=serial)
+            return
+        local_manifest = DeltaPusher.get_local_manifest(local_dir)
+        changed, stale = DeltaPusher.diff(device_manifest, local_manifest)
+        logger.info('{}: {} files changed, {} files removed.'.format(remote_dir, len(changed), len(stale)))
+        for path in stale:
+            os.remove(os.path.join(local_dir, *path.split('/')))
+        for path in changed:
+            local_file = os.path.join(local_dir, *path.split('/'))
+            if os.path.isfile(local_file):
+                os.remove(local_file)
+        # the changed files are pulled by one tar stream, instead of one "adb pull" for each file
+        AdbWrapper.adb_pull_archive(remote_dir, local_dir, serial=serial, members=sorted(changed))
+
     def backup_sdcard(self, local_dir, serial=None):
         """
         Backup data from device's SDCard to local folder.
@@ -184,10 +240,11 @@ class BackupRestoreHelper(object):
         ret_msg = '\n'.join(output_list)
         if ret_code == '0':
             target_dir = os.path.join(local_dir, self._LOCAL_DIR_SDCARD)
-            os.makedirs(target_dir)
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
             logger.info('Backup: {0} to {1}'.format(self._REMOTE_DIR_SDCARD, target_dir))
             try:
-                AdbWrapper.adb_pull(self._REMOTE_DIR_SDCARD, target_dir, serial=serial)
+                self._pull_folder(self._REMOTE_DIR_SDCARD, target_dir, serial=serial)
             except Exception as e:
                 logger.debug(e)
                 logger.error('Can not pull files from {0} to {1}.'.format(self._REMOTE_DIR_SDCARD, target_dir))
@@ -225,8 +282,12 @@ class BackupRestoreHelper(object):
         # Backup Wifi
         wifi_dir = os.path.join(local_dir, self._LOCAL_DIR_WIFI)
         wifi_file = os.path.join(local_dir, self._LOCAL_FILE_WIFI)
-        os.makedirs(wifi_dir)
+        if not os.path.isdir(wifi_dir):
+            os.makedirs(wifi_dir)
         logger.info('Backing up Wifi information...')
+        # remove the Wifi information of previous backup
+        if os.path.isfile(wifi_file):
+            os.remove(wifi_file)
         try:
             AdbWrapper.adb_pull(self._REMOTE_FILE_WIFI, wifi_file, serial=serial)
         except Exception as e:
@@ -234,19 +295,21 @@ class BackupRestoreHelper(object):
             logger.error('If you don\'t have root permission, you cannot backup Wifi information.')
         # Backup profile
         b2g_mozilla_dir = os.path.join(local_dir, self._LOCAL_DIR_B2G)
-        os.makedirs(b2g_mozilla_dir)
+        if not os.path.isdir(b2g_mozilla_dir):
+            os.makedirs(b2g_mozilla_dir)
         logger.info('Backing up {0} to {1} ...'.format(self._REMOTE_DIR_B2G, b2g_mozilla_dir))
         try:
-            AdbWrapper.adb_pull(self._REMOTE_DIR_B2G, b2g_mozilla_dir, serial=serial)
+            self._pull_folder(self._REMOTE_DIR_B2G, b2g_mozilla_dir, serial=serial)
         except Exception as e:
             logger.debug(e)
             logger.error('Can not pull files from {0} to {1}'.format(self._REMOTE_DIR_B2G, b2g_mozilla_dir))
         # Backup data/local
         datalocal_dir = os.path.join(local_dir, self._LOCAL_DIR_DATA)
-        os.makedirs(datalocal_dir)
+        if not os.path.isdir(datalocal_dir):
+            os.makedirs(datalocal_dir)
         logger.info('Backing up {0} to {1} ...'.format(self._REMOTE_DIR_DATA, datalocal_dir))
         try:
-            AdbWrapper.adb_pull(self._REMOTE_DIR_DATA, datalocal_dir, serial=serial)
+            self._pull_folder(self._REMOTE_DIR_DATA, datalocal_dir, serial=serial)
         except Exception as e:
             logger.debug(e)
             logger.error('Can not pull files from {0} to {1}'.format(self._REMOTE_DIR_DATA, datalocal_dir))
@@ -390,6 +453,111 @@ class BackupRestoreHelper(object):
                 shutil.rmtree(tmp_dir)
                 logger.debug('TEMP Folder for check profile removed: {}'.format(tmp_dir))
 
+    @staticmethod
+    def _parse_size(text):
+        """
+        Parse the size of "du -sk" or "df", which is in KB without unit, or has the unit like "700.0M".
+        @return: the size in bytes, or None when it can not be parsed.
+        """
+        units = {'': 1024, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+        match = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)$', text.strip())
+        if match is None:
+            return None
+        return int(float(match.group(1)) * units[match.group(2)])
+
+    def _get_staging_space(self, serial=None):
+        """
+        Get the size of profile and the free space of /data partition on device.
+        @return: the profile size and the free space in bytes, e.g. (profile_size, free_space), or None if unknown.
+        """
+        results = AdbWrapper.adb_shell_batch(['du -sk {0} {1}'.format(self._REMOTE_DIR_B2G, self._REMOTE_DIR_DATA),
+                                              'df /data'], serial=serial)
+        (du_output, du_retcode), (df_output, df_retcode) = results
+        sizes = [self._parse_size(line.split()[0]) for line in du_output.splitlines() if line.strip()]
+        free_space = None
+        for line in df_output.splitlines():
+            tokens = line.split()
+            # toolbox: "Filesystem Size Used Free Blksize", busybox and toybox: "Filesystem 1K-blocks Used Available"
+            if len(tokens) >= 4 and tokens[0].startswith('/'):
+                free_space = self._parse_size(tokens[3])
+        if du_retcode != 0 or not sizes or None in sizes or free_space is None:
+            logger.debug('Can not get the space of device: {}, {}'.format(du_output, df_output))
+            return None
+        return sum(sizes), free_space
+
+    def stage_profile_on_device(self, staging_dir, serial=None):
+        """
+        Keep B2G user profile on device, by moving it into the staging folder of /data partition.
+        It is a rename in the same partition, and the free space is checked in case "mv" copies the files.
+
+        @param staging_dir: the staging folder on /data partition of device.
+        @param serial: device serial number. (optional)
+        @return: True if the profile is staged, False if device lacks space.
+        """
+        # the staging folder left by the last failed run keeps the profile, so restore it instead of removing it
+        output, retcode = AdbWrapper.adb_shell('[ -d {0} ]'.format(staging_dir), serial=serial)
+        if retcode == 0:
+            logger.warning('Found the profile staged by the last run in [{0}], restore it first.'.format(staging_dir))
+            self.restore_staged_profile(staging_dir, serial=serial)
+        space = self._get_staging_space(serial=serial)
+        if space is None:
+            return False
+        profile_size, free_space = space
+        logger.info('Profile size: {0} bytes, free space of /data: {1} bytes.'.format(profile_size, free_space))
+        if free_space < profile_size:
+            return False
+        logger.info('Staging profile to [{0}] on device...'.format(staging_dir))
+        results = AdbWrapper.adb_shell_batch(['mkdir -p {0}'.format(staging_dir),
+                                              'mv {0} {1}/{2}'.format(self._REMOTE_DIR_B2G, staging_dir,
+                                                                      self._LOCAL_DIR_B2G),
+                                              'mv {0} {1}/{2}'.format(self._REMOTE_DIR_DATA, staging_dir,
+                                                                      self._LOCAL_DIR_DATA)], serial=serial)
+        failures = [output for output, retcode in results if retcode != 0]
+        if failures:
+            # move back whatever was moved
+            self.restore_staged_profile(staging_dir, serial=serial)
+            raise Exception('Can not stage profile on device: {}'.format(failures))
+        return True
+
+    def restore_staged_profile(self, staging_dir, serial=None):
+        """
+        Restore B2G user profile from the staging folder of device, and remove its gecko.mstone value.
+
+        @param staging_dir: the staging folder on /data partition of device.
+        @param serial: device serial number. (optional)
+        """
+        logger.info('Restoring profile from [{0}] on device...'.format(staging_dir))
+        command_list = []
+        for remote_dir, staged_name in ((self._REMOTE_DIR_B2G, self._LOCAL_DIR_B2G),
+                                        (self._REMOTE_DIR_DATA, self._LOCAL_DIR_DATA)):
+            staged_dir = '{0}/{1}'.format(staging_dir, staged_name)
+            command_list.append('if [ -d {0} ]; then rm -r {1}; mkdir -p {2}; mv {0} {1}; fi'.format(
+                staged_dir, remote_dir, os.path.dirname(remote_dir)))
+        command_list.append('rm -r {0}'.format(staging_dir))
+        AdbWrapper.adb_shell_batch(command_list, serial=serial)
+        # remove gecko.mstone value, so that gecko can check the apps under /system/b2g/webapps again.
+        tmp_dir = tempfile.mkdtemp(prefix='b2gprofile_')
+        try:
+            ini_file = os.path.join(tmp_dir, self._FILE_PROFILE_INI)
+            AdbWrapper.adb_pull('{0}/{1}'.format(self._REMOTE_DIR_B2G, self._FILE_PROFILE_INI), ini_file,
+                                serial=serial)
+            remote_perf = '{0}/{1}/{2}'.format(self._REMOTE_DIR_B2G, self._get_profile_path(ini_file),
+                                               self._FILE_PERF_JS)
+            local_perf = os.path.join(tmp_dir, self._FILE_PERF_JS)
+            AdbWrapper.adb_pull(remote_perf, local_perf, serial=serial)
+            with open(local_perf, 'r') as f:
+                perf_contents = f.readlines()
+            if any('gecko.mstone' in line for line in perf_contents):
+                with open(local_perf, 'w') as f:
+                    f.writelines(line for line in perf_contents if 'gecko.mstone' not in line)
+                AdbWrapper.adb_push(local_perf, remote_perf, serial=serial)
+        except Exception as e:
+            logger.debug(e)
+            logger.warning('Can not remove gecko.mstone from {0}.'.format(self._FILE_PERF_JS))
+        finally:
+            shutil.rmtree(tmp_dir)
+        logger.info('Restore profile done.')
+
     def restore_profile(self, local_dir, serial=None):
         """
         Restore B2G user profile from local folder to device.
@@ -415,7 +583,7 @@ class BackupRestoreHelper(object):
                 logger.info('Restore from {0} to {1} ...'.format(b2g_mozilla_dir, self._REMOTE_DIR_B2G))
                 AdbWrapper.adb_shell('rm -r {0}'.format(self._REMOTE_DIR_B2G))
                 try:
-                    AdbWrapper.adb_push(b2g_mozilla_dir, self._REMOTE_DIR_B2G, serial=serial)
+                    AdbWrapper.adb_push_archive(b2g_mozilla_dir, self._REMOTE_DIR_B2G, serial=serial)
                 except Exception as e:
                     logger.debug(e)
                     logger.error('Can not push files from {0} to {1}'.format(b2g_mozilla_dir, self._REMOTE_DIR_B2G))
@@ -425,7 +593,7 @@ class BackupRestoreHelper(object):
                 logger.info('Restore from {0} to {1} ...'.format(datalocal_dir, self._REMOTE_DIR_DATA))
                 AdbWrapper.adb_shell('rm -r {0}'.format(self._REMOTE_DIR_DATA))
                 try:
-                    AdbWrapper.adb_push(datalocal_dir, self._REMOTE_DIR_DATA, serial=serial)
+                    AdbWrapper.adb_push_archive(datalocal_dir, self._REMOTE_DIR_DATA, serial=serial)
                 except Exception as e:
                     logger.debug(e)
                     logger.error('Can not push files from {0} to {1}'.format(datalocal_dir, self._REMOTE_DIR_DATA))
@@ -438,7 +606,7 @@ class BackupRestoreHelper(object):
         Entry point.
         """
         # get the device's serial number
-        devices = AdbWrapper.adb_devices()
+        devices = AdbHelper.get_devices()
         if len(devices) == 0:
             raise Exception('No device.')
         else:
@@ -460,6 +628,9 @@ class BackupRestoreHelper(object):
             logger.info('Target device [{0}]'.format(self.serial))
         # Backup
         if self.backup:
+            if self.repository:
+                self._backup_to_repository(self._get_store_serial(devices))
+                return
             tmp_dir = None
             try:
                 # Create temp folder
@@ -493,20 +664,86 @@ class BackupRestoreHelper(object):
                     logger.debug('TEMP Folder for backup removed: {}'.format(tmp_dir))
         # Restore
         elif self.restore:
-            # Checking the Version of Profile
-            if self._check_profile_version(local_dir=self.profile_dir, serial=self.serial):
-                # Stop B2G
-                B2GHelper.stop_b2g(serial=self.serial)
-                # Restore User Profile
-                self.restore_profile(local_dir=self.profile_dir, serial=self.serial)
-                # Restore SDCard
-                if self.sdcard:
-                    self.restore_sdcard(local_dir=self.profile_dir, serial=self.serial)
-                # Start B2G
-                if not self.no_reboot:
-                    B2GHelper.start_b2g(serial=self.serial)
-            else:
-                logger.error('The version on device is smaller than backup\'s version.')
+            if self.repository:
+                self._restore_from_repository(self._get_store_serial(devices))
+                return
+            self._restore(self.profile_dir)
+
+    def _get_store_serial(self, devices):
+        """
+        @return: the serial number which the snapshots of repository are recorded by.
+        """
+        if self.serial is None and len(devices) == 1:
+            return devices.keys()[0]
+        return self.serial
+
+    def _restore(self, local_dir):
+        # Checking the Version of Profile
+        if self._check_profile_version(local_dir=local_dir, serial=self.serial):
+            # Stop B2G
+            B2GHelper.stop_b2g(serial=self.serial)
+            # Restore User Profile
+            self.restore_profile(local_dir=local_dir, serial=self.serial)
+            # Restore SDCard
+            if self.sdcard:
+                self.restore_sdcard(local_dir=local_dir, serial=self.serial)
+            # Start B2G
+            if not self.no_reboot:
+                B2GHelper.start_b2g(serial=self.serial)
+        else:
+            logger.error('The version on device is smaller than backup\'s version.')
+
+    def _backup_to_repository(self, store_serial):
+        """
+        Backup into the repository as one new snapshot.
+        The latest snapshot of device is checked out first, so only the new or changed files are pulled from device.
+        """
+        store = BackupStore(self.repository)
+        tmp_dir = None
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix='backup_restore_')
+            logger.debug('TEMP Foler: {}'.format(tmp_dir))
+            latest = store.get_latest_snapshot(store_serial)
+            if latest:
+                store.checkout(store_serial, latest, tmp_dir)
+                sdcard_dir = os.path.join(tmp_dir, self._LOCAL_DIR_SDCARD)
+                if not self.sdcard and os.path.isdir(sdcard_dir):
+                    shutil.rmtree(sdcard_dir)
+            # Stop B2G
+            B2GHelper.stop_b2g(serial=self.serial)
+            # Backup User Profile
+            self.backup_profile(local_dir=tmp_dir, serial=self.serial)
+            # Backup SDCard
+            if self.sdcard:
+                self.backup_sdcard(local_dir=tmp_dir, serial=self.serial)
+            snapshot = store.commit(tmp_dir, serial=store_serial)
+            logger.info('Backup into [{0}] as snapshot [{1}].'.format(self.repository, snapshot))
+            # Start B2G
+            if not self.no_reboot:
+                B2GHelper.start_b2g(serial=self.serial)
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir)
+                logger.debug('TEMP Folder for backup removed: {}'.format(tmp_dir))
+
+    def _restore_from_repository(self, store_serial):
+        """
+        Rebuild the profile from the snapshot manifest of repository, and then restore it.
+        """
+        store = BackupStore(self.repository)
+        snapshot = self.snapshot or store.get_latest_snapshot(store_serial)
+        if snapshot is None:
+            raise Exception('No snapshot of [{0}] in [{1}].'.format(store_serial, self.repository))
+        tmp_dir = None
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix='backup_restore_')
+            logger.debug('TEMP Foler: {}'.format(tmp_dir))
+            store.checkout(store_serial, snapshot, tmp_dir)
+            self._restore(tmp_dir)
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir)
+                logger.debug('TEMP Folder for restore removed: {}'.format(tmp_dir))
 
 
 def main():
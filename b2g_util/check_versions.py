@@ -4,21 +4,23 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import io
 import re
 import os
 import json
-import shutil
 import logging
 import zipfile
-import tempfile
 import argparse
-import subprocess
 from distutils import util
 from datetime import datetime
 from argparse import ArgumentDefaultsHelpFormatter
 from util import console_utilities
 from util.adb_helper import AdbHelper
 from util.adb_helper import AdbWrapper
+from util.remote_file import RemoteFile
+from util.parallel import gather
+from util.parallel import DEFAULT_MAX_WORKERS
+from misc.optimizejars import open_optimized_jar
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +33,7 @@ class VersionChecker(object):
         self.serial = None
         self.log_text = None
         self.log_json = None
+        self.max_workers = DEFAULT_MAX_WORKERS
 
     def set_serial(self, serial):
         """
@@ -56,6 +59,14 @@ class VersionChecker(object):
         self.log_text = log_text
         logger.debug('Set log_text: {}'.format(self.log_text))
 
+    def set_max_workers(self, max_workers):
+        """
+        Setup the max number of devices which are checked concurrently.
+        @param max_workers: the max number of concurrent devices.
+        """
+        self.max_workers = max_workers
+        logger.debug('Set max_workers: {}'.format(self.max_workers))
+
     def set_log_json(self, log_json):
         """
         Setup the log_json file path.
@@ -78,6 +89,8 @@ class VersionChecker(object):
                                      'Overrides ANDROID_SERIAL environment variable.')
         arg_parser.add_argument('--log-text', action='store', dest='log_text', default=None, help='Text ouput.')
         arg_parser.add_argument('--log-json', action='store', dest='log_json', default=None, help='JSON output.')
+        arg_parser.add_argument('-j', '--jobs', action='store', type=int, dest='jobs', default=DEFAULT_MAX_WORKERS,
+                                help='The max number of devices which are checked concurrently.')
         arg_parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', default=False,
                                 help='Turn on verbose output, with all the debug logger.')
 
@@ -97,9 +110,23 @@ class VersionChecker(object):
         self.set_serial(args.serial)
         self.set_log_text(args.log_text)
         self.set_log_json(args.log_json)
+        self.set_max_workers(args.jobs)
         # return instance
         return self
 
+    @staticmethod
+    def _pull_to_memory(source, serial=None):
+        """
+        Pull the file from device into memory.
+        @param source: the remote file path.
+        @param serial: device serial number. (optional)
+        @return: the BytesIO object of file content.
+        """
+        f = io.BytesIO()
+        AdbWrapper.adb_pull_fileobj(source, f, serial=serial)
+        f.seek(0)
+        return f
+
     @staticmethod
     def get_device_info(serial=None):
         """
@@ -107,124 +134,104 @@ class VersionChecker(object):
         @param serial: device serial number. (optional)
         @return: the information dict object.
         """
-        tmp_dir = None
+        # only the central directories and the needed members of omni.ja and application.zip are read from device
+        omni_ja = None
         try:
-            tmp_dir = tempfile.mkdtemp(prefix='checkversions_')
-            # pull data from device
-            try:
-                AdbWrapper.adb_pull('/system/b2g/omni.ja', tmp_dir, serial=serial)
-            except Exception as e:
-                logger.debug(e)
-                logger.error('Error pulling Gecko file.')
+            omni_ja = RemoteFile('/system/b2g/omni.ja', serial=serial)
+        except Exception as e:
+            logger.debug(e)
+            logger.error('Error pulling Gecko file.')
+        application_zip = None
+        for application_zip_path in ('/data/local/webapps/settings.gaiamobile.org/application.zip',
+                                     '/system/b2g/webapps/settings.gaiamobile.org/application.zip'):
             try:
-                AdbWrapper.adb_pull('/data/local/webapps/settings.gaiamobile.org/application.zip', tmp_dir,
-                                    serial=serial)
+                application_zip = RemoteFile(application_zip_path, serial=serial)
+                break
             except Exception as e:
                 logger.debug(e)
+        if application_zip is None:
+            logger.error('Error pulling Gaia file.')
+        application_ini = None
+        try:
+            application_ini = VersionChecker._pull_to_memory('/system/b2g/application.ini', serial=serial)
+        except Exception as e:
+            logger.debug(e)
+            logger.error('Error pulling application.ini file.')
+        # get Gaia info
+        gaia_rev = 'n/a'
+        gaia_date = 'n/a'
+        gaia_commit = None
+        if application_zip is not None:
+            with application_zip:
+                z = zipfile.ZipFile(application_zip)
+                if 'resources/gaia_commit.txt' in z.namelist():
+                    gaia_commit = z.read('resources/gaia_commit.txt')
+        else:
+            logger.warning('Can not find application.zip file.')
+        if gaia_commit is not None:
+            gaia_commit_lines = gaia_commit.splitlines()
+            gaia_rev = gaia_commit_lines[0].strip()
+            gaia_date_sec_from_epoch = gaia_commit_lines[1].strip()
+            gaia_date = datetime.utcfromtimestamp(int(gaia_date_sec_from_epoch)).strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            logger.warning('Can not get gaia_commit.txt file from application.zip file.')
+        # read optimized omni.ja for Gecko info
+        gecko_rev = 'n/a'
+        if omni_ja is not None:
+            buildconfig = None
+            with omni_ja:
                 try:
-                    AdbWrapper.adb_pull('/system/b2g/webapps/settings.gaiamobile.org/application.zip', tmp_dir,
-                                        serial=serial)
+                    z = open_optimized_jar(omni_ja)
+                    buildconfig = z.read('chrome/toolkit/content/global/buildconfig.html')
                 except Exception as e:
                     logger.debug(e)
-                    logger.error('Error pulling Gaia file.')
-            try:
-                AdbWrapper.adb_pull('/system/b2g/application.ini', tmp_dir, serial=serial)
-            except Exception as e:
-                logger.debug(e)
-                logger.error('Error pulling application.ini file.')
-            # get Gaia info
-            gaia_rev = 'n/a'
-            gaia_date = 'n/a'
-            application_zip_file = os.path.join(tmp_dir, 'application.zip')
-            if os.path.isfile(application_zip_file):
-                with open(application_zip_file, 'rb') as f:
-                    z = zipfile.ZipFile(f)
-                    z.extract('resources/gaia_commit.txt', tmp_dir)
-            else:
-                logger.warning('Can not find application.zip file.')
-            gaiacommit_file = os.path.join(tmp_dir, 'resources/gaia_commit.txt')
-            if os.path.isfile(gaiacommit_file):
-                with open(gaiacommit_file, "r") as f:
-                    gaia_rev = re.sub(r'\n+', '', f.readline())
-                    gaia_date_sec_from_epoch = re.sub(r'\n+', '', f.readline())
-                gaia_date = datetime.utcfromtimestamp(int(gaia_date_sec_from_epoch)).strftime('%Y-%m-%d %H:%M:%S')
+            # get Gecko info from buildconfig.html file
+            if buildconfig is not None:
+                for line in buildconfig.splitlines():
+                    if re.search(r'Built from', line):
+                        ret = re.findall(r'>(.*?)<', line)
+                        gecko_rev = ret[1]
+                        break
             else:
-                logger.warning('Can not get gaia_commit.txt file from application.zip file.')
-            # deoptimize omni.ja for Gecko info
-            gecko_rev = 'n/a'
-            if os.path.isfile(os.path.join(tmp_dir, 'omni.ja')):
-                deopt_dir = os.path.join(tmp_dir, 'deopt')
-                deopt_file = os.path.join(deopt_dir, 'omni.ja')
-                deopt_exec = os.path.join(tmp_dir, 'optimizejars.py')
-                os.makedirs(deopt_dir)
-                # TODO rewrite optimizejars.py if possible
-                current_dir = os.path.dirname(os.path.abspath(__file__))
-                current_exec = os.path.join(current_dir, 'misc', 'optimizejars.py')
-                shutil.copyfile(current_exec, deopt_exec)
-                cmd = 'python %s --deoptimize %s %s %s' % (deopt_exec, tmp_dir, tmp_dir, deopt_dir)
-                p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                output = p.communicate()[0]
-                logger.debug('optimizejars.py stdout: {}'.format(output))
-                # unzip omni.ja to get Gecko info
-                if os.path.isfile(deopt_file):
-                    with open(deopt_file, 'rb') as f:
-                        z = zipfile.ZipFile(f)
-                        z.extract('chrome/toolkit/content/global/buildconfig.html', tmp_dir)
-                else:
-                    logger.warning('Can not deoptimize omni.ja file.')
-                    gecko_rev = 'n/a'
-                # get Gecko info from buildconfig.html file
-                buildconfig_file = os.path.join(tmp_dir, 'chrome/toolkit/content/global/buildconfig.html')
-                if os.path.isfile(buildconfig_file):
-                    for line in open(buildconfig_file, "r"):
-                        if re.search(r'Built from', line):
-                            ret = re.findall(r'>(.*?)<', line)
-                            gecko_rev = ret[1]
-                            break
-                else:
-                    logger.warning('Can not get buildconfig.html file from omni.ja file.')
-            else:
-                print 'Can not find omni.ja file.'
-            # get Gecko version, and B2G BuildID from application.ini file
-            build_id = 0
-            version = 0
-            if os.path.isfile(os.path.join(tmp_dir, 'application.ini')):
-                for line in open(os.path.join(tmp_dir, 'application.ini'), "r"):
-                    if re.search(r'^\s*BuildID', line):
-                        ret = re.findall(r'.*?=(.*)', line)
-                        build_id = ret[0]
-                    if re.search(r'^\s*Version', line):
-                        ret = re.findall(r'.*?=(.*)', line)
-                        version = ret[0]
-            else:
-                build_id = 'n/a'
-                version = 'n/a'
-            # get device information by getprop command
-            device_name = re.sub(r'\r+|\n+', '', AdbWrapper.adb_shell('getprop ro.product.device', serial=serial)[0])
-            firmware_release = re.sub(r'\r+|\n+', '',
-                                      AdbWrapper.adb_shell('getprop ro.build.version.release', serial=serial)[0])
-            firmware_incremental = re.sub(r'\r+|\n+', '',
-                                          AdbWrapper.adb_shell('getprop ro.build.version.incremental', serial=serial)[
-                                              0])
-            firmware_date = re.sub(r'\r+|\n+', '', AdbWrapper.adb_shell('getprop ro.build.date', serial=serial)[0])
-            firmware_bootloader = re.sub(r'\r+|\n+', '',
-                                         AdbWrapper.adb_shell('getprop ro.boot.bootloader', serial=serial)[0])
-            # prepare the return information
-            device_info = {'Serial': serial,
-                           'Build ID': build_id,
-                           'Gaia Revision': gaia_rev,
-                           'Gaia Date': gaia_date,
-                           'Gecko Revision': gecko_rev,
-                           'Gecko Version': version,
-                           'Device Name': device_name,
-                           'Firmware(Release)': firmware_release,
-                           'Firmware(Incremental)': firmware_incremental,
-                           'Firmware Date': firmware_date,
-                           'Bootloader': firmware_bootloader}
-        finally:
-            if tmp_dir:
-                shutil.rmtree(tmp_dir)
-                logger.debug('Remove {}.'.format(tmp_dir))
+                logger.warning('Can not get buildconfig.html file from omni.ja file.')
+        else:
+            print 'Can not find omni.ja file.'
+        # get Gecko version, and B2G BuildID from application.ini file
+        build_id = 0
+        version = 0
+        if application_ini is not None:
+            for line in application_ini.getvalue().splitlines():
+                if re.search(r'^\s*BuildID', line):
+                    ret = re.findall(r'.*?=(.*)', line)
+                    build_id = ret[0]
+                if re.search(r'^\s*Version', line):
+                    ret = re.findall(r'.*?=(.*)', line)
+                    version = ret[0]
+        else:
+            build_id = 'n/a'
+            version = 'n/a'
+        # get device information by getprop command
+        device_name = re.sub(r'\r+|\n+', '', AdbWrapper.adb_shell('getprop ro.product.device', serial=serial)[0])
+        firmware_release = re.sub(r'\r+|\n+', '',
+                                  AdbWrapper.adb_shell('getprop ro.build.version.release', serial=serial)[0])
+        firmware_incremental = re.sub(r'\r+|\n+', '',
+                                      AdbWrapper.adb_shell('getprop ro.build.version.incremental', serial=serial)[
+                                          0])
+        firmware_date = re.sub(r'\r+|\n+', '', AdbWrapper.adb_shell('getprop ro.build.date', serial=serial)[0])
+        firmware_bootloader = re.sub(r'\r+|\n+', '',
+                                     AdbWrapper.adb_shell('getprop ro.boot.bootloader', serial=serial)[0])
+        # prepare the return information
+        device_info = {'Serial': serial,
+                       'Build ID': build_id,
+                       'Gaia Revision': gaia_rev,
+                       'Gaia Date': gaia_date,
+                       'Gecko Revision': gecko_rev,
+                       'Gecko Version': version,
+                       'Device Name': device_name,
+                       'Firmware(Release)': firmware_release,
+                       'Firmware(Incremental)': firmware_incremental,
+                       'Firmware Date': firmware_date,
+                       'Bootloader': firmware_bootloader}
         return device_info
 
     @staticmethod
@@ -313,7 +320,7 @@ class VersionChecker(object):
         """
         Entry point.
         """
-        self.devices = AdbWrapper.adb_devices()
+        self.devices = AdbHelper.get_devices()
         is_no_color = self.no_color
         if 'NO_COLOR' in os.environ:
             try:
@@ -328,15 +335,32 @@ class VersionChecker(object):
             final_serial = AdbHelper.get_serial(self.serial)
             if final_serial is None:
                 self.device_info_list = []
-                for device, state in self.devices.items():
+                # get the information of all online devices concurrently, and then print them in order
+                devices = self.devices.items()
+                online_devices = [device for device, state in devices if state == 'device']
+                # one failed device does not stop the report of others
+                infos = gather([(self.get_device_info, {'serial': device}) for device in online_devices],
+                               max_workers=self.max_workers, return_exceptions=True)
+                info_dict = dict(zip(online_devices, infos))
+                failed_serials = []
+                for device, state in devices:
                     print('Serial: {0} (State: {1})'.format(device, state))
-                    if state == 'device':
-                        device_info = self.get_device_info(serial=device)
-                        self.print_device_info(device_info, no_color=is_no_color)
-                        self.device_info_list.append(device_info)
-                    else:
+                    if state != 'device':
                         print('Skipped.\n')
                         self.device_info_list.append({'Serial': device, 'Skip': True})
+                    elif isinstance(info_dict[device], Exception):
+                        print('{}: {}\n'.format(device, info_dict[device]))
+                        self.device_info_list.append({'Serial': device, 'Error': str(info_dict[device])})
+                        failed_serials.append(device)
+                    else:
+                        device_info = info_dict[device]
+                        self.print_device_info(device_info, no_color=is_no_color)
+                        self.device_info_list.append(device_info)
+                self._output_log()
+                if failed_serials:
+                    raise Exception('Check versions failed on {} devices: {}'.format(len(failed_serials),
+                                                                                    ', '.join(failed_serials)))
+                return
             else:
                 print('Serial: {0} (State: {1})'.format(final_serial, self.devices[final_serial]))
                 device_info = self.get_device_info(serial=final_serial)
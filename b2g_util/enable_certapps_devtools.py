@@ -172,7 +172,7 @@ class FullPrivilegeResetter(object):
         """
         Entry point.
         """
-        devices = AdbWrapper.adb_devices()
+        devices = AdbHelper.get_devices()
 
         is_enable = not self.disable
         if len(devices) == 0:
@@ -9,8 +9,6 @@ import sys
 import stat
 import shutil
 import logging
-import tarfile
-import zipfile
 import easygui
 import tempfile
 import textwrap
@@ -20,8 +18,11 @@ from sys import platform as _platform
 
 from check_versions import VersionChecker
 from shallow_flash import ShallowFlashHelper
-from util.adb_helper import AdbWrapper
+from util.b2g_helper import B2GHelper
 from util.decompressor import Decompressor
+from util.artifact_cache import ArtifactCache
+from util.artifact_cache import CachedArtifactDownloader
+from util.extraction_cache import ExtractionCache
 from taskcluster_util.taskcluster_traverse import TraverseRunner
 
 
@@ -33,18 +34,29 @@ class B2GTraverseRunner(TraverseRunner):
     def __init__(self, connection_options=None):
         self.has_image = False
         self.image_path = None
-        self.image_magic_folder = 'b2g-distro/'
 
         self.has_gaia = False
         self.gaia_path = None
-        self.gaia_magic_folder = 'gaia/profile/'
 
         self.has_gecko = False
         self.gecko_path = None
-        self.gecko_magic_folder = 'b2g'
+
+        self.cache = None
+        self._artifact_downloader = None
 
         super(B2GTraverseRunner, self).__init__(connection_options=connection_options)
 
+    @property
+    def artifact_downloader(self):
+        return self._artifact_downloader
+
+    @artifact_downloader.setter
+    def artifact_downloader(self, downloader):
+        # look up the artifact cache before downloading
+        if downloader is not None and self.cache is not None:
+            downloader = CachedArtifactDownloader(downloader, self.cache)
+        self._artifact_downloader = downloader
+
     def parser(self):
         # argument parser
         parser = argparse.ArgumentParser(description='The simple GUI tool for flashing B2G from Taskcluster.',
@@ -74,55 +86,49 @@ class B2GTraverseRunner(TraverseRunner):
                             help='The namespace of task')
         parser.add_argument('-d', '--dest-dir', action='store', dest='dest_dir',
                             help='The dest folder (default: current working folder)')
+        parser.add_argument('--cache-dir', action='store', dest='cache_dir', default=ArtifactCache.DEFAULT_CACHE_DIR,
+                            help='The artifact cache folder\n(default: {})'.format(ArtifactCache.DEFAULT_CACHE_DIR))
+        parser.add_argument('--cache-size', action='store', type=int, dest='cache_size',
+                            default=ArtifactCache.DEFAULT_MAX_SIZE / 1024 / 1024,
+                            help='The max size (MB) of artifact cache\n(default: {})'.format(
+                                ArtifactCache.DEFAULT_MAX_SIZE / 1024 / 1024))
+        parser.add_argument('--no-cache', action='store_true', dest='no_cache', default=False,
+                            help='Always download the artifacts without artifact cache')
         parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', default=False,
                             help='Turn on verbose output, with all the debug logger.')
-        return parser.parse_args(sys.argv[1:])
+        options = parser.parse_args(sys.argv[1:])
+        self.cache = None if options.no_cache else ArtifactCache(options.cache_dir, options.cache_size * 1024 * 1024)
+        return options
 
     def check_b2g_image(self, file_path):
-        logger.debug('check image: {}'.format(file_path))
-        if os.path.isfile(file_path) and file_path.endswith('.zip'):
-            try:
-                with zipfile.ZipFile(file_path, 'r') as f:
-                    if self.image_magic_folder in f.namelist():
-                        self.has_image = True
-                        self.image_path = file_path
-                        logger.info('Find B2G Image {}'.format(self.image_path))
-                        return True
-            except:
-                logger.debug('cannot open: {}'.format(file_path))
-                return False
+        if B2GHelper.check_b2g_image(file_path):
+            self.has_image = True
+            self.image_path = file_path
+            logger.info('Find B2G Image {}'.format(self.image_path))
+            return True
         return False
 
     def check_gaia_package(self, file_path):
-        logger.debug('check gaia: {}'.format(file_path))
-        if os.path.isfile(file_path) and file_path.endswith('.zip'):
-            try:
-                with zipfile.ZipFile(file_path, 'r') as f:
-                    if self.gaia_magic_folder in f.namelist():
-                        self.has_gaia = True
-                        self.gaia_path = file_path
-                        logger.info('Find Gaia Package {}'.format(self.gaia_path))
-                        return True
-            except:
-                logger.debug('cannot open: {}'.format(file_path))
-                return False
+        if B2GHelper.check_gaia_package(file_path):
+            self.has_gaia = True
+            self.gaia_path = file_path
+            logger.info('Find Gaia Package {}'.format(self.gaia_path))
+            return True
         return False
 
     def check_gecko_package(self, file_path):
-        logger.debug('check gecko: {}'.format(file_path))
-        if os.path.isfile(file_path) and file_path.endswith('.tar.gz'):
-            try:
-                with tarfile.TarFile.open(file_path, 'r:gz') as f:
-                    if self.gecko_magic_folder in f.getnames():
-                        self.has_gecko = True
-                        self.gecko_path = file_path
-                        logger.info('Find Gecko Package {}'.format(self.gecko_path))
-                        return True
-            except:
-                logger.debug('cannot open: {}'.format(file_path))
-                return False
+        if B2GHelper.check_gecko_package(file_path):
+            self.has_gecko = True
+            self.gecko_path = file_path
+            logger.info('Find Gecko Package {}'.format(self.gecko_path))
+            return True
         return False
 
+    def gui_download_artifacts(self, task_name, task_id):
+        if isinstance(self.artifact_downloader, CachedArtifactDownloader):
+            self.artifact_downloader.namespace = task_name
+        super(B2GTraverseRunner, self).gui_download_artifacts(task_name, task_id)
+
     def generate_flash_message(self):
         msg = 'What do you want to flash?\n\n' \
             '- Skip: do not want to flash any thing.\n'
@@ -183,8 +189,8 @@ class B2GTraverseRunner(TraverseRunner):
             os.chmod(self.temp_dir + '/b2g-distro/load-config.sh', stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
             while True:
                 os.system('cd ' + self.temp_dir + '/b2g-distro; ./flash.sh -f')
-                # wait for device, and then check version
-                AdbWrapper.adb_wait_for_device(timeout=120)
+                # wait for B2G, and then check version
+                B2GHelper.wait_for_boot()
                 logger.info('Check versions.')
                 checker = VersionChecker()
                 checker.run()
@@ -223,6 +229,9 @@ class B2GTraverseRunner(TraverseRunner):
                 if gecko:
                     logger.info('Gecko: {}'.format(gecko))
                     sfh.set_gecko(gecko)
+                if self.cache:
+                    # the packages are extracted once for flashing more than one device
+                    sfh.set_extraction_cache(ExtractionCache())
                 title = 'Keep Profile'
                 msg = 'Would you like to keep profile? (BETA)'
                 keep_profile = easygui.ynbox(msg, title)
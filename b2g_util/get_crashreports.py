@@ -142,7 +142,7 @@ class CrashReporter(object):
         """
         Entry point.
         """
-        devices = AdbWrapper.adb_devices()
+        devices = AdbHelper.get_devices()
 
         if len(devices) == 0:
             raise Exception('No device.')
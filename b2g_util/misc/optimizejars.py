@@ -2,11 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import io
 import os
 import re
 import sys
+import mmap
+import time
 import struct
+import zipfile
 import subprocess
+import multiprocessing
 
 local_file_header = [
     ("signature", "uint32"),
@@ -73,48 +78,64 @@ def format_struct(format):
     return (fmt, string_fields)
 
 
+# the string fields which are read as zero-copy buffers of the blob, instead of copied strings
+buffer_fields = frozenset(["data"])
+
+# the record class of each layout, keyed by id(format)
+_record_types = {}
+
+
+def record_type(format):
+    """
+    Get the record class of one layout, which is compiled once and cached.
+    The class has the precompiled struct.Struct, and one slot per field.
+    """
+    cached = _record_types.get(id(format))
+    if cached is not None and cached[0] is format:
+        return cached[1]
+    (fstr, string_fields) = format_struct(format)
+    names = tuple(name for (name, _) in format)
+    cls = type("MyStruct_%s" % "_".join(names[:2]), (MyStruct,), {
+        "__slots__": names,
+        "format": format,
+        "struct": struct.Struct(fstr),
+        "fixed_fields": tuple(name for name in names if name not in string_fields),
+        "string_fields": tuple((name, string_fields[name]) for name in names if name in string_fields),
+    })
+    _record_types[id(format)] = (format, cls)
+    return cls
+
+
 def size_of(format):
-    return struct.calcsize(format_struct(format)[0])
+    return record_type(format).struct.size
 
 
-class MyStruct:
-    def __init__(self, format, string_fields):
-        self.__dict__["struct_members"] = {}
-        self.__dict__["format"] = format
-        self.__dict__["string_fields"] = string_fields
+class MyStruct(object):
+    __slots__ = ()
 
     def addMember(self, name, value):
-        self.__dict__["struct_members"][name] = value
+        setattr(self, name, value)
 
-    def __getattr__(self, item):
-        try:
-            return self.__dict__["struct_members"][item]
-        except:
-            pass
-        print("no %s" % item)
-        print(self.__dict__["struct_members"])
-        raise AttributeError
-
-    def __setattr__(self, item, value):
-        if item in self.__dict__["struct_members"]:
-            self.__dict__["struct_members"][item] = value
-        else:
-            raise AttributeError
+    def packed_size(self):
+        return self.struct.size + sum(len(getattr(self, name)) for (name, _) in self.string_fields)
 
     def pack(self):
-        extra_data = ""
-        values = []
-        string_fields = self.__dict__["string_fields"]
-        struct_members = self.__dict__["struct_members"]
-        format = self.__dict__["format"]
-        for (name, _) in format:
-            if name in string_fields:
-                extra_data = extra_data + struct_members[name]
-            else:
-                values.append(struct_members[name])
-        return struct.pack(format_struct(format)[0], *values) + extra_data
+        values = [getattr(self, name) for name in self.fixed_fields]
+        extra_data = "".join(str(getattr(self, name)) for (name, _) in self.string_fields)
+        return self.struct.pack(*values) + extra_data
+
+    def write_to(self, fd):
+        """
+        Write the record into file without joining the buffer fields.
+        @return: the written size.
+        """
+        fd.write(self.struct.pack(*[getattr(self, name) for name in self.fixed_fields]))
+        for (name, _) in self.string_fields:
+            fd.write(getattr(self, name))
+        return self.packed_size()
 
 ENDSIG = 0x06054b50
+CDIRSIG = 0x02014b50
 
 
 def assert_true(cond, msg):
@@ -125,42 +146,55 @@ def assert_true(cond, msg):
 
 class BinaryBlob:
     def __init__(self, f):
-        self.data = open(f, "rb").read()
+        self.mapped_file = None
+        if hasattr(f, "read"):
+            self.data = f.read()
+        else:
+            self.mapped_file = open(f, "rb")
+            if os.fstat(self.mapped_file.fileno()).st_size > 0:
+                self.data = mmap.mmap(self.mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ""
         self.offset = 0
         self.length = len(self.data)
 
+    def close(self):
+        if self.mapped_file is not None:
+            if isinstance(self.data, mmap.mmap):
+                self.data.close()
+            self.mapped_file.close()
+            self.mapped_file = None
+
     def readAt(self, pos, length):
         self.offset = pos + length
         return self.data[pos:self.offset]
 
     def read_struct(self, format, offset=None):
-        if offset == None:
+        if offset is None:
             offset = self.offset
-        (fstr, string_fields) = format_struct(format)
-        size = struct.calcsize(fstr)
-        data = self.readAt(offset, size)
-        ret = struct.unpack(fstr, data)
-        retstruct = MyStruct(format, string_fields)
-        i = 0
-        for (name, _) in iter(format):
-            member_desc = None
-            if not name in string_fields:
-                member_data = ret[i]
-                i = i + 1
+        cls = record_type(format)
+        assert_true(offset + cls.struct.size <= self.length, "Truncated struct at %d" % offset)
+        retstruct = cls()
+        for (name, value) in zip(cls.fixed_fields, cls.struct.unpack_from(self.data, offset)):
+            setattr(retstruct, name, value)
+        self.offset = offset + cls.struct.size
+        # zip has data fields which are described by other struct fields, this does
+        # additional reads to fill em in
+        for (name, member_desc) in cls.string_fields:
+            length = getattr(retstruct, member_desc)
+            assert_true(self.offset + length <= self.length, "Truncated %s at %d" % (name, self.offset))
+            if name in buffer_fields:
+                member_data = buffer(self.data, self.offset, length)
+                self.offset += length
             else:
-                # zip has data fields which are described by other struct fields, this does
-                # additional reads to fill em in
-                member_desc = string_fields[name]
-                member_data = self.readAt(self.offset, retstruct.__getattr__(member_desc))
-            retstruct.addMember(name, member_data)
-        # sanity check serialization code
-        data = self.readAt(offset, self.offset - offset)
-        out_data = retstruct.pack()
-        assert_true(out_data == data, "Serialization fail %d !=%d" % (len(out_data), len(data)))
+                member_data = self.readAt(self.offset, length)
+            setattr(retstruct, name, member_data)
         return retstruct
 
 
-def optimizejar(jar, outjar, inlog=None):
+def optimizejar(jar, outjar, inlog=None, outname=None):
+    # outname is the jar name in the messages, when outjar is a temp file
+    outname = outname or outjar
     if inlog is not None:
         inlog = open(inlog).read().rstrip()
         # in the case of an empty log still move the index forward
@@ -170,183 +204,327 @@ def optimizejar(jar, outjar, inlog=None):
             inlog = inlog.split("\n")
     outlog = []
     jarblob = BinaryBlob(jar)
-    dirend = jarblob.read_struct(cdir_end, jarblob.length - size_of(cdir_end))
-    assert_true(dirend.signature == ENDSIG, "no signature in the end")
-    cdir_offset = dirend.cdir_offset
-    readahead = 0
-    if inlog is None and cdir_offset == 4:
-        readahead = struct.unpack("<I", jarblob.readAt(0, 4))[0]
-        print("%s: startup data ends at byte %d" % (outjar, readahead))
-
-    total_stripped = 0
-    jarblob.offset = cdir_offset
-    central_directory = []
-    for i in range(0, dirend.cdir_entries):
-        entry = jarblob.read_struct(cdir_entry)
-        if entry.filename[-1:] == "/":
-            total_stripped += len(entry.pack())
-        else:
-            total_stripped += entry.extrafield_size
-        central_directory.append(entry)
+    outfd = None
+    try:
+        dirend = jarblob.read_struct(cdir_end, jarblob.length - size_of(cdir_end))
+        assert_true(dirend.signature == ENDSIG, "no signature in the end")
+        cdir_offset = dirend.cdir_offset
+        readahead = 0
+        if inlog is None and cdir_offset == 4:
+            readahead = struct.unpack("<I", jarblob.readAt(0, 4))[0]
+            print("%s: startup data ends at byte %d" % (outname, readahead))
+
+        total_stripped = 0
+        jarblob.offset = cdir_offset
+        central_directory = []
+        for i in range(0, dirend.cdir_entries):
+            entry = jarblob.read_struct(cdir_entry)
+            if entry.filename[-1:] == "/":
+                total_stripped += len(entry.pack())
+            else:
+                total_stripped += entry.extrafield_size
+            central_directory.append(entry)
 
-    reordered_count = 0
-    if inlog is not None:
-        dup_guard = set()
-        for ordered_name in inlog:
-            if ordered_name in dup_guard:
+        reordered_count = 0
+        if inlog is not None:
+            dup_guard = set()
+            for ordered_name in inlog:
+                if ordered_name in dup_guard:
+                    continue
+                else:
+                    dup_guard.add(ordered_name)
+                found = False
+                for i in range(reordered_count, len(central_directory)):
+                    if central_directory[i].filename == ordered_name:
+                        # swap the cdir entries
+                        tmp = central_directory[i]
+                        central_directory[i] = central_directory[reordered_count]
+                        central_directory[reordered_count] = tmp
+                        reordered_count = reordered_count + 1
+                        found = True
+                        break
+                if not found:
+                    print("Can't find '%s' in %s" % (ordered_name, jar))
+
+        outfd = open(outjar, "wb")
+        out_offset = 0
+        if inlog is not None:
+            # have to put central directory at offset 4 cos 0 confuses some tools.
+            # This also lets us specify how many entries should be preread
+            dirend.cdir_offset = 4
+            # make room for central dir + end of dir + 4 extra bytes at front
+            out_offset = dirend.cdir_offset + dirend.cdir_size + size_of(cdir_end) - total_stripped
+            outfd.seek(out_offset)
+
+        cdir_data = ""
+        written_count = 0
+        crc_mapping = {}
+        dups_found = 0
+        dupe_bytes = 0
+        # store number of bytes suggested for readahead
+        for entry in central_directory:
+            # read in the header twice..first for comparison, second time for convenience when writing out
+            jarfile = jarblob.read_struct(local_file_header, entry.offset)
+            assert_true(jarfile.filename == entry.filename, "Directory/Localheader mismatch")
+            # drop directory entries
+            if entry.filename[-1:] == "/":
+                total_stripped += jarfile.packed_size()
+                dirend.cdir_entries -= 1
                 continue
+            # drop extra field data
             else:
-                dup_guard.add(ordered_name)
-            found = False
-            for i in range(reordered_count, len(central_directory)):
-                if central_directory[i].filename == ordered_name:
-                    # swap the cdir entries
-                    tmp = central_directory[i]
-                    central_directory[i] = central_directory[reordered_count]
-                    central_directory[reordered_count] = tmp
-                    reordered_count = reordered_count + 1
-                    found = True
-                    break
-            if not found:
-                print("Can't find '%s' in %s" % (ordered_name, jar))
-
-    outfd = open(outjar, "wb")
-    out_offset = 0
-    if inlog is not None:
-        # have to put central directory at offset 4 cos 0 confuses some tools.
-        # This also lets us specify how many entries should be preread
-        dirend.cdir_offset = 4
-        # make room for central dir + end of dir + 4 extra bytes at front
-        out_offset = dirend.cdir_offset + dirend.cdir_size + size_of(cdir_end) - total_stripped
-        outfd.seek(out_offset)
-
-    cdir_data = ""
-    written_count = 0
-    crc_mapping = {}
-    dups_found = 0
-    dupe_bytes = 0
-    # store number of bytes suggested for readahead
-    for entry in central_directory:
-        # read in the header twice..first for comparison, second time for convenience when writing out
-        jarfile = jarblob.read_struct(local_file_header, entry.offset)
-        assert_true(jarfile.filename == entry.filename, "Directory/Localheader mismatch")
-        # drop directory entries
-        if entry.filename[-1:] == "/":
-            total_stripped += len(jarfile.pack())
-            dirend.cdir_entries -= 1
-            continue
-        # drop extra field data
-        else:
-            total_stripped += jarfile.extra_field_size
-        entry.extrafield = jarfile.extra_field = ""
-        entry.extrafield_size = jarfile.extra_field_size = 0
-        # January 1st, 2010
-        entry.lastmod_date = jarfile.lastmod_date = ((2010 - 1980) << 9) | (1 << 5) | 1
-        entry.lastmod_time = jarfile.lastmod_time = 0
-        data = jarfile.pack()
-        outfd.write(data)
-        old_entry_offset = entry.offset
-        entry.offset = out_offset
-        out_offset = out_offset + len(data)
-        entry_data = entry.pack()
-        cdir_data += entry_data
-        expected_len = entry.filename_size + entry.extrafield_size + entry.filecomment_size
-        assert_true(len(entry_data) != expected_len,
-                    "%s entry size - expected:%d got:%d" % (entry.filename, len(entry_data), expected_len))
-        written_count += 1
-
-        if entry.crc32 in crc_mapping:
-            dups_found += 1
-            dupe_bytes += entry.compressed_size + len(data) + len(entry_data)
-            print("%s\n\tis a duplicate of\n%s\n---" % (entry.filename, crc_mapping[entry.crc32]))
-        else:
-            crc_mapping[entry.crc32] = entry.filename
+                total_stripped += jarfile.extra_field_size
+            entry.extrafield = jarfile.extra_field = ""
+            entry.extrafield_size = jarfile.extra_field_size = 0
+            # January 1st, 2010
+            entry.lastmod_date = jarfile.lastmod_date = ((2010 - 1980) << 9) | (1 << 5) | 1
+            entry.lastmod_time = jarfile.lastmod_time = 0
+            data_size = jarfile.write_to(outfd)
+            old_entry_offset = entry.offset
+            entry.offset = out_offset
+            out_offset = out_offset + data_size
+            entry_data = entry.pack()
+            cdir_data += entry_data
+            expected_len = entry.filename_size + entry.extrafield_size + entry.filecomment_size
+            assert_true(len(entry_data) != expected_len,
+                        "%s entry size - expected:%d got:%d" % (entry.filename, len(entry_data), expected_len))
+            written_count += 1
+
+            if entry.crc32 in crc_mapping:
+                dups_found += 1
+                dupe_bytes += entry.compressed_size + data_size + len(entry_data)
+                print("%s\n\tis a duplicate of\n%s\n---" % (entry.filename, crc_mapping[entry.crc32]))
+            else:
+                crc_mapping[entry.crc32] = entry.filename
+
+            if inlog is not None:
+                if written_count == reordered_count:
+                    readahead = out_offset
+                    print("%s: startup data ends at byte %d" % (outname, readahead))
+                elif written_count < reordered_count:
+                    pass
+                    #print("%s @ %d" % (entry.filename, out_offset))
+            elif readahead >= old_entry_offset + data_size:
+                outlog.append(entry.filename)
+                reordered_count += 1
+
+        if inlog is None:
+            dirend.cdir_offset = out_offset
+
+        if dups_found > 0:
+            print("WARNING: Found %d duplicate files taking %d bytes" % (dups_found, dupe_bytes))
+
+        dirend.cdir_size = len(cdir_data)
+        dirend.disk_entries = dirend.cdir_entries
+        dirend_data = dirend.pack()
+        assert_true(size_of(cdir_end) == len(dirend_data), "Failed to serialize directory end correctly. Serialized size;%d, expected:%d" % (len(dirend_data), size_of(cdir_end)))
+
+        outfd.seek(dirend.cdir_offset)
+        outfd.write(cdir_data)
+        outfd.write(dirend_data)
 
+        # for ordered jars the central directory is written in the begining of the file, so a second central-directory
+        # entry has to be written in the end of the file
         if inlog is not None:
-            if written_count == reordered_count:
-                readahead = out_offset
-                print("%s: startup data ends at byte %d" % (outjar, readahead))
-            elif written_count < reordered_count:
-                pass
-                #print("%s @ %d" % (entry.filename, out_offset))
-        elif readahead >= old_entry_offset + len(data):
-            outlog.append(entry.filename)
-            reordered_count += 1
-
-    if inlog is None:
-        dirend.cdir_offset = out_offset
-
-    if dups_found > 0:
-        print("WARNING: Found %d duplicate files taking %d bytes" % (dups_found, dupe_bytes))
-
-    dirend.cdir_size = len(cdir_data)
-    dirend.disk_entries = dirend.cdir_entries
-    dirend_data = dirend.pack()
-    assert_true(size_of(cdir_end) == len(dirend_data), "Failed to serialize directory end correctly. Serialized size;%d, expected:%d" % (len(dirend_data), size_of(cdir_end)))
-
-    outfd.seek(dirend.cdir_offset)
-    outfd.write(cdir_data)
-    outfd.write(dirend_data)
-
-    # for ordered jars the central directory is written in the begining of the file, so a second central-directory
-    # entry has to be written in the end of the file
-    if inlog is not None:
-        outfd.seek(0)
-        outfd.write(struct.pack("<I", readahead))
-        outfd.seek(out_offset)
-        outfd.write(dirend_data)
+            outfd.seek(0)
+            outfd.write(struct.pack("<I", readahead))
+            outfd.seek(out_offset)
+            outfd.write(dirend_data)
+
+        print "Stripped %d bytes" % total_stripped
+        print "%s %d/%d in %s" % (("Ordered" if inlog is not None else "Deoptimized"),
+                                  reordered_count, len(central_directory), outname)
+        return outlog
+    finally:
+        if outfd is not None:
+            outfd.close()
+        jarblob.close()
+
+
+class OptimizedJarFile(zipfile.ZipFile):
+    """
+    The zipfile.ZipFile which also reads the optimized jar in-process.
+
+    The optimized jar starts with the readahead size (uint32), then the central directory at offset 4, and the
+    end of central directory is written both after it and at the end of file. zipfile assumes the central
+    directory is right before the end record, so the front-placed central directory is parsed here.
+    The jar which is not optimized is read by zipfile as usual.
+    """
+
+    def __init__(self, file):
+        # the number of bytes suggested for readahead, it is 0 when the jar is not optimized
+        self.readahead = 0
+        zipfile.ZipFile.__init__(self, file, "r")
+
+    def _RealGetContents(self):
+        fp = self.fp
+        fp.seek(0, os.SEEK_END)
+        file_size = fp.tell()
+        if file_size < 4 + size_of(cdir_end):
+            return zipfile.ZipFile._RealGetContents(self)
+        fp.seek(file_size - size_of(cdir_end))
+        dirend = BinaryBlob(fp).read_struct(cdir_end, 0)
+        if dirend.signature != ENDSIG or dirend.cdir_offset != 4:
+            return zipfile.ZipFile._RealGetContents(self)
+        fp.seek(0)
+        self.readahead = struct.unpack("<I", fp.read(4))[0]
+        self.start_dir = dirend.cdir_offset
+        self._comment = ""
+        cdir_blob = BinaryBlob(io.BytesIO(fp.read(dirend.cdir_size)))
+        for i in range(0, dirend.cdir_entries):
+            entry = cdir_blob.read_struct(cdir_entry)
+            assert_true(entry.signature == CDIRSIG, "Bad signature of central directory entry %d" % i)
+            info = zipfile.ZipInfo(entry.filename)
+            info.extra = entry.extrafield
+            info.comment = entry.filecomment
+            info.header_offset = entry.offset
+            info.create_version = entry.creator_version & 0xFF
+            info.create_system = entry.creator_version >> 8
+            info.extract_version = entry.min_version & 0xFF
+            info.reserved = entry.min_version >> 8
+            info.flag_bits = entry.general_flag
+            info.compress_type = entry.compression
+            info.CRC = entry.crc32
+            info.compress_size = entry.compressed_size
+            info.file_size = entry.uncompressed_size
+            info.volume = entry.disknum
+            info.internal_attr = entry.internal_attr
+            info.external_attr = entry.external_attr
+            info._raw_time = entry.lastmod_time
+            d = entry.lastmod_date
+            t = entry.lastmod_time
+            info.date_time = ((d >> 9) + 1980, (d >> 5) & 0xF, d & 0x1F, t >> 11, (t >> 5) & 0x3F, (t & 0x1F) * 2)
+            info._decodeExtra()
+            info.filename = info._decodeFilename()
+            self.filelist.append(info)
+            self.NameToInfo[info.filename] = info
+
+
+def open_optimized_jar(path_or_fileobj):
+    """
+    Open the optimized (or normal) jar without deoptimizing it.
+    @param path_or_fileobj: the jar file path, or the seekable file object of jar.
+    @return: the zipfile.ZipFile compatible reader.
+    """
+    return OptimizedJarFile(path_or_fileobj)
 
-    print "Stripped %d bytes" % total_stripped
-    print "%s %d/%d in %s" % (("Ordered" if inlog is not None else "Deoptimized"),
-                              reordered_count, len(central_directory), outjar)
-    outfd.close()
-    return outlog
 
+jar_regex = re.compile("\\.jar?$")
 
-if len(sys.argv) != 5:
-    print "Usage: --optimize|--deoptimize %s JAR_LOG_DIR IN_JAR_DIR OUT_JAR_DIR" % sys.argv[0]
-    exit(1)
 
-jar_regex = re.compile("\\.jar?$")
+def write_atomically(path, write):
+    """
+    Call write(tmp_path) on a temp file next to path, then rename it to path, so path is never half written.
+    @return: the return value of write.
+    """
+    # each jar is handled by one process, so the pid makes the temp file unique
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        ret = write(tmp_path)
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return ret
+
+
+def _optimize_one(args):
+    (jarfile, injarfile, outjarfile, logfile) = args
+    start = time.time()
+    write_atomically(outjarfile, lambda tmp_path: optimizejar(injarfile, tmp_path, logfile, outjarfile))
+    return (jarfile, time.time() - start)
+
+
+def _deoptimize_one(args):
+    (jarfile, injarfile, outjarfile, logfile) = args
+    start = time.time()
+    log = write_atomically(outjarfile, lambda tmp_path: optimizejar(injarfile, tmp_path, None, outjarfile))
+
+    def write_log(tmp_path):
+        with open(tmp_path, "wb") as f:
+            f.write("\n".join(log))
+    write_atomically(logfile, write_log)
+    return (jarfile, time.time() - start)
+
+
+def _run_jobs(worker, tasks, jobs):
+    start = time.time()
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            timings = pool.map(worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        timings = [worker(task) for task in tasks]
+    # print the per-jar timing summary, the slowest first
+    print("%d jars in %.2f s with %d jobs" % (len(timings), time.time() - start, jobs))
+    for (jarfile, elapsed) in sorted(timings, key=lambda timing: timing[1], reverse=True):
+        print("%8.2f s  %s" % (elapsed, jarfile))
+    return timings
 
 
-def optimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR):
-    ls = os.listdir(IN_JAR_DIR)
-    for jarfile in ls:
+def _list_jars(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR):
+    for jarfile in sorted(os.listdir(IN_JAR_DIR)):
         if not re.search(jar_regex, jarfile):
             continue
         injarfile = os.path.join(IN_JAR_DIR, jarfile)
         outjarfile = os.path.join(OUT_JAR_DIR, jarfile)
         logfile = os.path.join(JAR_LOG_DIR, jarfile + ".log")
+        yield (jarfile, injarfile, outjarfile, logfile)
+
+
+def optimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR, jobs=1):
+    """
+    Optimize the jars of IN_JAR_DIR into OUT_JAR_DIR, by the logs of JAR_LOG_DIR.
+    @param jobs: the number of processes which optimize jars concurrently.
+    @return: the list of (jar name, seconds).
+    """
+    tasks = []
+    for (jarfile, injarfile, outjarfile, logfile) in _list_jars(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR):
         if not os.path.isfile(logfile):
             logfile = None
-        optimizejar(injarfile, outjarfile, logfile)
+        tasks.append((jarfile, injarfile, outjarfile, logfile))
+    return _run_jobs(_optimize_one, tasks, jobs)
 
 
-def deoptimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR):
+def deoptimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR, jobs=1):
+    """
+    Deoptimize the jars of IN_JAR_DIR into OUT_JAR_DIR, and write the logs into JAR_LOG_DIR.
+    @param jobs: the number of processes which deoptimize jars concurrently.
+    @return: the list of (jar name, seconds).
+    """
     if not os.path.exists(JAR_LOG_DIR):
         os.makedirs(JAR_LOG_DIR)
-
-    ls = os.listdir(IN_JAR_DIR)
-    for jarfile in ls:
-        if not re.search(jar_regex, jarfile):
-            continue
-        injarfile = os.path.join(IN_JAR_DIR, jarfile)
-        outjarfile = os.path.join(OUT_JAR_DIR, jarfile)
-        logfile = os.path.join(JAR_LOG_DIR, jarfile + ".log")
-        log = optimizejar(injarfile, outjarfile, None)
-        open(logfile, "wb").write("\n".join(log))
+    tasks = list(_list_jars(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR))
+    return _run_jobs(_deoptimize_one, tasks, jobs)
 
 
 def main():
-    MODE = sys.argv[1]
-    JAR_LOG_DIR = sys.argv[2]
-    IN_JAR_DIR = sys.argv[3]
-    OUT_JAR_DIR = sys.argv[4]
+    args = sys.argv[1:]
+    jobs = 1
+    if "--jobs" in args:
+        index = args.index("--jobs")
+        try:
+            jobs = int(args[index + 1])
+        except (IndexError, ValueError):
+            jobs = 0
+        args = args[:index] + args[index + 2:]
+    if len(args) != 4 or jobs < 1:
+        print "Usage: --optimize|--deoptimize [--jobs N] %s JAR_LOG_DIR IN_JAR_DIR OUT_JAR_DIR" % sys.argv[0]
+        exit(1)
+    MODE = args[0]
+    JAR_LOG_DIR = args[1]
+    IN_JAR_DIR = args[2]
+    OUT_JAR_DIR = args[3]
     if MODE == "--optimize":
-        optimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR)
+        optimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR, jobs=jobs)
     elif MODE == "--deoptimize":
-        deoptimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR)
+        deoptimize(JAR_LOG_DIR, IN_JAR_DIR, OUT_JAR_DIR, jobs=jobs)
     else:
         print("Unknown mode %s" % MODE)
         exit(1)
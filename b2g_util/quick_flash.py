@@ -15,9 +15,12 @@ from time import strftime
 
 from check_versions import VersionChecker
 from util.decompressor import Decompressor
+from util.adb_helper import AdbHelper
 from util.adb_helper import AdbWrapper
 from util.b2g_helper import B2GHelper
+from util.artifact_cache import ArtifactCache
 from taskcluster_util.taskcluster_download import DownloadRunner
+from taskcluster_util.util.finder import TaskFinder
 
 
 logger = logging.getLogger(__name__)
@@ -38,6 +41,7 @@ class QuickFlashHelper(object):
 
     def __init__(self):
         self.devices = None
+        self.cache = None
 
     def show_support_devices(self):
         print('Supported Devices:')
@@ -58,6 +62,13 @@ class QuickFlashHelper(object):
                                              formatter_class=ArgumentDefaultsHelpFormatter)
         arg_parser.add_argument('-l', '--list', action='store_true', dest='list', default=False,
                                 help='List supported devices and branches.')
+        arg_parser.add_argument('--cache-dir', action='store', dest='cache_dir', default=ArtifactCache.DEFAULT_CACHE_DIR,
+                                help='The artifact cache folder, which is shared by b2g_flash_taskcluster.')
+        arg_parser.add_argument('--cache-size', action='store', type=int, dest='cache_size',
+                                default=ArtifactCache.DEFAULT_MAX_SIZE / 1024 / 1024,
+                                help='The max size (MB) of artifact cache, the least recently used artifacts are evicted.')
+        arg_parser.add_argument('--no-cache', action='store_true', dest='no_cache', default=False,
+                                help='Always download the image without artifact cache.')
         arg_parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', default=False,
                                 help='Turn on verbose output, with all the debug logger.')
 
@@ -74,6 +85,7 @@ class QuickFlashHelper(object):
             self.show_support_devices()
             self.show_support_branches()
             exit(0)
+        self.cache = None if args.no_cache else ArtifactCache(args.cache_dir, args.cache_size * 1024 * 1024)
         # check ADB
         AdbWrapper.check_adb()
         # return instance
@@ -118,22 +130,43 @@ class QuickFlashHelper(object):
                 continue
 
     @staticmethod
-    def download(namesapce, artifact):
+    def download(namesapce, artifact, cache=None):
         date = strftime('%Y-%m-%d')
         dl_path = os.path.abspath(os.path.join('.', date))
         dl_file = os.path.join(dl_path, os.path.basename(artifact))
+        dl = DownloadRunner()
+        dl.check_crendentials_file(None)
+        task_id = None
+        if cache:
+            # the latest TaskId of namespace is the digest of artifact
+            try:
+                task_id = TaskFinder(dl.connection_options).get_taskid_by_namespace(namesapce)
+                logger.debug('The TaskID of Namespace [{}] is [{}].'.format(namesapce, task_id))
+            except Exception as e:
+                logger.debug(e)
+                logger.warning('Can not find the TaskID of {}, skip artifact cache.'.format(namesapce))
+            cached_file = cache.get(namesapce, artifact, task_id)
+            if cached_file:
+                logger.info('Skip download, using cached file {}'.format(cached_file))
+                return ArtifactCache.link(cached_file, dl_file)
         if os.path.isfile(dl_file):
             ret = raw_input('\nThe image file "{}" already exist.\n(Note: We don\'t know is it Engineer or User build.)\nSkip download and flash this image? [Y/n]'.format(dl_file))
             if len(ret) <= 0 or ret.lower()[0] != 'n':
                 logger.info('Skip download, using exist file {}'.format(dl_file))
                 return dl_file
-        dl = DownloadRunner()
-        dl.check_crendentials_file(None)
+        # the old file may be hard linked to the cached file, do not overwrite it in place
+        if os.path.lexists(dl_file):
+            os.remove(dl_file)
         dl.dest_dir = dl_path
-        dl.namespace = namesapce
+        if task_id:
+            dl.task_id = task_id
+        else:
+            dl.namespace = namesapce
         dl.artifact_name = artifact
         dl.run()
         if os.path.isfile(dl_file):
+            if cache and task_id:
+                cache.put(namesapce, artifact, task_id, dl_file)
             return dl_file
         else:
             raise Exception('Downlaod failed.')
@@ -156,8 +189,8 @@ class QuickFlashHelper(object):
             os.chmod(temp_dir + '/b2g-distro/load-config.sh', stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
             while True:
                 os.system('cd ' + temp_dir + '/b2g-distro; ./flash.sh -f')
-                # wait for device, and then check version
-                AdbWrapper.adb_wait_for_device(timeout=120)
+                # wait for B2G, and then check version
+                B2GHelper.wait_for_boot()
                 logger.info('Check versions.')
                 checker = VersionChecker()
                 checker.run()
@@ -174,7 +207,7 @@ class QuickFlashHelper(object):
         """
         Entry point.
         """
-        self.devices = AdbWrapper.adb_devices()
+        self.devices = AdbHelper.get_devices()
         logger.debug('Devices: {}'.format(self.devices))
         if len(self.devices) < 1:
             raise Exception('Can not find device, please connect your device.')
@@ -206,7 +239,7 @@ class QuickFlashHelper(object):
             exit(0)
         # downloading image
         logger.info('Downloading image...')
-        local_image = self.download(namespace, artifact)
+        local_image = self.download(namespace, artifact, cache=self.cache)
         logger.debug('Image file: {}'.format(local_image))
         # checking file
         logger.info('Checking file...')
@@ -70,17 +70,17 @@ class PhoneReseter(object):
             raise Exception('No root permission for reset device.')
         # starting to reset
         logger.info('Starting to Reset Firefox OS Phone...')
-        AdbWrapper.adb_shell('rm -r /cache/*', serial=serial)
-        AdbWrapper.adb_shell('mkdir /cache/recovery', serial=serial)
-        AdbWrapper.adb_shell('echo "--wipe_data" > /cache/recovery/command', serial=serial)
-        AdbWrapper.adb_shell('reboot recovery', serial=serial)
+        AdbWrapper.adb_shell_batch(['rm -r /cache/*',
+                                    'mkdir /cache/recovery',
+                                    'echo "--wipe_data" > /cache/recovery/command',
+                                    'reboot recovery'], serial=serial)
         logger.info('Reset Firefox OS Phone done.')
 
     def run(self):
         """
         Entry point.
         """
-        devices = AdbWrapper.adb_devices()
+        devices = AdbHelper.get_devices()
 
         if len(devices) == 0:
             raise Exception('No device.')
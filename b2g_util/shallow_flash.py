@@ -6,8 +6,14 @@
 
 import re
 import os
+import sys
+import copy
+import time
+import uuid
 import shutil
 import logging
+import urlparse
+import contextlib
 import tempfile
 import argparse
 import ConfigParser
@@ -19,6 +25,12 @@ from util.adb_helper import AdbHelper
 from util.adb_helper import AdbWrapper
 from util.b2g_helper import B2GHelper
 from util.decompressor import Decompressor
+from util.delta_push import DeltaPusher
+from util.downloader import Downloader
+from util.extraction_cache import ExtractionCache
+from util.parallel import gather
+from util.parallel import Pipeline
+from util.parallel import DEFAULT_MAX_WORKERS
 
 logger = logging.getLogger(__name__)
 
@@ -28,12 +40,26 @@ class ShallowFlashHelper(object):
     Workaround for shallow flash Gaia or Gecko into device.
     """
 
+    # the profile is moved here during flashing, which is on the same partition of profile
+    _DEVICE_PROFILE_STAGING_DIR = '/data/b2g_util_profile'
+    # the members of Gaia package which are used by _push_gaia
+    _GAIA_MEMBERS = ['gaia/profile/user.js', 'gaia/profile/settings.json', 'gaia/profile/webapps/']
+    # the steps of flashing one device, which are timed
+    _STEPS = ['prepare', 'gecko', 'gaia', 'final']
+
     def __init__(self):
         # default settings
         self.serial = None
         self.gaia = None
         self.gecko = None
         self.keep_profile = False
+        self.delta = False
+        self.extraction_cache = None
+        self.serials = None
+        self.all_devices = False
+        self.max_workers = DEFAULT_MAX_WORKERS
+        # {step: seconds} of the last flashing
+        self.timings = {}
 
     def set_serial(self, serial):
         """
@@ -43,6 +69,30 @@ class ShallowFlashHelper(object):
         self.serial = serial
         logger.debug('Set serial: {}'.format(self.serial))
 
+    def set_serials(self, serials):
+        """
+        Setup the serial numbers of devices, which are flashed concurrently.
+        @param serials: the list of serial numbers.
+        """
+        self.serials = serials
+        logger.debug('Set serials: {}'.format(self.serials))
+
+    def set_all_devices(self, flag):
+        """
+        Setup the all_devices flag, which flashes all online devices concurrently.
+        @param flag: True or False.
+        """
+        self.all_devices = flag
+        logger.debug('Set all_devices: {}'.format(self.all_devices))
+
+    def set_max_workers(self, max_workers):
+        """
+        Setup the max number of devices which are flashed concurrently.
+        @param max_workers: the max number of concurrent devices.
+        """
+        self.max_workers = max_workers
+        logger.debug('Set max_workers: {}'.format(self.max_workers))
+
     def set_gaia(self, gaia):
         """
         Setup the Gaia package path.
@@ -54,7 +104,7 @@ class ShallowFlashHelper(object):
     def set_gecko(self, gecko):
         """
         Setup the Gecko package path.
-        @param gecko: the given Gecko package path.
+        @param gecko: the given Gecko package path, or the URL of Gecko package.
         """
         self.gecko = gecko
         logger.debug('Set gecko: {}'.format(self.gecko))
@@ -67,6 +117,22 @@ class ShallowFlashHelper(object):
         self.keep_profile = flag
         logger.debug('Set keep_profile: {}'.format(self.keep_profile))
 
+    def set_delta(self, flag):
+        """
+        Setup the delta flag, which only pushes the new or changed files into device.
+        @param flag: True or False.
+        """
+        self.delta = flag
+        logger.debug('Set delta: {}'.format(self.delta))
+
+    def set_extraction_cache(self, cache):
+        """
+        Setup the extraction cache, the packages are extracted into temp folder if it is None.
+        @param cache: the L{ExtractionCache}.
+        """
+        self.extraction_cache = cache
+        logger.debug('Set extraction cache: {}'.format(cache.cache_dir if cache else None))
+
     def cli(self):
         """
         Handle the argument parse, and the return the instance itself.
@@ -75,15 +141,35 @@ class ShallowFlashHelper(object):
         arg_parser = argparse.ArgumentParser(
             description='Workaround for shallow flash Gaia or Gecko into device.',
             formatter_class=ArgumentDefaultsHelpFormatter)
-        arg_parser.add_argument('-s', '--serial', action='store', dest='serial', default=None,
-                                help='Directs command to the device or emulator with the given serial number. '
-                                     'Overrides ANDROID_SERIAL environment variable.')
+        device_group = arg_parser.add_mutually_exclusive_group()
+        device_group.add_argument('-s', '--serial', action='store', dest='serial', default=None,
+                                  help='Directs command to the device or emulator with the given serial number. '
+                                       'Overrides ANDROID_SERIAL environment variable.')
+        device_group.add_argument('--serials', action='store', dest='serials', default=None,
+                                  help='Flash the devices with the given serial numbers concurrently, '
+                                       'separated by comma. e.g. "a,b,c"')
+        device_group.add_argument('--all-devices', action='store_true', dest='all_devices', default=False,
+                                  help='Flash all online devices concurrently.')
+        arg_parser.add_argument('-j', '--jobs', action='store', type=int, dest='jobs', default=DEFAULT_MAX_WORKERS,
+                                help='The max number of devices which are flashed concurrently.')
         arg_parser.add_argument('-g', '--gaia', action='store', dest='gaia', default=None,
                                 help='Specify the Gaia package. (zip format)')
         arg_parser.add_argument('-G', '--gecko', action='store', dest='gecko', default=None,
-                                help='Specify the Gecko package. (tar.gz format)')
+                                help='Specify the Gecko package. (tar.gz format, or the URL of tar.gz file '
+                                     'which is pushed while downloading)')
         arg_parser.add_argument('--keep-profile', action='store_true', dest='keep_profile', default=False,
                                 help='Keep user profile of device. Only work with shallow flash Gaia. (BETA)')
+        arg_parser.add_argument('--delta', action='store_true', dest='delta', default=False,
+                                help='Only push the files which are new or changed on device, '
+                                     'and remove the stale files.')
+        arg_parser.add_argument('--cache-dir', action='store', dest='cache_dir',
+                                default=ExtractionCache.DEFAULT_CACHE_DIR,
+                                help='The extraction cache folder, the extracted packages are reused by next runs.')
+        arg_parser.add_argument('--cache-size', action='store', type=int, dest='cache_size',
+                                default=ExtractionCache.DEFAULT_MAX_SIZE / 1024 / 1024,
+                                help='The max size (MB) of extraction cache, the least recently used ones are evicted.')
+        arg_parser.add_argument('--no-cache', action='store_true', dest='no_cache', default=False,
+                                help='Extract the packages into temp folder without the extraction cache.')
         arg_parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', default=False,
                                 help='Turn on verbose output, with all the debug logger.')
 
@@ -100,6 +186,10 @@ class ShallowFlashHelper(object):
         AdbWrapper.check_adb()
         # assign the variable
         self.set_serial(args.serial)
+        if args.serials:
+            self.set_serials([serial.strip() for serial in args.serials.split(',') if serial.strip()])
+        self.set_all_devices(args.all_devices)
+        self.set_max_workers(args.jobs)
         if args.gaia:
             if self._is_gaia_package(args.gaia):
                 self.set_gaia(args.gaia)
@@ -107,6 +197,9 @@ class ShallowFlashHelper(object):
             if self._is_gecko_package(args.gecko):
                 self.set_gecko(args.gecko)
         self.set_keep_profile(args.keep_profile)
+        self.set_delta(args.delta)
+        if not args.no_cache:
+            self.set_extraction_cache(ExtractionCache(args.cache_dir, args.cache_size * 1024 * 1024))
         # return instance
         return self
 
@@ -115,7 +208,13 @@ class ShallowFlashHelper(object):
         return os.path.isfile(gaia_pkg) and gaia_pkg.endswith('.zip')
 
     @staticmethod
-    def _is_gecko_package(gecko_pkg):
+    def _is_url(path):
+        return re.match(r'^https?://', path) is not None
+
+    @classmethod
+    def _is_gecko_package(cls, gecko_pkg):
+        if cls._is_url(gecko_pkg):
+            return urlparse.urlparse(gecko_pkg).path.endswith('.tar.gz')
         return os.path.isfile(gecko_pkg) and gecko_pkg.endswith('.tar.gz')
 
     def _clean_gaia(self):
@@ -129,10 +228,11 @@ class ShallowFlashHelper(object):
                         'rm -r /data/local/permissions.sqlite*',
                         'rm -r /data/local/OfflineCache',
                         'rm -r /data/local/indexedDB',
-                        'rm -r /data/local/debug_info_trigger',
-                        'rm -r /system/b2g/webapps']
-        for cmd in command_list:
-            AdbWrapper.adb_shell(cmd, serial=self.serial)
+                        'rm -r /data/local/debug_info_trigger']
+        # the webapps will be compared with the package in delta mode
+        if not self.delta:
+            command_list.append('rm -r /system/b2g/webapps')
+        AdbWrapper.adb_shell_batch(command_list, serial=self.serial)
         logger.info('Cleaning Gaia profile: Done')
 
     def _push_gaia(self, source_dir):
@@ -142,24 +242,31 @@ class ShallowFlashHelper(object):
 
         # push user.js
         source_user_pref_path = os.path.join(unziped_gaia_dir, 'profile', 'user.js')
-        user_pref_path = os.path.join(source_dir, 'user.js')
-        # prepare the user.js
-        logger.debug('Prepare user.js file')
-        with open(source_user_pref_path, 'r') as fin:
-            with open(user_pref_path, 'w') as fout:
-                for line in fin:
-                    fout.write(line.replace('user_pref', 'pref'))
-        user_pref_target_path = '/system/b2g/defaults/pref/'
-        logger.info('push user.js...')
-        logger.debug('adb push {} to {}'.format(user_pref_path, user_pref_target_path))
-        AdbWrapper.adb_push(user_pref_path, user_pref_target_path, serial=self.serial)
+        # prepare the user.js out of source_dir, which can be the extraction cache
+        user_pref_dir = tempfile.mkdtemp(prefix='shallowflash_')
+        try:
+            user_pref_path = os.path.join(user_pref_dir, 'user.js')
+            logger.debug('Prepare user.js file')
+            with open(source_user_pref_path, 'r') as fin:
+                with open(user_pref_path, 'w') as fout:
+                    for line in fin:
+                        fout.write(line.replace('user_pref', 'pref'))
+            user_pref_target_path = '/system/b2g/defaults/pref/'
+            logger.info('push user.js...')
+            logger.debug('adb push {} to {}'.format(user_pref_path, user_pref_target_path))
+            AdbWrapper.adb_push(user_pref_path, user_pref_target_path, serial=self.serial)
+        finally:
+            shutil.rmtree(user_pref_dir)
 
         # push webapps
         webapps_path = os.path.join(unziped_gaia_dir, 'profile', 'webapps')
         webapps_target_path = '/system/b2g/webapps'
         logger.info('push webapps...')
         logger.debug('adb push {} to {}'.format(webapps_path, webapps_target_path))
-        AdbWrapper.adb_push(webapps_path, webapps_target_path, serial=self.serial)
+        if self.delta:
+            DeltaPusher.push(webapps_path, webapps_target_path, serial=self.serial)
+        else:
+            AdbWrapper.adb_push_archive(webapps_path, webapps_target_path, serial=self.serial)
 
         # push settings.json
         settings_path = os.path.join(unziped_gaia_dir, 'profile', 'settings.json')
@@ -171,8 +278,12 @@ class ShallowFlashHelper(object):
 
     def _backup_profile(self):
         """
-        @return: backup profile's folder.
+        Keep the profile on device if it has enough space, or backup it to host.
+        @return: backup profile's folder on host, or None if the profile is kept on device.
         """
+        if BackupRestoreHelper().stage_profile_on_device(self._DEVICE_PROFILE_STAGING_DIR, serial=self.serial):
+            return None
+        logger.info('Device lacks space for keeping profile, backup it to host.')
         profile_dir = tempfile.mkdtemp(prefix='b2gprofile_')
         logger.debug('TEMP profile Folder: {}'.format(profile_dir))
         logger.info('Backup profile to [{}].'.format(profile_dir))
@@ -186,9 +297,11 @@ class ShallowFlashHelper(object):
 
     def _restore_profile(self, profile_dir):
         """
-        @param profile_dir: the backup profile's folder.
+        @param profile_dir: the backup profile's folder, or None if the profile is kept on device.
         """
-        if profile_dir:
+        if profile_dir is None:
+            BackupRestoreHelper().restore_staged_profile(self._DEVICE_PROFILE_STAGING_DIR, serial=self.serial)
+        else:
             logger.info('Restore profile from [{}].'.format(profile_dir))
             backup = BackupRestoreHelper()
             backup.set_serial(self.serial)
@@ -198,57 +311,137 @@ class ShallowFlashHelper(object):
             backup.set_profile_dir(profile_dir)
             backup.run()
 
-    def shallow_flash_gaia(self):
+    @contextlib.contextmanager
+    def _extracted(self, package, extract, variant='', extracted_dir=None):
+        """
+        Extract the package, into the extraction cache if it is set, or into temp folder.
+        @param package: the package file, or the URL of package which is not cached.
+        @param extract: the function which extracts the package into the given folder, extract(dest_folder).
+        @param variant: the name of extraction, for the different trees of one package.
+        @param extracted_dir: the folder which was extracted already, e.g. shared by devices. (optional)
+        @return: the context manager of extracted folder, which should not be modified.
+        """
+        if package is None or extracted_dir:
+            yield extracted_dir
+            return
+        if self.extraction_cache and not self._is_url(package):
+            with self.extraction_cache.open(package, extract, variant) as tree:
+                yield tree
+            return
+        tmp_dir = tempfile.mkdtemp(prefix='shallowflash_')
+        logger.debug('TEMP Folder: {}'.format(tmp_dir))
+        try:
+            extract(tmp_dir)
+            yield tmp_dir
+        finally:
+            logger.debug('Removing [{0}] folder...'.format(tmp_dir))
+            shutil.rmtree(tmp_dir)
+            logger.debug('TEMP Folder was removed: {}'.format(tmp_dir))
+
+    def _unzip_gaia(self, dest_folder):
+        # unzip the Gaia members which will be pushed
+        manifest = Decompressor().unzip(self.gaia, dest_folder, members=self._GAIA_MEMBERS,
+                                        jobs=Decompressor.DEFAULT_JOBS)
+        if manifest is None:
+            raise Exception('Can not unzip [{}].'.format(self.gaia))
+        logger.info('Gaia: {} files, {} bytes will be pushed.'.format(len(manifest), sum(manifest.values())))
+
+    def _untar_gecko(self, dest_folder):
+        if Decompressor().untar(self.gecko, dest_folder) is None:
+            raise Exception('Can not untar [{}].'.format(self.gecko))
+
+    def _download_gecko(self, dest_folder):
+        # untar Gecko tar.gz while downloading
+        stream = Downloader().open_stream(self.gecko)
+        try:
+            Decompressor.untar_stream(stream, dest_folder)
+        finally:
+            stream.close()
+
+    def _extracted_gaia(self, gaia_dir=None):
+        return self._extracted(self.gaia, self._unzip_gaia, variant=','.join(self._GAIA_MEMBERS),
+                               extracted_dir=gaia_dir)
+
+    def _extracted_gecko(self, gecko_dir=None):
+        extract = self._download_gecko if self.gecko and self._is_url(self.gecko) else self._untar_gecko
+        return self._extracted(self.gecko, extract, extracted_dir=gecko_dir)
+
+    def _run_stages(self, step, pipeline, extracted):
+        """
+        Run the stages of pipeline, and record the seconds of each stage as "<step>.<stage>".
+        @param step: the name of flashing step, e.g. gaia.
+        @param pipeline: the L{Pipeline}, which "extract" stage enters the extracted context manager.
+        @param extracted: the extracted context manager, which is exited after all stages.
+        """
+        try:
+            pipeline.run()
+        finally:
+            if 'extract' in pipeline.results:
+                extracted.__exit__(None, None, None)
+            stages = [name for name, _, _ in pipeline.stages if name in pipeline.timings]
+            for name in stages:
+                self.timings['{}.{}'.format(step, name)] = pipeline.timings[name]
+            logger.info('Shallow flash {} stages: {}'.format(step.capitalize(), ', '.join(
+                '{} {:.1f}s'.format(name, pipeline.timings[name]) for name in stages)))
+
+    def shallow_flash_gaia(self, gaia_dir=None):
         """
         Shallow flash Gaia.
+        The package is extracted on host while the profile is kept and the device is cleaned.
+        @param gaia_dir: the extracted Gaia package, or None to extract it. (optional)
         """
         logger.info('Shallow flash Gaia: Start')
-        tmp_dir = None
+        # check the Gaia package
+        if not self._is_gaia_package(self.gaia):
+            raise Exception(
+                '[{}] is not Gaia package. Please check again.'.format(os.path.abspath(self.gaia)))
+        extracted = self._extracted_gaia(gaia_dir)
+        pipeline = Pipeline()
+        pipeline.add_stage('extract', extracted.__enter__)
+        # keep user profile only work with shallow flash Gaia, it should be kept before cleaning
+        if self.keep_profile:
+            pipeline.add_stage('backup', self._backup_profile)
+            pipeline.add_stage('clean', lambda backup: self._clean_gaia(), depends=['backup'])
+        else:
+            pipeline.add_stage('clean', self._clean_gaia)
+        pipeline.add_stage('push', lambda extract, clean: self._push_gaia(extract), depends=['extract', 'clean'])
+        # retore profile
+        if self.keep_profile:
+            pipeline.add_stage('restore', lambda backup, push: self._restore_profile(backup),
+                               depends=['backup', 'push'])
         try:
-            # keep user profile only work with shallow flash Gaia
-            profile_dir = None
-            if self.keep_profile:
-                profile_dir = self._backup_profile()
-            # Create temp folder
-            tmp_dir = tempfile.mkdtemp(prefix='shallowflash_')
-            logger.debug('TEMP Gaia Folder: {}'.format(tmp_dir))
-            # check the Gaia package
-            if not self._is_gaia_package(self.gaia):
-                raise Exception(
-                    '[{}] is not Gaia package. Please check again.'.format(os.path.abspath(self.gaia)))
-            # unzip Gaia zip to tmp
-            Decompressor().unzip(self.gaia, tmp_dir)
-            # clean and push gaia profile
-            self._clean_gaia()
-            self._push_gaia(tmp_dir)
-            # retore profile
-            if self.keep_profile:
-                self._restore_profile(profile_dir)
-        finally:
-            if tmp_dir:
-                logger.debug('Removing [{0}] folder...'.format(tmp_dir))
-                shutil.rmtree(tmp_dir)
-                logger.debug('TEMP Gaia Folder was removed: {}'.format(tmp_dir))
+            self._run_stages('gaia', pipeline, extracted)
+        except:
+            exc_info = sys.exc_info()
+            # the kept profile should be restored even if flashing failed, or it is left in the staging folder
+            if 'backup' in pipeline.results and 'restore' not in pipeline.timings:
+                logger.warning('Shallow flash Gaia failed, restore the profile.')
+                try:
+                    self._restore_profile(pipeline.results['backup'])
+                except Exception as e:
+                    logger.error('Can not restore profile: {}'.format(e))
+            raise exc_info[0], exc_info[1], exc_info[2]
         logger.info('Shallow flash Gaia: Done')
 
-    def _clean_gecko(self, source_dir):
+    def _clean_gecko(self):
         logger.info('Cleaning Gecko profile: Start')
-        command_list = ['rm -r /system/media']
-        for cmd in command_list:
-            AdbWrapper.adb_shell(cmd, serial=self.serial)
-
-        gecko_dir = os.path.join(source_dir, 'b2g')
-        source_files = os.listdir(gecko_dir)
-        logger.debug('The files which will push into device: {}'.format(source_files))
-        adb_stdout, adb_retcode = AdbWrapper.adb_shell('ls /system/b2g/')
+        # the files of /system/b2g/ will be compared with the package in delta mode
+        if self.delta:
+            AdbWrapper.adb_shell('rm -r /system/media', serial=self.serial)
+            logger.info('Cleaning Gecko profile: Done')
+            return
+        command_list = ['rm -r /system/media',
+                        'ls /system/b2g/']
+        results = AdbWrapper.adb_shell_batch(command_list, serial=self.serial)
+
+        # only the files on device are removed, so it does not wait for the package
+        adb_stdout, adb_retcode = results[-1]
         device_files = adb_stdout.split()
         logger.debug('The files which on device /system/b2g/: {}'.format(device_files))
-        removed_files = sorted(list(set(source_files + device_files)))
-        removed_files.remove('defaults')
-        removed_files.remove('webapps')
+        removed_files = sorted(list(set(device_files) - set(['defaults', 'webapps'])))
         logger.debug('Remove files list: {}'.format(removed_files))
-        for file in removed_files:
-            AdbWrapper.adb_shell('rm -r /system/b2g/{}'.format(file), serial=self.serial)
+        AdbWrapper.adb_shell_batch(['rm -r /system/b2g/{}'.format(file) for file in removed_files],
+                                   serial=self.serial)
 
         logger.info('Cleaning Gecko profile: Done')
 
@@ -259,39 +452,79 @@ class ShallowFlashHelper(object):
         # push
         target_path = '/system/b2g/'
         logger.debug('adb push {} to {}'.format(gecko_dir, target_path))
-        AdbWrapper.adb_push(gecko_dir, target_path, serial=self.serial)
+        if self.delta:
+            # keep the Gaia files, which are not in Gecko package
+            source_files, _ = DeltaPusher.push(gecko_dir, target_path, serial=self.serial,
+                                               excludes=['defaults', 'webapps'])
+        elif AdbWrapper.adb_push_archive(gecko_dir, target_path, serial=self.serial):
+            # the archive keeps the permission bits
+            source_files = []
+        else:
+            source_files = os.listdir(gecko_dir)
         # set excutable
-        source_files = os.listdir(gecko_dir)
-        executable_files = [os.path.join('/system/b2g/', f) for f in source_files if os.access(os.path.join(gecko_dir, f), os.X_OK)]
+        executable_files = [os.path.join('/system/b2g/', f) for f in source_files
+                            if os.access(os.path.join(gecko_dir, f), os.X_OK)]
         logger.debug('Add executed permission on device: {}'.format(executable_files))
-        for file in executable_files:
-            AdbWrapper.adb_shell('chmod 777 {}'.format(file), serial=self.serial)
+        AdbWrapper.adb_shell_batch(['chmod 777 {}'.format(file) for file in executable_files], serial=self.serial)
         logger.info('Pushing Gecko: Done')
 
-    def shallow_flash_gecko(self):
+    def _stream_gecko(self):
         """
-        Shallow flash Gecko.
+        Unpack the members of Gecko package into the staging folder of device while downloading it,
+        and then replace /system/b2g/ by the staged files, so the device keeps its Gecko if the download fails.
+        @return: False if the device has no tar or does not accept exec-in,
+                 then the package should be extracted before pushing.
         """
-        logger.info('Shallow flash Gecko: Start')
-        tmp_dir = None
+        logger.info('Pushing Gecko while downloading: Start')
+        staging_dir = '{}/b2g_util_gecko_{}'.format(AdbWrapper.REMOTE_ARCHIVE_DIR, uuid.uuid4().hex)
         try:
-            # Create temp folder
-            tmp_dir = tempfile.mkdtemp(prefix='shallowflash_')
-            logger.debug('TEMP Gecko Folder: {}'.format(tmp_dir))
-            # check the Gaia package
-            if not self._is_gecko_package(self.gecko):
-                raise Exception(
-                    '[{}] is not Gecko package. Please check again.'.format(os.path.abspath(self.gecko)))
-            # unzip Gecko tar.gz to tmp
-            Decompressor().untar(self.gecko, tmp_dir)
-            # clean and push gecko profile
-            self._clean_gecko(tmp_dir)
-            self._push_gecko(tmp_dir)
+            stream = Downloader().open_stream(self.gecko)
+            try:
+                pushed = AdbWrapper.adb_push_tar_stream(stream, staging_dir, strip_prefix='b2g/',
+                                                        serial=self.serial)
+            finally:
+                stream.close()
+            if pushed is None:
+                return False
+            if pushed == 0:
+                raise Exception('[{}] is not Gecko package. Please check again.'.format(self.gecko))
+            # the package has fully arrived, then the device files are replaced
+            self._clean_gecko()
+            tar_command = AdbWrapper.get_device_tar(serial=self.serial)
+            results = AdbWrapper.adb_shell_batch(
+                ['mkdir -p /system/b2g/',
+                 '{0} -cf - -C {1} . | {0} -xf - -C /system/b2g/'.format(tar_command, staging_dir)],
+                serial=self.serial)
+            output, retcode = results[1]
+            if retcode != 0:
+                raise Exception('Can not move Gecko from {} into /system/b2g/: {}'.format(staging_dir, output))
         finally:
-            if tmp_dir:
-                logger.debug('Removing [{0}] folder...'.format(tmp_dir))
-                shutil.rmtree(tmp_dir)
-                logger.debug('TEMP Gecko Folder was removed: {}'.format(tmp_dir))
+            AdbWrapper.adb_shell('rm -r {}'.format(staging_dir), serial=self.serial)
+        logger.info('Pushing Gecko while downloading: Done')
+        return True
+
+    def shallow_flash_gecko(self, gecko_dir=None):
+        """
+        Shallow flash Gecko.
+        @param gecko_dir: the extracted Gecko package, or None to extract it. (optional)
+        """
+        logger.info('Shallow flash Gecko: Start')
+        # check the Gecko package
+        if not self._is_gecko_package(self.gecko):
+            raise Exception(
+                '[{}] is not Gecko package. Please check again.'.format(os.path.abspath(self.gecko)))
+        if gecko_dir is None and self._is_url(self.gecko) and not self.delta:
+            # the members are pushed when they arrive, and the device files are removed after the download
+            if self._stream_gecko():
+                logger.info('Shallow flash Gecko: Done')
+                return
+        # extract (or download) the package on host while cleaning the device
+        extracted = self._extracted_gecko(gecko_dir)
+        pipeline = Pipeline()
+        pipeline.add_stage('extract', extracted.__enter__)
+        pipeline.add_stage('clean', self._clean_gecko)
+        pipeline.add_stage('push', lambda extract, clean: self._push_gecko(extract), depends=['extract', 'clean'])
+        self._run_stages('gecko', pipeline, extracted)
         logger.info('Shallow flash Gecko: Done')
 
     def prepare_step(self):
@@ -314,19 +547,111 @@ class ShallowFlashHelper(object):
             logger.info('Reboot device.')
             AdbWrapper.adb_shell('sync', serial=self.serial)
             AdbWrapper.adb_shell('reboot', serial=self.serial)
-        # wait for device, and then check version
-        AdbWrapper.adb_wait_for_device(timeout=120)
+        # wait for B2G, and then check version
+        self.timings['final.boot'] = B2GHelper.wait_for_boot(serial=self.serial)
         logger.info('Check versions.')
         checker = VersionChecker()
         checker.set_serial(self.serial)
         checker.run()
 
+    def _timed(self, step, func, *args):
+        start_time = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings[step] = time.time() - start_time
+
+    def flash(self, gaia_dir=None, gecko_dir=None):
+        """
+        Shallow flash the device of serial.
+        @param gaia_dir: the extracted Gaia package, or None to extract it. (optional)
+        @param gecko_dir: the extracted Gecko package, or None to extract it. (optional)
+        """
+        self.timings = {}
+        self._timed('prepare', self.prepare_step)
+        if self.serial:
+            logger.info('Target device [{0}]'.format(self.serial))
+        if self.gecko:
+            self._timed('gecko', self.shallow_flash_gecko, gecko_dir)
+        if self.gaia:
+            self._timed('gaia', self.shallow_flash_gaia, gaia_dir)
+        self._timed('final', self.final_step)
+
+    def _flash_device(self, serial, gaia_dir, gecko_dir):
+        """
+        @return: the result dict of device, {'serial', 'error', 'timings', 'total'}.
+        """
+        helper = copy.copy(self)
+        helper.set_serial(serial)
+        start_time = time.time()
+        error = None
+        try:
+            helper.flash(gaia_dir=gaia_dir, gecko_dir=gecko_dir)
+        except Exception as e:
+            logger.error('Device [{}] failed: {}'.format(serial, e))
+            error = str(e) or e.__class__.__name__
+        return {'serial': serial, 'error': error, 'timings': helper.timings, 'total': time.time() - start_time}
+
+    def run_fleet(self):
+        """
+        Shallow flash the devices of serials, or all online devices, concurrently.
+        The packages are extracted once, and then shared by all devices.
+        @return: the list of result dict, {'serial', 'error', 'timings', 'total'}, in the order of serials.
+        """
+        devices = AdbHelper.get_devices()
+        if self.all_devices:
+            serials = sorted(serial for serial, state in devices.items() if state == 'device')
+        else:
+            serials = self.serials
+        if len(serials) == 0:
+            raise Exception('No device.')
+        offline_results = {}
+        for serial in serials:
+            if devices.get(serial) != 'device':
+                offline_results[serial] = {'serial': serial, 'timings': {}, 'total': 0,
+                                           'error': 'Device is not online (State: {}).'.format(devices.get(serial))}
+        online_serials = [serial for serial in serials if serial not in offline_results]
+        logger.info('Shallow flash {} devices: {}'.format(len(online_serials), ', '.join(online_serials)))
+        with self._extracted_gecko() as gecko_dir, self._extracted_gaia() as gaia_dir:
+            results = gather([(self._flash_device, {'serial': serial, 'gaia_dir': gaia_dir, 'gecko_dir': gecko_dir})
+                              for serial in online_serials], max_workers=self.max_workers)
+        result_dict = dict((result['serial'], result) for result in offline_results.values() + results)
+        return [result_dict[serial] for serial in serials]
+
+    @classmethod
+    def print_fleet_results(cls, results):
+        """
+        Print the result table of devices, with the seconds of each step.
+        """
+        serial_width = max([len('Serial')] + [len(result['serial']) for result in results])
+        titles = ['Result'] + [step.capitalize() for step in cls._STEPS] + ['Total']
+        print('{0:{1}s}  '.format('Serial', serial_width) + ''.join('{0:>9s}'.format(title) for title in titles))
+        for result in results:
+            timings = [result['timings'].get(step) for step in cls._STEPS] + [result['total']]
+            print('{0:{1}s}  '.format(result['serial'], serial_width) +
+                  '{0:>9s}'.format('FAIL' if result['error'] else 'PASS') +
+                  ''.join('{0:>9s}'.format('-' if seconds is None else '{0:.1f}s'.format(seconds))
+                          for seconds in timings))
+        for result in results:
+            if result['error']:
+                print('{}: {}'.format(result['serial'], result['error']))
+
     def run(self):
         """
         Entry point.
         """
+        if self.all_devices or self.serials:
+            if not self.gaia and not self.gecko:
+                return
+            results = self.run_fleet()
+            self.print_fleet_results(results)
+            failed_serials = [result['serial'] for result in results if result['error']]
+            if failed_serials:
+                raise Exception('Shallow flash failed on {} devices: {}'.format(len(failed_serials),
+                                                                               ', '.join(failed_serials)))
+            return
         # get the device's serial number
-        devices = AdbWrapper.adb_devices()
+        devices = AdbHelper.get_devices()
         if len(devices) == 0:
             raise Exception('No device.')
         else:
@@ -341,14 +666,7 @@ class ShallowFlashHelper(object):
                 logger.debug('Setup serial to [{0}]'.format(self.serial))
 
         if self.gaia or self.gecko:
-            self.prepare_step()
-            if self.serial:
-                logger.info('Target device [{0}]'.format(self.serial))
-            if self.gecko:
-                self.shallow_flash_gecko()
-            if self.gaia:
-                self.shallow_flash_gaia()
-            self.final_step()
+            self.flash()
 
 
 def main():
@@ -0,0 +1,579 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import stat
+import time
+import errno
+import socket
+import struct
+import logging
+import subprocess
+from distutils import spawn
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdbClient(object):
+    """
+    Pure Python client of the ADB host protocol.
+
+    It talks to the ADB server socket directly (host:devices, host:transport:<serial>, shell:, sync:, ...),
+    so there is no "adb" client process for each command.
+    """
+
+    DEFAULT_HOST = '127.0.0.1'
+    DEFAULT_PORT = 5037
+
+    SYNC_DATA_MAX = 64 * 1024
+    SYNC_DEFAULT_MODE = 0644
+
+    def __init__(self, host=None, port=None, timeout=None, start_server=True):
+        """
+        @param host: the ADB server host. Default is 127.0.0.1.
+        @param port: the ADB server port. Default is ANDROID_ADB_SERVER_PORT or 5037.
+        @param timeout: the socket timeout in seconds. Default is None (blocking).
+        @param start_server: run "adb start-server" once when the ADB server is not running.
+        """
+        self.host = host or self.DEFAULT_HOST
+        if port is None:
+            port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', self.DEFAULT_PORT))
+        self.port = port
+        self.timeout = timeout
+        self.start_server = start_server
+
+    def _start_adb_server(self):
+        """
+        Start the ADB server by "adb start-server".
+        @return: True if the ADB server was started.
+        """
+        if spawn.find_executable('adb') is None:
+            return False
+        logger.debug('Starting ADB server...')
+        p = subprocess.Popen('adb start-server', shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        logger.debug('RET: {0}'.format(output))
+        return p.returncode == 0
+
+    def connect(self):
+        """
+        Connect to the ADB server.
+        @return: the connected socket.
+        @raise exception: when the ADB server is not reachable.
+        """
+        try:
+            return socket.create_connection((self.host, self.port), self.timeout)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED or not self.start_server:
+                raise
+            # only try to start the server once
+            self.start_server = False
+            if not self._start_adb_server():
+                raise
+            return socket.create_connection((self.host, self.port), self.timeout)
+
+    @staticmethod
+    def _read_exactly(sock, size):
+        data = ''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise Exception('ADB connection closed, expected {} bytes but got {}.'.format(size, len(data)))
+            data += chunk
+        return data
+
+    @staticmethod
+    def _read_all(sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(AdbClient.SYNC_DATA_MAX)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    @classmethod
+    def _read_hex_payload(cls, sock):
+        length = int(cls._read_exactly(sock, 4), 16)
+        return cls._read_exactly(sock, length)
+
+    @staticmethod
+    def _send_request(sock, payload):
+        logger.debug('ADB REQUEST: {0}'.format(payload))
+        sock.sendall('%04x%s' % (len(payload), payload))
+
+    @classmethod
+    def _read_status(cls, sock, request=''):
+        """
+        Read the OKAY/FAIL status of request.
+        @raise exception: when the status is FAIL.
+        """
+        status = cls._read_exactly(sock, 4)
+        if status == 'OKAY':
+            return True
+        if status == 'FAIL':
+            message = cls._read_hex_payload(sock)
+            raise Exception('{}'.format({'REQUEST': request, 'FAIL': message}))
+        raise Exception('{}'.format({'REQUEST': request, 'UNKNOWN STATUS': status}))
+
+    def _host_request(self, payload, has_reply=True):
+        """
+        Send the host request, and then return the reply payload.
+        """
+        sock = self.connect()
+        try:
+            self._send_request(sock, payload)
+            self._read_status(sock, payload)
+            if has_reply:
+                return self._read_hex_payload(sock)
+            # some host services (e.g. forward) send the second status after the service is done
+            remaining = self._read_all(sock)
+            if remaining.startswith('FAIL'):
+                raise Exception('{}'.format({'REQUEST': payload, 'FAIL': remaining[8:]}))
+            return remaining
+        finally:
+            sock.close()
+
+    def version(self):
+        """
+        Get the version of ADB server.
+        @return: the version number.
+        """
+        return int(self._host_request('host:version'), 16)
+
+    def devices(self):
+        """
+        Get the device list.
+        @return: devices as dict {device_serial: device_status, ...}.
+        """
+        return self.parse_devices(self._host_request('host:devices'))
+
+    @staticmethod
+    def parse_devices(payload):
+        """
+        Parse the payload of host:devices and host:track-devices.
+        @return: devices as dict {device_serial: device_status, ...}.
+        """
+        devices = {}
+        for line in payload.splitlines():
+            items = line.strip().split('\t')
+            if len(items) >= 2:
+                devices[items[0]] = items[1]
+        return devices
+
+    def open_transport(self, serial=None):
+        """
+        Open the connection which switched to the device transport.
+        @param serial: device serial number. (optional)
+        @return: the connected socket.
+        """
+        if serial is None:
+            request = 'host:transport-any'
+        else:
+            request = 'host:transport:{}'.format(serial)
+        sock = self.connect()
+        try:
+            self._send_request(sock, request)
+            self._read_status(sock, request)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def open_service(self, service, serial=None):
+        """
+        Open the device service. e.g. "shell:", "sync:".
+        @param service: the service name with arguments.
+        @param serial: device serial number. (optional)
+        @return: the connected socket of the service stream.
+        """
+        sock = self.open_transport(serial)
+        try:
+            self._send_request(sock, service)
+            self._read_status(sock, service)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _service_output(self, service, serial=None):
+        sock = self.open_service(service, serial)
+        try:
+            return self._read_all(sock)
+        finally:
+            sock.close()
+
+    def shell(self, command, serial=None):
+        """
+        Run command on device.
+        @return: the raw output of command.
+        """
+        return self._service_output('shell:{}'.format(command), serial)
+
+    def exec_out(self, command, serial=None):
+        """
+        Run command on device by "exec:" service, which output is binary-safe (no pty and no CRLF conversion).
+        @return: the raw output of command.
+        @raise exception: when the device does not support "exec:" service.
+        """
+        return self._service_output('exec:{}'.format(command), serial)
+
+    def open_exec_out(self, command, serial=None):
+        """
+        Run command on device by "exec:" service, and read the output as stream.
+        @return: the readable file object of the raw output, which should be closed by caller.
+        @raise exception: when the device does not support "exec:" service.
+        """
+        sock = self.open_service('exec:{}'.format(command), serial)
+        # the file object keeps the connection until it is closed
+        fileobj = sock.makefile('rb')
+        sock.close()
+        return fileobj
+
+    def exec_in(self, command, fileobj, serial=None, progress_callback=None, total_size=None):
+        """
+        Run command on device by "exec:" service, and send the file object into its stdin like "adb exec-in".
+        The output of command is dropped, and the command may still be running when it returns.
+        @param progress_callback: called with current_byte and total_size after each chunk. (optional)
+        @param total_size: the total size for progress_callback. (optional)
+        @return: the sent bytes.
+        @raise exception: when the device does not support "exec:" service.
+        """
+        sock = self.open_service('exec:{}'.format(command), serial)
+        try:
+            total = 0
+            while True:
+                chunk = fileobj.read(self.SYNC_DATA_MAX)
+                if not chunk:
+                    break
+                sock.sendall(chunk)
+                total += len(chunk)
+                if progress_callback:
+                    progress_callback(current_byte=total, total_size=total_size)
+            return total
+        finally:
+            sock.close()
+
+    def root(self, serial=None):
+        """
+        Restart adbd with root permission.
+        @return: the output of adbd.
+        """
+        return self._service_output('root:', serial)
+
+    def remount(self, serial=None):
+        """
+        Remount the /system partition on the device read-write.
+        @return: the output of adbd.
+        """
+        return self._service_output('remount:', serial)
+
+    def _host_prefix(self, serial=None):
+        if serial is None:
+            return 'host:'
+        return 'host-serial:{}:'.format(serial)
+
+    def forward(self, local, remote, serial=None, no_rebind=False):
+        """
+        Forward socket connection.
+        """
+        norebind = 'norebind:' if no_rebind else ''
+        self._host_request('{}forward:{}{};{}'.format(self._host_prefix(serial), norebind, local, remote),
+                           has_reply=False)
+        return True
+
+    def list_forward(self):
+        """
+        List all forward socket connections.
+        @return: the raw list of forward. e.g. "<serial> <local> <remote>" per line.
+        """
+        return self._host_request('host:list-forward')
+
+    def kill_forward(self, local, serial=None):
+        """
+        Remove the forward socket connection.
+        """
+        self._host_request('{}killforward:{}'.format(self._host_prefix(serial), local), has_reply=False)
+        return True
+
+    def kill_forward_all(self):
+        """
+        Remove all forward socket connections.
+        """
+        self._host_request('host:killforward-all', has_reply=False)
+        return True
+
+    def sync(self, serial=None):
+        """
+        Open the sync connection.
+        @return: L{AdbSyncConnection} object.
+        """
+        return AdbSyncConnection(self.open_service('sync:', serial))
+
+    def stat(self, path, serial=None):
+        """
+        Get the status of remote file.
+        @return: (mode, size, mtime). The mode is 0 if the file does not exist.
+        """
+        with self.sync(serial) as conn:
+            return conn.stat(path)
+
+    def list_dir(self, path, serial=None):
+        """
+        List the remote folder.
+        @return: list of (name, mode, size, mtime).
+        """
+        with self.sync(serial) as conn:
+            return conn.list(path)
+
+    def pull_fileobj(self, source, fileobj, serial=None, progress_callback=None):
+        """
+        Pull one file from device into the writable file object, e.g. BytesIO.
+        @param progress_callback: called with current_byte and total_size after each chunk. (optional)
+        @return: the received bytes.
+        @raise exception: when the remote file does not exist.
+        """
+        with self.sync(serial) as conn:
+            mode, size, mtime = conn.stat(source)
+            if mode == 0:
+                raise Exception('remote object \'{}\' does not exist'.format(source))
+            return conn.recv(source, fileobj, progress_callback=progress_callback, total_size=size)
+
+    def push_fileobj(self, fileobj, dest, serial=None, mode=SYNC_DEFAULT_MODE,
+                     progress_callback=None, total_size=None):
+        """
+        Push the readable file object into one file of device.
+        @param progress_callback: called with current_byte and total_size after each chunk. (optional)
+        @param total_size: the total size for progress_callback. (optional)
+        @return: the sent bytes.
+        """
+        with self.sync(serial) as conn:
+            return conn.send(fileobj, dest, mode=mode, progress_callback=progress_callback, total_size=total_size)
+
+    def pull(self, source, dest, serial=None, progress_callback=None):
+        """
+        Pull files from device. The folder will be pulled recursively.
+        @param progress_callback: called with current_byte and total_size of all files. (optional)
+        @return: the transfer message like "adb pull".
+        @raise exception: when the remote object does not exist.
+        """
+        start = time.time()
+        conn = self.sync(serial)
+        try:
+            mode, size, mtime = conn.stat(source)
+            if mode == 0:
+                raise Exception('remote object \'{}\' does not exist'.format(source))
+            if stat.S_ISDIR(mode):
+                file_list = conn.walk(source, dest)
+            else:
+                if os.path.isdir(dest):
+                    dest = os.path.join(dest, os.path.basename(source.rstrip('/')))
+                file_list = [(source, dest, size)]
+            total_size = sum(item[2] for item in file_list)
+            total_bytes = 0
+            for remote_file, local_file, file_size in file_list:
+                local_dir = os.path.dirname(local_file)
+                if local_dir and not os.path.isdir(local_dir):
+                    os.makedirs(local_dir)
+                with open(local_file, 'wb') as f:
+                    total_bytes += conn.recv(remote_file, f, total_size=total_size,
+                                             progress_callback=self._offset_callback(progress_callback,
+                                                                                     total_bytes))
+        finally:
+            conn.close()
+        return self._transfer_message('pulled', len(file_list), total_bytes, time.time() - start)
+
+    @staticmethod
+    def _offset_callback(progress_callback, offset):
+        """
+        Convert the progress of one file into the progress of all files.
+        """
+        if progress_callback is None:
+            return None
+
+        def callback(current_byte, total_size):
+            progress_callback(current_byte=offset + current_byte, total_size=total_size)
+        return callback
+
+    def push(self, source, dest, serial=None, progress_callback=None):
+        """
+        Push files into device. The folder will be pushed recursively.
+        @param progress_callback: called with current_byte and total_size of all files. (optional)
+        @return: the transfer message like "adb push".
+        @raise exception: when the local object does not exist.
+        """
+        if not os.path.exists(source):
+            raise Exception('cannot stat \'{}\': No such file or directory'.format(source))
+        start = time.time()
+        conn = self.sync(serial)
+        try:
+            if os.path.isdir(source):
+                file_list = []
+                for root, dirs, files in os.walk(source):
+                    dirs.sort()
+                    for name in sorted(files):
+                        local_file = os.path.join(root, name)
+                        rel_path = os.path.relpath(local_file, source).replace(os.sep, '/')
+                        file_list.append((local_file, dest.rstrip('/') + '/' + rel_path))
+            else:
+                if dest.endswith('/') or stat.S_ISDIR(conn.stat(dest)[0]):
+                    dest = dest.rstrip('/') + '/' + os.path.basename(source)
+                file_list = [(source, dest)]
+            total_size = sum(os.path.getsize(item[0]) for item in file_list)
+            total_bytes = 0
+            for local_file, remote_file in file_list:
+                file_mode = os.stat(local_file).st_mode & 0777
+                with open(local_file, 'rb') as f:
+                    total_bytes += conn.send(f, remote_file, mode=file_mode, total_size=total_size,
+                                             progress_callback=self._offset_callback(progress_callback,
+                                                                                     total_bytes))
+        finally:
+            conn.close()
+        return self._transfer_message('pushed', len(file_list), total_bytes, time.time() - start)
+
+    @staticmethod
+    def _transfer_message(action, file_count, total_bytes, elapsed):
+        kbps = int(total_bytes / 1024.0 / elapsed) if elapsed > 0 else 0
+        message = '{} KB/s ({} bytes in {:.3f}s)'.format(kbps, total_bytes, elapsed)
+        if file_count != 1:
+            message = '{} files {}. 0 files skipped.\n{}'.format(file_count, action, message)
+        return message
+
+
+class AdbSyncConnection(object):
+    """
+    The connection of ADB sync service. (STAT, LIST, RECV, SEND)
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def close(self):
+        try:
+            self.sock.sendall('QUIT' + struct.pack('<I', 0))
+        except socket.error as e:
+            logger.debug(e)
+        finally:
+            self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _send_sync_request(self, request_id, path):
+        self.sock.sendall(request_id + struct.pack('<I', len(path)) + path)
+
+    def _read_sync_header(self):
+        header = AdbClient._read_exactly(self.sock, 8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    def stat(self, path):
+        """
+        Get the status of remote file.
+        @return: (mode, size, mtime). The mode is 0 if the file does not exist.
+        """
+        self._send_sync_request('STAT', path)
+        data = AdbClient._read_exactly(self.sock, 16)
+        if data[:4] != 'STAT':
+            raise Exception('Unexpected sync response {} of STAT {}'.format(data[:4], path))
+        return struct.unpack('<III', data[4:])
+
+    def list(self, path):
+        """
+        List the remote folder.
+        @return: list of (name, mode, size, mtime), without "." and "..".
+        """
+        self._send_sync_request('LIST', path)
+        entries = []
+        while True:
+            data = AdbClient._read_exactly(self.sock, 20)
+            response_id = data[:4]
+            mode, size, mtime, name_length = struct.unpack('<IIII', data[4:])
+            if response_id == 'DONE':
+                break
+            if response_id != 'DENT':
+                raise Exception('Unexpected sync response {} of LIST {}'.format(response_id, path))
+            name = AdbClient._read_exactly(self.sock, name_length)
+            if name not in ('.', '..'):
+                entries.append((name, mode, size, mtime))
+        return entries
+
+    def walk(self, remote_dir, local_dir):
+        """
+        Walk the remote folder recursively.
+        @return: list of (remote_file, local_file, size) of files.
+        """
+        file_list = []
+        for name, mode, size, mtime in sorted(self.list(remote_dir)):
+            remote_path = remote_dir.rstrip('/') + '/' + name
+            local_path = os.path.join(local_dir, name)
+            if stat.S_ISDIR(mode):
+                file_list.extend(self.walk(remote_path, local_path))
+            elif stat.S_ISREG(mode) or stat.S_ISLNK(mode):
+                file_list.append((remote_path, local_path, size))
+        if not file_list and not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        return file_list
+
+    def recv(self, path, fileobj, progress_callback=None, total_size=None):
+        """
+        Receive the remote file into file object chunk by chunk.
+        @param path: the remote file path.
+        @param fileobj: the writable file object.
+        @param progress_callback: called with current_byte and total_size after each chunk. (optional)
+        @param total_size: the total size for progress_callback. (optional)
+        @return: the received bytes.
+        @raise exception: when failed.
+        """
+        self._send_sync_request('RECV', path)
+        total = 0
+        while True:
+            response_id, length = self._read_sync_header()
+            if response_id == 'DATA':
+                fileobj.write(AdbClient._read_exactly(self.sock, length))
+                total += length
+                if progress_callback:
+                    progress_callback(current_byte=total, total_size=total_size)
+            elif response_id == 'DONE':
+                return total
+            elif response_id == 'FAIL':
+                raise Exception('failed to pull \'{}\': {}'.format(path, AdbClient._read_exactly(self.sock, length)))
+            else:
+                raise Exception('Unexpected sync response {} of RECV {}'.format(response_id, path))
+
+    def send(self, fileobj, path, mode=AdbClient.SYNC_DEFAULT_MODE, mtime=None, progress_callback=None,
+             total_size=None):
+        """
+        Send the file object into remote file chunk by chunk.
+        @param fileobj: the readable file object.
+        @param path: the remote file path.
+        @param mode: the permission bits of remote file.
+        @param mtime: the modified time of remote file. Default is now.
+        @param progress_callback: called with current_byte and total_size after each chunk. (optional)
+        @param total_size: the total size for progress_callback. (optional)
+        @return: the sent bytes.
+        @raise exception: when failed.
+        """
+        self._send_sync_request('SEND', '{},{}'.format(path, stat.S_IFREG | mode))
+        total = 0
+        while True:
+            chunk = fileobj.read(AdbClient.SYNC_DATA_MAX)
+            if not chunk:
+                break
+            self.sock.sendall('DATA' + struct.pack('<I', len(chunk)) + chunk)
+            total += len(chunk)
+            if progress_callback:
+                progress_callback(current_byte=total, total_size=total_size)
+        if mtime is None:
+            mtime = int(time.time())
+        self.sock.sendall('DONE' + struct.pack('<I', mtime))
+        response_id, length = self._read_sync_header()
+        if response_id == 'FAIL':
+            raise Exception('failed to copy to \'{}\': {}'.format(path, AdbClient._read_exactly(self.sock, length)))
+        if response_id != 'OKAY':
+            raise Exception('Unexpected sync response {} of SEND {}'.format(response_id, path))
+        return total
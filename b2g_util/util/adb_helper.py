@@ -4,17 +4,113 @@
 
 import os
 import re
+import time
+import errno
+import uuid
+import shutil
 import logging
+import tarfile
+import tempfile
 import threading
+import contextlib
 import subprocess
 from distutils import spawn
+from adb_client import AdbClient
+from adb_shell_session import AdbShellSessionPool
+from parallel import WorkerPool
+from device_registry import DeviceRegistry
+from device_registry import DevicePoller
 
 
 logger = logging.getLogger(__name__)
 
 
+class _TailReader(object):
+    """
+    The file object wrapper which keeps the last bytes read from the stream.
+    """
+
+    TAIL_SIZE = 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.tail = ''
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.tail = (self.tail + data)[-self.TAIL_SIZE:]
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
 class AdbWrapper(object):
 
+    BACKEND_SUBPROCESS = 'subprocess'
+    BACKEND_SOCKET = 'socket'
+    # select the backend by B2G_UTIL_ADB_BACKEND environment variable, or set_backend()
+    backend = os.environ.get('B2G_UTIL_ADB_BACKEND', BACKEND_SUBPROCESS)
+    client = None
+    # enable the persistent shell session by B2G_UTIL_ADB_SHELL_SESSION environment variable, or set_shell_session()
+    shell_pool = None
+    if os.environ.get('B2G_UTIL_ADB_SHELL_SESSION', '0').lower() in ('1', 'true', 'yes'):
+        shell_pool = AdbShellSessionPool()
+    # the tar command of each device for adb_push_archive, or None when the device has no tar
+    device_tar_commands = {}
+    # whether each device accepts the stdin of "exec:" service, for streaming the tar into the tar of device
+    device_exec_in = {}
+    REMOTE_ARCHIVE_DIR = '/data/local/tmp'
+    # the mark of the return code of device tar, which is appended after the archive by adb_pull_archive
+    _TAR_EXIT_MARK = '__B2G_TAR_EXIT_'
+    # the max length of member names in one tar command of adb_pull_archive
+    MAX_ARCHIVE_COMMAND_MEMBERS = 2048
+    REMOTE_ARCHIVE_FALLBACK_DIR = '/data'
+    EXEC_IN_TIMEOUT = 120
+
+    @classmethod
+    def set_backend(cls, backend, host=None, port=None):
+        """
+        Setup the backend of AdbWrapper.
+        @param backend: "subprocess" runs "adb" command, "socket" talks to the ADB server directly.
+        @param host: the ADB server host of socket backend. (optional)
+        @param port: the ADB server port of socket backend. (optional)
+        """
+        if backend not in (cls.BACKEND_SUBPROCESS, cls.BACKEND_SOCKET):
+            raise Exception('Unknown ADB backend [{}].'.format(backend))
+        cls.backend = backend
+        cls.client = None
+        if backend == cls.BACKEND_SOCKET:
+            cls.client = AdbClient(host=host, port=port)
+        logger.debug('Set ADB backend: {}'.format(backend))
+
+    @classmethod
+    def set_shell_session(cls, flag, idle_timeout=60):
+        """
+        Setup the persistent shell session of adb_shell.
+        When it is enabled, adb_shell runs commands in one long-lived shell per device.
+        @param flag: True or False.
+        @param idle_timeout: close the shell session which is idle for idle_timeout seconds.
+        """
+        if cls.shell_pool is not None:
+            cls.shell_pool.close_all()
+            cls.shell_pool = None
+        if flag:
+            cls.shell_pool = AdbShellSessionPool(idle_timeout=idle_timeout)
+        logger.debug('Set shell session: {}'.format(flag))
+
+    @classmethod
+    def get_client(cls):
+        """
+        Get the AdbClient of socket backend.
+        @return: L{AdbClient} object, or None if the backend is not socket.
+        """
+        if cls.backend != cls.BACKEND_SOCKET:
+            return None
+        if cls.client is None:
+            cls.client = AdbClient()
+        return cls.client
+
     @classmethod
     def check_adb(cls):
         """
@@ -23,6 +119,13 @@ class AdbWrapper(object):
         @raise exception: There is no ADB command in your system.
         """
         logger.debug('Checking ADB...')
+        client = cls.get_client()
+        if client is not None:
+            try:
+                logger.debug('ADB server version: {}'.format(client.version()))
+                return True
+            except Exception as e:
+                logger.debug(e)
         if spawn.find_executable('adb') is None:
             raise Exception('There is no "adb" in your environment PATH.')
         logger.debug('You have ADB.')
@@ -35,6 +138,11 @@ class AdbWrapper(object):
         @return: devices as dict {device_serial: device_status, ...}.
         @raise exception: When return code isn't zero.
         """
+        client = cls.get_client()
+        if client is not None:
+            devices = client.devices()
+            logger.debug('RET: {0}'.format(devices))
+            return devices
         cmd = 'adb devices'
         p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         output, stderr = p.communicate()
@@ -57,12 +165,19 @@ class AdbWrapper(object):
         return devices
 
     @classmethod
-    def adb_pull(cls, source, dest, serial=None):
+    def adb_pull(cls, source, dest, serial=None, progress_callback=None):
         """
         Pull files from device.
+        @param progress_callback: called with current_byte and total_size while pulling by socket backend. (optional)
         @return: stdout of command.
         @raise exception: When return code isn't zero.
         """
+        client = cls.get_client()
+        if client is not None:
+            output = client.pull(source, dest, serial=serial, progress_callback=progress_callback)
+            logger.debug('PULL: {0} {1}'.format(source, dest))
+            logger.debug('RET: {0}'.format(output))
+            return output
         if serial is None:
             cmd = 'adb pull'
         else:
@@ -79,12 +194,19 @@ class AdbWrapper(object):
         return output
 
     @classmethod
-    def adb_push(cls, source, dest, serial=None):
+    def adb_push(cls, source, dest, serial=None, progress_callback=None):
         """
         Push files into device.
+        @param progress_callback: called with current_byte and total_size while pushing by socket backend. (optional)
         @return: stdout of command.
         @raise exception: when return code isn't zero.
         """
+        client = cls.get_client()
+        if client is not None:
+            output = client.push(source, dest, serial=serial, progress_callback=progress_callback)
+            logger.debug('PUSH: {0} {1}'.format(source, dest))
+            logger.debug('RET: {0}'.format(output))
+            return output
         if serial is None:
             cmd = 'adb push'
         else:
@@ -100,6 +222,608 @@ class AdbWrapper(object):
             raise Exception('{}'.format({'STDOUT': output, 'STDERR': stderr}))
         return output
 
+    @classmethod
+    def adb_pull_fileobj(cls, source, fileobj, serial=None, progress_callback=None):
+        """
+        Pull one file from device into the writable file object, e.g. BytesIO.
+        The socket backend streams the file directly, and the subprocess backend pulls it via a temp file.
+
+            >>> f = BytesIO()
+            >>> AdbWrapper.adb_pull_fileobj('/system/b2g/application.ini', f)
+
+        @param source: the remote file path.
+        @param fileobj: the writable file object.
+        @param serial: device serial number. (optional)
+        @param progress_callback: called with current_byte and total_size after each chunk. (optional)
+        @return: the pulled bytes.
+        @raise exception: When the remote file does not exist.
+        """
+        client = cls.get_client()
+        if client is not None:
+            total_bytes = client.pull_fileobj(source, fileobj, serial=serial, progress_callback=progress_callback)
+            logger.debug('PULL: {0} ({1} bytes)'.format(source, total_bytes))
+            return total_bytes
+        tmp_dir = tempfile.mkdtemp(prefix='adbpull_')
+        try:
+            tmp_file = os.path.join(tmp_dir, os.path.basename(source.rstrip('/')) or 'file')
+            cls.adb_pull(source, tmp_file, serial=serial)
+            total_size = os.path.getsize(tmp_file)
+            with open(tmp_file, 'rb') as f:
+                return cls._copy_fileobj(f, fileobj, progress_callback, total_size)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @classmethod
+    def adb_push_fileobj(cls, fileobj, dest, serial=None, mode=0644, progress_callback=None, total_size=None):
+        """
+        Push the readable file object into one file of device.
+        The socket backend streams the file directly, and the subprocess backend pushes it via a temp file.
+        @param fileobj: the readable file object.
+        @param dest: the remote file path.
+        @param serial: device serial number. (optional)
+        @param mode: the permission bits of remote file.
+        @param progress_callback: called with current_byte and total_size after each chunk. (optional)
+        @param total_size: the total size for progress_callback. (optional)
+        @return: the pushed bytes.
+        @raise exception: When failed.
+        """
+        client = cls.get_client()
+        if client is not None:
+            total_bytes = client.push_fileobj(fileobj, dest, serial=serial, mode=mode,
+                                              progress_callback=progress_callback, total_size=total_size)
+            logger.debug('PUSH: {0} ({1} bytes)'.format(dest, total_bytes))
+            return total_bytes
+        tmp_dir = tempfile.mkdtemp(prefix='adbpush_')
+        try:
+            tmp_file = os.path.join(tmp_dir, os.path.basename(dest.rstrip('/')) or 'file')
+            with open(tmp_file, 'wb') as f:
+                total_bytes = cls._copy_fileobj(fileobj, f, progress_callback, total_size)
+            os.chmod(tmp_file, mode)
+            cls.adb_push(tmp_file, dest, serial=serial)
+            return total_bytes
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @staticmethod
+    def _copy_fileobj(source, dest, progress_callback=None, total_size=None):
+        total_bytes = 0
+        while True:
+            chunk = source.read(AdbClient.SYNC_DATA_MAX)
+            if not chunk:
+                break
+            dest.write(chunk)
+            total_bytes += len(chunk)
+            if progress_callback:
+                progress_callback(current_byte=total_bytes, total_size=total_size)
+        return total_bytes
+
+    @classmethod
+    def get_device_tar(cls, serial=None):
+        """
+        Find the tar command on device, which is tar, toybox tar, or busybox tar.
+        @return: the tar command, or None when the device has no tar.
+        """
+        if serial not in cls.device_tar_commands:
+            candidates = ['tar', 'toybox tar', 'busybox tar']
+            results = cls.adb_shell_batch(['{} -cf - /system/build.prop >/dev/null 2>&1'.format(candidate)
+                                           for candidate in candidates], serial=serial)
+            tar_command = None
+            for candidate, (_, retcode) in zip(candidates, results):
+                if retcode == 0:
+                    tar_command = candidate
+                    break
+            logger.debug('The tar of device {}: {}'.format(serial, tar_command))
+            cls.device_tar_commands[serial] = tar_command
+        return cls.device_tar_commands[serial]
+
+    @classmethod
+    def has_exec_in(cls, serial=None):
+        """
+        Check the device accepts the stdin of "exec:" service like "adb exec-in", which is Android 5.0 and later.
+        @return: True if the stdin can be streamed into the command of device.
+        """
+        if serial not in cls.device_exec_in:
+            client = cls.get_client()
+            try:
+                if client is not None:
+                    client.open_service('exec:true', serial).close()
+                    supported = True
+                else:
+                    if serial is None:
+                        cmd = 'adb exec-in true'
+                    else:
+                        cmd = 'adb -s %s exec-in true' % (serial,)
+                    p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+                    p.communicate()
+                    supported = p.returncode == 0
+            except Exception as e:
+                logger.debug(e)
+                supported = False
+            logger.debug('The device {} accepts exec-in: {}'.format(serial, supported))
+            cls.device_exec_in[serial] = supported
+        return cls.device_exec_in[serial]
+
+    @classmethod
+    def adb_exec_in(cls, fileobj, command, serial=None, progress_callback=None):
+        """
+        Run command on device, and stream the readable file object into its stdin like "adb exec-in".
+        The output of command is dropped, and the command may still be running when it returns.
+        @param fileobj: the readable file object.
+        @param command: the command.
+        @param serial: device serial number. (optional)
+        @param progress_callback: called with current_byte and total_size=None after each chunk. (optional)
+        @return: the sent bytes.
+        @raise exception: When return code (from adb command) isn't zero, or the device does not support it.
+        """
+        client = cls.get_client()
+        if client is not None:
+            logger.debug('EXEC-IN: {0}'.format(command))
+            return client.exec_in(command, fileobj, serial=serial, progress_callback=progress_callback)
+        if serial is None:
+            cmd = 'adb exec-in'
+        else:
+            cmd = 'adb -s %s exec-in' % (serial,)
+        cmd = "%s '%s'" % (cmd, command)
+        logger.debug('CMD: {0}'.format(cmd))
+        p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            total_bytes = cls._copy_fileobj(fileobj, p.stdin, progress_callback)
+        finally:
+            try:
+                p.stdin.close()
+            except IOError as e:
+                logger.debug(e)
+            output = p.stdout.read()
+            stderr = p.stderr.read()
+            p.wait()
+        if stderr:
+            logger.debug('ERR: {0}'.format(stderr))
+        if p.returncode is not 0:
+            raise Exception('{}'.format({'STDOUT': output, 'STDERR': stderr}))
+        return total_bytes
+
+    @classmethod
+    def adb_free_space(cls, path, serial=None):
+        """
+        Get the free space of the file system of remote path.
+        @return: the free bytes, or None when it can not be read.
+        """
+        output, retcode = cls.adb_shell('df {}'.format(path), serial=serial)
+        # old toolbox: "/data: 5767168K total, 1258291K used, 4508877K available (block size 4096)"
+        match = re.search(r'(\d+)K available', output)
+        if match:
+            return int(match.group(1)) * 1024
+        lines = [line for line in output.splitlines() if line.strip()]
+        if retcode != 0 or len(lines) < 2:
+            logger.debug('Can not get the free space of {}: {}'.format(path, output))
+            return None
+        header = lines[0].split()
+        # busybox wraps the line after the long file system name
+        values = ' '.join(lines[1:]).split()
+        try:
+            if 'Free' in header:
+                # toolbox: "/data 5.5G 1.2G 4.3G 4096"
+                match = re.match(r'^([\d.]+)([KMGT]?)$', values[header.index('Free')])
+                return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2) or ' '))
+            if 'Available' in header:
+                # busybox and toybox: "/dev/block/mmcblk0p10 5767168 1258291 4508877 22% /data"
+                return int(values[header.index('Available')]) * 1024
+        except (AttributeError, IndexError, ValueError) as e:
+            logger.debug(e)
+        logger.debug('Can not get the free space of {}: {}'.format(path, output))
+        return None
+
+    @staticmethod
+    def _root_owner(tarinfo):
+        # the owner can always write, so the pushed files can be cleaned and updated on device
+        tarinfo.mode |= 0200
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = 'root'
+        return tarinfo
+
+    @staticmethod
+    def _archive_size(source):
+        """
+        The estimated size of the tar of local folder.
+        """
+        size = tarfile.RECORDSIZE
+        for root, dirs, files in os.walk(source):
+            # one header for each entry, and the extra headers of long names
+            size += tarfile.BLOCKSIZE * 3 * (len(dirs) + len(files))
+            for name in files:
+                file_size = os.path.getsize(os.path.join(root, name))
+                size += (file_size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        return size
+
+    @classmethod
+    def adb_push_archive(cls, source, dest, serial=None, progress_callback=None):
+        """
+        Push the folder into device as one tar stream, and unpack it by the tar of device.
+        The tar is streamed into the tar of device when the device accepts exec-in,
+        or it is staged on device when there is enough space.
+        The permission bits of files are kept with the write bit of owner, and the owner is root.
+        It falls back to adb_push when the device has no tar, or no space to stage the tar.
+        @param source: the local folder.
+        @param dest: the remote folder.
+        @param serial: device serial number. (optional)
+        @param progress_callback: called with current_byte and total_size=None after each chunk. (optional)
+        @return: True if the folder is pushed as archive, False if it falls back to adb_push.
+        @raise exception: When failed.
+        """
+        tar_command = cls.get_device_tar(serial=serial)
+        if tar_command is None:
+            logger.info('No tar on device, push {} file by file.'.format(source))
+        else:
+            def _write_folder(tar):
+                tar.add(source, arcname='.', filter=cls._root_owner)
+            if cls.has_exec_in(serial=serial):
+                total_bytes = cls._push_tar(_write_folder, tar_command, dest, serial=serial,
+                                            progress_callback=progress_callback)
+            else:
+                total_bytes = cls._push_staged_tar(_write_folder, tar_command, dest, cls._archive_size(source),
+                                                   serial=serial, progress_callback=progress_callback)
+            if total_bytes is not None:
+                logger.debug('PUSH ARCHIVE: {0} {1} ({2} bytes)'.format(source, dest, total_bytes))
+                return True
+            logger.info('No space on device for the archive, push {} file by file.'.format(source))
+        cls.adb_push(source, dest, serial=serial, progress_callback=progress_callback)
+        return False
+
+    @classmethod
+    def adb_push_tar_stream(cls, fileobj, dest, strip_prefix='', serial=None, progress_callback=None):
+        """
+        Push the members of one tar stream into device, when they arrive from the stream.
+        e.g. the Gecko package which is being downloaded.
+        The members are streamed into the tar of device, which unpacks them as they arrive,
+        so they are written to neither the local disk nor the temp file of device.
+        @param fileobj: the file object of tar stream, which can be compressed by gzip or bzip2.
+        @param dest: the remote folder.
+        @param strip_prefix: only the members under this prefix are pushed, without the prefix. e.g. 'b2g/' (optional)
+        @param serial: device serial number. (optional)
+        @param progress_callback: called with current_byte and total_size=None after each chunk. (optional)
+        @return: the number of pushed members,
+                 or None when the device has no tar or does not accept exec-in. (the stream is not read)
+        @raise exception: When failed.
+        """
+        tar_command = cls.get_device_tar(serial=serial)
+        if tar_command is None or not cls.has_exec_in(serial=serial):
+            return None
+        members = []
+
+        def _write_members(tar):
+            with tarfile.open(fileobj=fileobj, mode='r|*') as source:
+                for tarinfo in source:
+                    if not tarinfo.name.startswith(strip_prefix) or not cls._is_safe_member(tarinfo):
+                        continue
+                    tarinfo.name = tarinfo.name[len(strip_prefix):]
+                    if not tarinfo.name:
+                        continue
+                    tar.addfile(cls._root_owner(tarinfo), source.extractfile(tarinfo) if tarinfo.isreg() else None)
+                    members.append(tarinfo.name)
+        total_bytes = cls._push_tar(_write_members, tar_command, dest, serial=serial,
+                                    progress_callback=progress_callback)
+        logger.debug('PUSH TAR STREAM: {0} members to {1} ({2} bytes)'.format(len(members), dest, total_bytes))
+        return len(members)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _tar_pipe(write_tar):
+        """
+        Write the tar into one pipe by thread, and yield the other end for reading.
+        @param write_tar: the function which adds members into the given TarFile.
+        @raise exception: the error of write_tar, which also breaks the reader.
+        """
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, 'rb')
+        writer = os.fdopen(write_fd, 'wb')
+        errors = []
+
+        def _write_archive():
+            try:
+                with tarfile.open(fileobj=writer, mode='w|') as tar:
+                    write_tar(tar)
+            except (IOError, OSError) as e:
+                # the broken pipe is caused by the failure of reader
+                if e.errno != errno.EPIPE:
+                    errors.append(e)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    writer.close()
+                except (IOError, OSError) as e:
+                    logger.debug(e)
+        thread = threading.Thread(target=_write_archive)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield reader
+        finally:
+            # unblock the writer if the reader fails
+            reader.close()
+            thread.join()
+            if errors:
+                raise errors[0]
+
+    @classmethod
+    def _remote_temp_dir(cls, dest):
+        """
+        The remote folder for the temp files of pushing, which is not inside of dest.
+        e.g. /data/local/tmp is removed when /data/local is restored.
+        """
+        if (cls.REMOTE_ARCHIVE_DIR.rstrip('/') + '/').startswith(dest.rstrip('/') + '/'):
+            return cls.REMOTE_ARCHIVE_FALLBACK_DIR
+        return cls.REMOTE_ARCHIVE_DIR
+
+    @classmethod
+    def _wait_remote_status(cls, status_file, serial=None, timeout=None):
+        """
+        Wait for the command of device to write its return code into the status file.
+        @return: the return code.
+        @raise exception: when running for more than timeout seconds.
+        """
+        timeout = cls.EXEC_IN_TIMEOUT if timeout is None else timeout
+        deadline = time.time() + timeout
+        while True:
+            output, retcode = cls.adb_shell('cat {}'.format(status_file), serial=serial)
+            if retcode == 0 and re.match(r'^\d+$', output.strip()):
+                return int(output.strip())
+            if time.time() > deadline:
+                raise Exception('Wait for the status {} timeout, timeout {}'.format(status_file, timeout))
+            time.sleep(0.1)
+
+    @classmethod
+    def _push_tar(cls, write_tar, tar_command, dest, serial=None, progress_callback=None):
+        """
+        Stream the tar into the tar of device by exec-in, which unpacks the members as they arrive.
+        The archive is never staged on device, so it does not need the space for a second copy.
+        @param write_tar: the function which adds members into the given TarFile.
+        @return: the pushed bytes.
+        @raise exception: When failed.
+        """
+        temp_dir = cls._remote_temp_dir(dest)
+        name = '{}/b2g_util_{}'.format(temp_dir, uuid.uuid4().hex)
+        log_file = name + '.log'
+        status_file = name + '.status'
+        # exec-in returns when the stream is sent, so the device writes the return code of tar into a file,
+        # and the file is renamed when it is complete
+        command = ('trap "" HUP; mkdir -p {temp_dir} {dest} && {tar} -xf - -C {dest} >{log} 2>&1; '
+                   'echo $? >{status}.tmp; mv {status}.tmp {status}').format(
+            temp_dir=temp_dir, dest=dest, tar=tar_command, log=log_file, status=status_file)
+        try:
+            with cls._tar_pipe(write_tar) as reader:
+                total_bytes = cls.adb_exec_in(reader, command, serial=serial, progress_callback=progress_callback)
+            retcode = cls._wait_remote_status(status_file, serial=serial)
+            if retcode != 0:
+                output = cls.adb_shell('cat {}'.format(log_file), serial=serial)[0]
+                raise Exception('Can not unpack the archive into {}: {}'.format(dest, output))
+        finally:
+            cls.adb_shell('rm -f {0} {1} {1}.tmp'.format(log_file, status_file), serial=serial)
+        return total_bytes
+
+    @classmethod
+    def _push_staged_tar(cls, write_tar, tar_command, dest, archive_size, serial=None, progress_callback=None):
+        """
+        Push the tar into one temp file of device, and then unpack it, for the device which does not accept exec-in.
+        The temp file is always removed, even if the push fails.
+        @param write_tar: the function which adds members into the given TarFile.
+        @param archive_size: the estimated size of the tar, which should fit into the free space of device.
+        @return: the pushed bytes, or None when there is no space on device for the temp file.
+        @raise exception: When failed.
+        """
+        temp_dir = cls._remote_temp_dir(dest)
+        free_space = cls.adb_free_space(temp_dir, serial=serial)
+        if free_space is not None and free_space < archive_size:
+            logger.debug('{} bytes free in {}, but the archive needs {} bytes.'.format(
+                free_space, temp_dir, archive_size))
+            return None
+        remote_archive = '{}/b2g_util_{}.tar'.format(temp_dir, uuid.uuid4().hex)
+        try:
+            with cls._tar_pipe(write_tar) as reader:
+                total_bytes = cls.adb_push_fileobj(reader, remote_archive, serial=serial,
+                                                   progress_callback=progress_callback)
+            results = cls.adb_shell_batch(['mkdir -p {}'.format(dest),
+                                           '{} -xf {} -C {}'.format(tar_command, remote_archive, dest)],
+                                          serial=serial)
+            output, retcode = results[1]
+            if retcode != 0:
+                raise Exception('Can not unpack {} into {}: {}'.format(remote_archive, dest, output))
+        finally:
+            cls.adb_shell('rm -f {}'.format(remote_archive), serial=serial)
+        return total_bytes
+
+    @staticmethod
+    def _is_safe_member(tarinfo):
+        """
+        Only the files, folders, and the symbolic links inside of the archive, can be unpacked.
+        """
+        for name in (tarinfo.name, tarinfo.linkname if tarinfo.issym() else ''):
+            if os.path.isabs(name) or '..' in name.split('/'):
+                return False
+        return tarinfo.isreg() or tarinfo.isdir() or tarinfo.issym()
+
+    @staticmethod
+    def _quote_remote(path):
+        """
+        Quote the path for the shell of device.
+        """
+        return '"{}"'.format(re.sub(r'(["$`\\])', r'\\\1', path))
+
+    @classmethod
+    def adb_pull_archive(cls, source, dest, serial=None, progress_callback=None, members=None):
+        """
+        Pull the folder from device as one tar stream, which is made by the tar of device and read by "exec-out",
+        and unpack it into the local folder on the fly.
+        It falls back to adb_pull when the device has no tar or does not support "exec-out".
+        @param source: the remote folder.
+        @param dest: the local folder.
+        @param serial: device serial number. (optional)
+        @param progress_callback: called with current_byte and total_size=None after each file. (optional)
+        @param members: only pull these paths relative to source, by as few tar streams as possible. (optional)
+        @return: True if the folder is pulled as archive, False if it falls back to adb_pull.
+        @raise exception: When failed, or the tar of device failed.
+        """
+        if members is not None and not members:
+            return True
+        tar_command = cls.get_device_tar(serial=serial)
+        if tar_command is None:
+            logger.info('No tar on device, pull {} file by file.'.format(source))
+            cls._pull_members(source, dest, serial=serial, progress_callback=progress_callback, members=members)
+            return False
+        if members is None:
+            batches = [['.']]
+        else:
+            # the request of device service is limited, so the long list is split into batches
+            batches = [[]]
+            length = 0
+            for member in members:
+                # the names starting with "-" are not the options of tar
+                quoted = cls._quote_remote('./' + member)
+                if batches[-1] and length + len(quoted) > cls.MAX_ARCHIVE_COMMAND_MEMBERS:
+                    batches.append([])
+                    length = 0
+                batches[-1].append(quoted)
+                length += len(quoted) + 1
+        total_bytes = 0
+        for index, batch in enumerate(batches):
+            total_bytes = cls._pull_tar_stream(tar_command, source, batch, dest, serial=serial,
+                                               progress_callback=progress_callback, total_bytes=total_bytes)
+            if total_bytes is None:
+                if index > 0:
+                    raise Exception('Can not stream tar from device for {}.'.format(source))
+                logger.info('Can not stream tar from device, pull {} file by file.'.format(source))
+                cls._pull_members(source, dest, serial=serial, progress_callback=progress_callback,
+                                  members=members)
+                return False
+        logger.debug('PULL ARCHIVE: {0} {1} ({2} bytes)'.format(source, dest, total_bytes))
+        return True
+
+    @classmethod
+    def _pull_members(cls, source, dest, serial=None, progress_callback=None, members=None):
+        if members is None:
+            cls.adb_pull(source, dest, serial=serial, progress_callback=progress_callback)
+            return
+        for member in members:
+            local_file = os.path.join(dest, *member.split('/'))
+            if not os.path.isdir(os.path.dirname(local_file)):
+                os.makedirs(os.path.dirname(local_file))
+            cls.adb_pull('{}/{}'.format(source.rstrip('/'), member), local_file, serial=serial)
+
+    @classmethod
+    def _pull_tar_stream(cls, tar_command, source, names, dest, serial=None, progress_callback=None, total_bytes=0):
+        """
+        Pull the names under source as one tar stream, and unpack it into the local folder.
+        @return: the total bytes, or None if the device does not support "exec-out".
+        @raise exception: When the tar of device failed.
+        """
+        # the stderr of device may be merged into the stream, so the warnings of tar must not corrupt the archive,
+        # and the return code of tar is appended after the end of archive
+        command = '{} -cf - -C {} {} 2>/dev/null; echo {}$?'.format(tar_command, cls._quote_remote(source),
+                                                                   ' '.join(names), cls._TAR_EXIT_MARK)
+        client = cls.get_client()
+        process = None
+        try:
+            if client is not None:
+                logger.debug('EXEC-OUT: {0}'.format(command))
+                stream = client.open_exec_out(command, serial=serial)
+            else:
+                if serial is None:
+                    cmd = 'adb exec-out'
+                else:
+                    cmd = 'adb -s %s exec-out' % (serial,)
+                cmd = "%s '%s'" % (cmd, command.replace("'", "'\\''"))
+                logger.debug('CMD: {0}'.format(cmd))
+                process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                stream = process.stdout
+            stream = _TailReader(stream)
+            tar = tarfile.open(fileobj=stream, mode='r|')
+        except Exception as e:
+            logger.debug(e)
+            if process is not None:
+                process.communicate()
+            return None
+        try:
+            for member in tar:
+                if not cls._is_safe_member(member):
+                    logger.debug('Skip {} of {}.'.format(member.name, source))
+                    continue
+                tar.extract(member, dest)
+                total_bytes += member.size
+                if progress_callback:
+                    progress_callback(current_byte=total_bytes, total_size=None)
+            # read the padding of archive and the return code of tar
+            while stream.read(AdbClient.SYNC_DATA_MAX):
+                pass
+        finally:
+            tar.close()
+            stream.close()
+            if process is not None:
+                stderr = process.stderr.read()
+                process.wait()
+                if stderr:
+                    logger.debug('ERR: {0}'.format(stderr))
+        match = re.search(re.escape(cls._TAR_EXIT_MARK) + r'(\d+)\s*$', stream.tail)
+        if match is None:
+            raise Exception('The tar stream of {} is truncated.'.format(source))
+        if match.group(1) != '0':
+            raise Exception('The tar of device returned {}, some files of {} are not pulled.'.format(
+                match.group(1), source))
+        return total_bytes
+
+    @classmethod
+    def adb_exec_out(cls, command, serial=None):
+        """
+        Run command on device, and get the binary-safe stdout like "adb exec-out".
+        @return: the raw stdout of command.
+        @raise exception: When return code (from adb command) isn't zero, or the device does not support it.
+        """
+        client = cls.get_client()
+        if client is not None:
+            logger.debug('EXEC-OUT: {0}'.format(command))
+            return client.exec_out(command, serial=serial)
+        if serial is None:
+            cmd = 'adb exec-out'
+        else:
+            cmd = 'adb -s %s exec-out' % (serial,)
+        cmd = "%s '%s'" % (cmd, command)
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, stderr = p.communicate()
+        logger.debug('CMD: {0}'.format(cmd))
+        logger.debug('RET: {0} bytes'.format(len(output)))
+        if stderr:
+            logger.debug('ERR: {0}'.format(stderr))
+        if p.returncode is not 0:
+            raise Exception('{}'.format({'STDOUT': output, 'STDERR': stderr}))
+        return output
+
+    @classmethod
+    def adb_file_size(cls, path, serial=None):
+        """
+        Get the size of remote file.
+        @return: the size in bytes.
+        @raise exception: When the remote file does not exist, or the size can not be read.
+        """
+        client = cls.get_client()
+        if client is not None:
+            mode, size, mtime = client.stat(path, serial=serial)
+            if mode == 0:
+                raise Exception('remote object \'{}\' does not exist'.format(path))
+            return size
+        # toolbox has neither stat nor wc, so "ls -l" is the last resort
+        results = cls.adb_shell_batch(['stat -c %s {}'.format(path), 'wc -c < {}'.format(path),
+                                       'ls -l {}'.format(path)], serial=serial)
+        for output, retcode in results[:2]:
+            if retcode == 0 and re.match(r'^\d+$', output.strip()):
+                return int(output.strip())
+        output, retcode = results[2]
+        # toolbox and toybox: "-rw-r--r-- root root 12345 2015-10-15 03:02 omni.ja",
+        # busybox: "-rw-r--r--    1 root     root         12345 Oct 15 03:02 omni.ja"
+        match = re.search(r'\s(\d+)\s+(?:\d{4}-\d{2}-\d{2}|[A-Z][a-z]{2}\s+\d{1,2})\s', output)
+        if retcode != 0 or not output.startswith('-') or match is None:
+            raise Exception('Can not get the size of {}: {}'.format(path, output))
+        return int(match.group(1))
+
     @classmethod
     def adb_forward(cls, command=None, local=None, remote=None, serial=None):
         """
@@ -174,6 +898,16 @@ class AdbWrapper(object):
                 return False
         else:
             cmd = "%s '%s' '%s'" % (cmd, local, remote)
+        client = cls.get_client()
+        if client is not None:
+            logger.debug('FORWARD: {0}'.format(cmd))
+            if command == 'list':
+                return generate_forwarding_dict(client.list_forward())
+            elif command == 'remove':
+                return client.kill_forward(local, serial=serial)
+            elif command == 'remove-all':
+                return client.kill_forward_all()
+            return client.forward(local, remote, serial=serial, no_rebind=(command == 'no-rebind'))
         p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         shell_ret, stderr = p.communicate()
         logger.debug('CMD: {0}'.format(cmd))
@@ -193,6 +927,15 @@ class AdbWrapper(object):
         @return: the stdout and return code (from device) of "adb shell" command. e.g. (stdout, retcode)
         @raise exception: When return code (from adb command) isn't zero.
         """
+        client = cls.get_client()
+        if cls.shell_pool is not None:
+            return cls.shell_pool.execute(command, serial=serial, client=client)
+        if client is not None:
+            # get returncode from device
+            shell_ret = client.shell('%s; echo $?' % (command,), serial=serial)
+            logger.debug('CMD: {0}'.format(command))
+            logger.debug('RAW_RET: {0}'.format(shell_ret))
+            return cls._parse_shell_output(shell_ret)
         if serial is None:
             cmd = 'adb shell'
         else:
@@ -207,6 +950,77 @@ class AdbWrapper(object):
             logger.debug('RAW_ERR: {0}'.format(stderr))
         if p.returncode is not 0:
             raise Exception('{}'.format({'STDOUT': shell_ret, 'STDERR': stderr}))
+        return cls._parse_shell_output(shell_ret)
+
+    @classmethod
+    def adb_shell_batch(cls, commands, serial=None):
+        """
+        Run commands on device in one round trip.
+        @param commands: the list of commands.
+        @return: the stdout and return code (from device) of each command. e.g. [(stdout, retcode), ...]
+        @raise exception: When return code (from adb command) isn't zero.
+        """
+        if not commands:
+            return []
+        token = uuid.uuid4().hex
+        # the sentinel is split by quotes, so the echo of input never matches it
+        script = '; '.join('( {1} ); echo "__B2G_BATCH_""{0}__ {2} $?"'.format(token, command, index)
+                           for index, command in enumerate(commands))
+        client = cls.get_client()
+        if cls.shell_pool is not None:
+            shell_ret = cls.shell_pool.execute(script, serial=serial, client=client)[0]
+            logger.debug('CMD: {0}'.format(script))
+        elif client is not None:
+            shell_ret = client.shell(script, serial=serial)
+            logger.debug('CMD: {0}'.format(script))
+        else:
+            if serial is None:
+                cmd = 'adb shell'
+            else:
+                cmd = 'adb -s %s shell' % (serial,)
+            cmd = "%s '%s'" % (cmd, script)
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            shell_ret, stderr = p.communicate()
+            logger.debug('CMD: {0}'.format(cmd))
+            if stderr:
+                logger.debug('RAW_ERR: {0}'.format(stderr))
+            if p.returncode is not 0:
+                raise Exception('{}'.format({'STDOUT': shell_ret, 'STDERR': stderr}))
+        logger.debug('RAW_RET: {0}'.format(shell_ret))
+        return cls._parse_batch_output(shell_ret, '__B2G_BATCH_{}__'.format(token), len(commands))
+
+    @staticmethod
+    def _parse_batch_output(shell_ret, mark, count):
+        """
+        Split the stdout and the return code of each command, which were printed by the sentinel with "$?".
+        @return: the stdout and return code of each command. e.g. [(stdout, retcode), ...]
+        """
+        results = [('', 0)] * count
+        position = 0
+        index = 0
+        for match in re.finditer(re.escape(mark) + r' (\d+) (\d+)', shell_ret):
+            index = int(match.group(1))
+            output = re.sub(r'\s+$', '', re.sub(r'^\r?\n', '', shell_ret[position:match.start()]))
+            if index < count:
+                results[index] = (output, int(match.group(2)))
+            position = match.end()
+            index += 1
+        if index < count:
+            # some command will stop device with no returncode. e.g. adb shell reboot recovery
+            output = re.sub(r'\s+$', '', re.sub(r'^\r?\n', '', shell_ret[position:]))
+            results[index] = (output, 0)
+            logger.debug('No return code of commands from [{}] to [{}].'.format(index, count - 1))
+        for output, returncode in results:
+            logger.debug('RET: {0}'.format(output))
+            logger.debug('RET CODE: {0}'.format(returncode))
+        return results
+
+    @staticmethod
+    def _parse_shell_output(shell_ret):
+        """
+        Split the stdout and the return code which was printed by "echo $?" in the end.
+        @return: the stdout and return code. e.g. (stdout, retcode)
+        """
         # split the stdout and retcode (from device)
         shell_ret = re.sub(r'\s+$', '', shell_ret)
         shell_output = re.split(r'\s+(\d+$)', shell_ret, maxsplit=1)
@@ -238,19 +1052,30 @@ class AdbWrapper(object):
         Get the root permission of ADB.
         @return: True if adb already running as root. False if failed.
         """
-        if serial is None:
-            cmd = 'adb root'
+        client = cls.get_client()
+        if client is not None:
+            try:
+                output = client.root(serial=serial)
+                returncode = 0
+            except Exception as e:
+                output = '{}'.format(e)
+                returncode = 1
+            logger.debug('ROOT: {0}'.format(serial))
+            logger.debug('RET: {0}'.format(output))
         else:
-            cmd = 'adb -s %s root' % (serial,)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        output, stderr = p.communicate()
-        logger.debug('CMD: {0}'.format(cmd))
-        logger.debug('RET: {0}'.format(output))
-        if stderr:
-            logger.debug('ERR: {0}'.format(stderr))
-        if p.returncode is 0 and ('cannot' not in output):
+            if serial is None:
+                cmd = 'adb root'
+            else:
+                cmd = 'adb -s %s root' % (serial,)
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output, stderr = p.communicate()
+            returncode = p.returncode
+            logger.debug('CMD: {0}'.format(cmd))
+            logger.debug('RET: {0}'.format(output))
+            if stderr:
+                logger.debug('ERR: {0}'.format(stderr))
+        if returncode is 0 and ('cannot' not in output):
             if 'restarting' in output:
-                import time
                 time.sleep(1)
             logger.debug('adb root successed')
             logger.info('{}'.format(output))
@@ -266,17 +1091,30 @@ class AdbWrapper(object):
         Remounts the /system partition on the device read-write
         @return: True if succeeded. False if failed.
         """
-        if serial is None:
-            cmd = 'adb remount'
+        client = cls.get_client()
+        if client is not None:
+            stderr = None
+            try:
+                output = client.remount(serial=serial)
+                returncode = 0
+            except Exception as e:
+                output = '{}'.format(e)
+                returncode = 1
+            logger.debug('REMOUNT: {0}'.format(serial))
+            logger.debug('RET: {0}'.format(output))
         else:
-            cmd = 'adb -s %s remount' % (serial,)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        output, stderr = p.communicate()
-        logger.debug('CMD: {0}'.format(cmd))
-        logger.debug('RET: {0}'.format(output))
-        if stderr:
-            logger.debug('ERR: {0}'.format(stderr))
-        if p.returncode is 0:
+            if serial is None:
+                cmd = 'adb remount'
+            else:
+                cmd = 'adb -s %s remount' % (serial,)
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output, stderr = p.communicate()
+            returncode = p.returncode
+            logger.debug('CMD: {0}'.format(cmd))
+            logger.debug('RET: {0}'.format(output))
+            if stderr:
+                logger.debug('ERR: {0}'.format(stderr))
+        if returncode is 0:
             if 'remount succeeded' in output:
                 logger.info('{}'.format(output))
                 return True
@@ -291,33 +1129,87 @@ class AdbWrapper(object):
     def adb_wait_for_device(cls, timeout=60, serial=None):
         """
         block until device is online. (default timeout is 60 seconds)
+        The waiters share one L{DeviceRegistry}, or one L{DevicePoller} when the ADB server can not be tracked,
+        so it is safe to wait for many devices concurrently.
         @param timeout: specify the timeout for the operation in seconds. Default is 60 seconds.
+        @param serial: device serial number. Wait for any device if it is None. (optional)
         @raise exception: when running for more than timeout seconds.
         """
-        thread = None
-        cls.p_wait_for_device = None
+        logger.info('Starting wait for device, timeout: {}, serial: {}'.format(timeout, serial))
+        registry = DeviceRegistry.get_instance(cls.get_client())
+        if registry.tracking:
+            return registry.wait_for_state(serial, timeout=timeout)
+        return DevicePoller.get_instance(cls.adb_devices).wait_for_state(serial, timeout=timeout)
 
-        def _wait_for_device():
-            logger.info('Starting adb wait-for-device, timeout: {}, serial: {}'.format(timeout, serial))
-            if serial is None:
-                cmd = 'adb wait-for-device'
-            else:
-                cmd = 'adb -s %s wait-for-device' % (serial,)
-            cls.p_wait_for_device = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            cls.p_wait_for_device.communicate()
-        thread = threading.Thread(target=_wait_for_device)
-        thread.start()
-        thread.join(timeout)
-        if thread.is_alive():
-            logger.debug('Terminating wait-for-device process.')
-            cls.p_wait_for_device.terminate()
-            cls.p_wait_for_device = None
-            raise Exception('adb wait-for-device timeout, timeout {}, serial: {}'.format(timeout, serial))
-        return True
+
+class AsyncAdbWrapper(object):
+    """
+    The non-blocking counterpart of AdbWrapper for concurrent multi-device operations.
+    Each method returns L{Future} object, which result() returns the same value of AdbWrapper.
+
+        >>> futures = [AsyncAdbWrapper.adb_shell('getprop ro.build.date', serial=s) for s in serials]
+        >>> results = [f.result() for f in futures]
+    """
+
+    max_workers = 8
+    pool = None
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def set_max_workers(cls, max_workers):
+        """
+        Setup the max number of concurrent ADB operations.
+        """
+        with cls._pool_lock:
+            if cls.pool is not None:
+                cls.pool.shutdown(wait=False)
+                cls.pool = None
+            cls.max_workers = max_workers
+        logger.debug('Set max_workers: {}'.format(max_workers))
+
+    @classmethod
+    def _submit(cls, func, *args, **kwargs):
+        with cls._pool_lock:
+            if cls.pool is None:
+                cls.pool = WorkerPool(max_workers=cls.max_workers)
+            pool = cls.pool
+        return pool.submit(func, *args, **kwargs)
+
+    @classmethod
+    def adb_devices(cls):
+        return cls._submit(AdbWrapper.adb_devices)
+
+    @classmethod
+    def adb_shell(cls, command, serial=None):
+        return cls._submit(AdbWrapper.adb_shell, command, serial=serial)
+
+    @classmethod
+    def adb_shell_batch(cls, commands, serial=None):
+        return cls._submit(AdbWrapper.adb_shell_batch, commands, serial=serial)
+
+    @classmethod
+    def adb_pull(cls, source, dest, serial=None):
+        return cls._submit(AdbWrapper.adb_pull, source, dest, serial=serial)
+
+    @classmethod
+    def adb_push(cls, source, dest, serial=None):
+        return cls._submit(AdbWrapper.adb_push, source, dest, serial=serial)
 
 
 class AdbHelper(object):
 
+    @classmethod
+    def get_devices(cls):
+        """
+        Get the device list from L{DeviceRegistry}, which tracks devices by ADB server without spawning process.
+        It runs "adb devices" only when the ADB server can not be tracked.
+        @return: devices as dict {device_serial: device_status, ...}.
+        """
+        devices = DeviceRegistry.get_instance(AdbWrapper.get_client()).devices()
+        if devices is None:
+            devices = AdbWrapper.adb_devices()
+        return devices
+
     @classmethod
     def get_serial(cls, serial_number):
         """
@@ -347,7 +1239,7 @@ class AdbHelper(object):
             logger.debug('serial={}'.format(serial_number))
         # raise Exception if the serial is not in devices list
         if final_serial_number is not None:
-            devices = AdbWrapper.adb_devices()
+            devices = cls.get_devices()
             logger.debug('Devices: {}'.format(devices))
             if final_serial_number not in devices:
                 raise Exception('Can not found {} device in devices list {}.'.format(final_serial_number, devices))
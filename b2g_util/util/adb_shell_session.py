@@ -0,0 +1,313 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import re
+import time
+import uuid
+import atexit
+import contextlib
+import select
+import socket
+import logging
+import threading
+import subprocess
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdbShellSession(object):
+    """
+    The long-lived "adb shell" of one device.
+
+    Commands are written into the shell's stdin, and each result is framed by the unique sentinels,
+    so the process and USB handshake are set up only once for many commands.
+    """
+
+    READ_SIZE = 4096
+    # the tty of interactive shell truncates the input line longer than 4096 bytes (with the newline),
+    # then the sentinel never comes back. The longer script runs by non-interactive shell instead.
+    MAX_LINE_SIZE = 4096
+
+    def __init__(self, serial=None, client=None):
+        """
+        @param serial: device serial number. (optional)
+        @param client: the L{AdbClient} of socket backend. Runs "adb shell" process when it is None.
+        """
+        self.serial = serial
+        self.client = client
+        self.sock = None
+        self.process = None
+        self.buffer = ''
+        self.last_used = time.time()
+        # the number of callers holding the session from L{AdbShellSessionPool}, guarded by the pool lock
+        self.checkouts = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Open the shell stream of device.
+        """
+        self.close()
+        if self.client is not None:
+            self.sock = self.client.open_service('shell:', self.serial)
+        else:
+            cmd = ['adb', 'shell'] if self.serial is None else ['adb', '-s', self.serial, 'shell']
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+        self.buffer = ''
+        self.last_used = time.time()
+        logger.debug('Open shell session, serial: {}'.format(self.serial))
+
+    def close(self):
+        """
+        Close the shell stream.
+        """
+        if not self.is_open():
+            return
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error as e:
+                logger.debug(e)
+            self.sock = None
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                if self.process.poll() is None:
+                    self.process.terminate()
+                self.process.wait()
+            except (IOError, OSError) as e:
+                logger.debug(e)
+            self.process = None
+        logger.debug('Close shell session, serial: {}'.format(self.serial))
+
+    def is_open(self):
+        return self.sock is not None or self.process is not None
+
+    def _fileno(self):
+        if self.sock is not None:
+            return self.sock.fileno()
+        return self.process.stdout.fileno()
+
+    def _read_some(self, timeout=None):
+        """
+        @return: the received data, or '' when the stream is closed.
+        @raise exception: when there is no data until timeout.
+        """
+        readable = select.select([self._fileno()], [], [], timeout)[0]
+        if not readable:
+            raise Exception('Shell session timeout, timeout {}, serial: {}'.format(timeout, self.serial))
+        if self.sock is not None:
+            return self.sock.recv(self.READ_SIZE)
+        return os.read(self._fileno(), self.READ_SIZE)
+
+    def _write(self, data):
+        if self.sock is not None:
+            self.sock.sendall(data)
+        else:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+
+    def _execute_oneshot(self, script):
+        """
+        Run the script by non-interactive shell, e.g. "adb shell <script>", which input is not limited by tty.
+        @return: the raw output.
+        @raise exception: when return code (from adb command) isn't zero.
+        """
+        if self.client is not None:
+            return self.client.shell(script, self.serial)
+        cmd = ['adb', 'shell'] if self.serial is None else ['adb', '-s', self.serial, 'shell']
+        p = subprocess.Popen(cmd + [script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise Exception('{}'.format({'STDOUT': output, 'RETURN CODE': p.returncode}))
+        return output
+
+    def is_alive(self):
+        """
+        Check the stream is still alive, e.g. it will be closed after device reboot.
+        The pending data (e.g. the shell prompt) will be dropped.
+        """
+        if not self.is_open():
+            return False
+        if self.process is not None and self.process.poll() is not None:
+            return False
+        try:
+            while select.select([self._fileno()], [], [], 0)[0]:
+                if not self._read_some(0):
+                    return False
+        except (socket.error, OSError, IOError) as e:
+            logger.debug(e)
+            return False
+        self.buffer = ''
+        return True
+
+    def execute(self, command, timeout=None):
+        """
+        Run command in the shell session.
+        It reconnects automatically when the stream was closed, e.g. device reboot.
+        The command longer than the tty input line runs by non-interactive shell instead.
+
+        @param command: the command.
+        @param timeout: the timeout in seconds for waiting the output. Default is None (blocking).
+        @return: the stdout and return code (from device). e.g. (stdout, retcode)
+        """
+        with self.lock:
+            token = uuid.uuid4().hex
+            # the sentinels are split by quotes, so the echo of input never matches them
+            start_mark = '__B2G_START_{}__'.format(token)
+            end_mark = '__B2G_END_{}__'.format(token)
+            script = 'echo "__B2G_START_""{0}__"; ( {1} ) < /dev/null; echo "__B2G_END_""{0}__ $?"\n'.format(
+                token, command)
+            end_pattern = re.compile(re.escape(end_mark) + r' (\d+)')
+            if len(script) > self.MAX_LINE_SIZE:
+                logger.debug('SESSION CMD (non-interactive): {0}'.format(command))
+                data = self._execute_oneshot(script.rstrip('\n'))
+                match = end_pattern.search(data)
+                output = self._strip_output(data[:match.start()] if match else data, start_mark)
+                returncode = int(match.group(1)) if match else 0
+                self.last_used = time.time()
+                logger.debug('SESSION RET: {0}'.format(output))
+                logger.debug('SESSION RET CODE: {0}'.format(returncode))
+                return output, returncode
+            if not self.is_alive():
+                self.open()
+            try:
+                self._write(script)
+            except (socket.error, OSError, IOError) as e:
+                # the stream was closed before the command was sent, reconnect and try again
+                logger.debug(e)
+                self.open()
+                self._write(script)
+            logger.debug('SESSION CMD: {0}'.format(command))
+            while True:
+                match = end_pattern.search(self.buffer)
+                if match:
+                    break
+                try:
+                    data = self._read_some(timeout)
+                except (socket.error, OSError, IOError) as e:
+                    logger.debug(e)
+                    data = ''
+                if not data:
+                    # some command will stop device with no returncode. e.g. reboot
+                    output = self._strip_output(self.buffer, start_mark)
+                    self.close()
+                    self.last_used = time.time()
+                    return output, 0
+                self.buffer += data
+            output = self._strip_output(self.buffer[:match.start()], start_mark)
+            returncode = int(match.group(1))
+            self.buffer = self.buffer[match.end():]
+            self.last_used = time.time()
+            logger.debug('SESSION RET: {0}'.format(output))
+            logger.debug('SESSION RET CODE: {0}'.format(returncode))
+            return output, returncode
+
+    @staticmethod
+    def _strip_output(data, start_mark):
+        index = data.find(start_mark)
+        if index < 0:
+            return ''
+        output = data[index + len(start_mark):]
+        output = re.sub(r'^\r?\n', '', output)
+        return re.sub(r'\s+$', '', output)
+
+
+class AdbShellSessionPool(object):
+    """
+    The pool of L{AdbShellSession} keyed by device serial number.
+    The idle sessions will be closed after idle timeout.
+    """
+
+    def __init__(self, idle_timeout=60):
+        """
+        @param idle_timeout: close the session which is not used for idle_timeout seconds.
+        """
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+        atexit.register(self.close_all)
+
+    def _session(self, serial, client):
+        session = self.sessions.get(serial)
+        if session is None or session.client is not client:
+            if session is not None:
+                session.close()
+            session = AdbShellSession(serial=serial, client=client)
+            self.sessions[serial] = session
+        # the session handed out is not idle, so it is not evicted before it is used
+        session.last_used = time.time()
+        return session
+
+    def get(self, serial=None, client=None):
+        """
+        Get the session of device. The idle sessions will be evicted.
+        Use L{checkout} to keep the session from eviction while holding it.
+        @param serial: device serial number. (optional)
+        @param client: the L{AdbClient} of socket backend. (optional)
+        @return: L{AdbShellSession} object.
+        """
+        self.evict_idle()
+        with self.lock:
+            return self._session(serial, client)
+
+    @contextlib.contextmanager
+    def checkout(self, serial=None, client=None):
+        """
+        Hold the session of device, which is not evicted until it is returned to the pool.
+        @param serial: device serial number. (optional)
+        @param client: the L{AdbClient} of socket backend. (optional)
+        @return: the context manager of L{AdbShellSession} object.
+        """
+        self.evict_idle()
+        with self.lock:
+            session = self._session(serial, client)
+            session.checkouts += 1
+        try:
+            yield session
+        finally:
+            with self.lock:
+                session.checkouts -= 1
+
+    def execute(self, command, serial=None, client=None, timeout=None):
+        """
+        Run command in the session of device.
+        @return: the stdout and return code (from device). e.g. (stdout, retcode)
+        """
+        with self.checkout(serial, client) as session:
+            return session.execute(command, timeout=timeout)
+
+    def evict_idle(self):
+        """
+        Close and remove the sessions which are idle for more than idle timeout, except the checked out ones.
+        """
+        now = time.time()
+        with self.lock:
+            for serial, session in self.sessions.items():
+                if now - session.last_used > self.idle_timeout and not session.checkouts:
+                    logger.debug('Evict idle shell session, serial: {}'.format(serial))
+                    session.close()
+                    del self.sessions[serial]
+
+    def close(self, serial=None):
+        """
+        Close the session of device.
+        """
+        with self.lock:
+            session = self.sessions.pop(serial, None)
+        if session is not None:
+            session.close()
+
+    def close_all(self):
+        """
+        Close all sessions.
+        """
+        with self.lock:
+            sessions = self.sessions.values()
+            self.sessions = {}
+        for session in sessions:
+            session.close()
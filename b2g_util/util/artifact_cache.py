@@ -0,0 +1,253 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import time
+import errno
+import shutil
+import hashlib
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_dir(folder):
+    """
+    Create the folder if it does not exist, even if other processes are creating it at the same time.
+    """
+    try:
+        os.makedirs(folder)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(folder):
+            raise
+
+
+class CacheLock(object):
+    """
+    The exclusive lock of cache folder, which is shared by processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.path, 'a+')
+        if fcntl:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+        self.f = None
+
+
+class ArtifactCache(object):
+    """
+    The local artifact cache shared by processes, which is keyed by namespace, artifact name and digest.
+    The digest is the identity of artifact content, e.g. the TaskId of Taskcluster, or the ETag of URL.
+    The least recently used artifacts are evicted when the total size is over max_size.
+
+        cache_dir/
+            index.json
+            lock
+            artifacts/<sha1 of key>/<artifact basename>
+
+        >>> cache = ArtifactCache()
+        >>> path = cache.get('gecko.v2.mozilla-central.latest.b2g.aries-opt', 'private/build/aries.zip', task_id)
+        >>> path = path or cache.put('gecko.v2.mozilla-central.latest.b2g.aries-opt', 'private/build/aries.zip',
+        ...                          task_id, downloaded_file)
+    """
+
+    DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.b2g_util', 'artifact_cache')
+    DEFAULT_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+    _DIR_ARTIFACTS = 'artifacts'
+    _FILE_INDEX = 'index.json'
+    _FILE_LOCK = 'lock'
+
+    def __init__(self, cache_dir=None, max_size=None):
+        """
+        @param cache_dir: the cache folder, which will be created if it does not exist. (optional)
+        @param max_size: the max total size of artifacts in bytes. (optional)
+        """
+        self.cache_dir = os.path.abspath(cache_dir or self.DEFAULT_CACHE_DIR)
+        self.max_size = self.DEFAULT_MAX_SIZE if max_size is None else max_size
+        artifacts_dir = os.path.join(self.cache_dir, self._DIR_ARTIFACTS)
+        ensure_dir(artifacts_dir)
+
+    @staticmethod
+    def _key(namespace, artifact, digest):
+        return hashlib.sha1('\n'.join([namespace or '', artifact, digest])).hexdigest()
+
+    def _entry_path(self, key, artifact):
+        return os.path.join(self.cache_dir, self._DIR_ARTIFACTS, key, os.path.basename(artifact))
+
+    def _lock(self):
+        return CacheLock(os.path.join(self.cache_dir, self._FILE_LOCK))
+
+    def _load_index(self):
+        index_file = os.path.join(self.cache_dir, self._FILE_INDEX)
+        if not os.path.isfile(index_file):
+            return {}
+        try:
+            with open(index_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning('The cache index {} is broken, reset it.'.format(index_file))
+            return {}
+
+    def _save_index(self, index):
+        index_file = os.path.join(self.cache_dir, self._FILE_INDEX)
+        tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        if os.name == 'nt' and os.path.isfile(index_file):
+            os.remove(index_file)
+        os.rename(tmp_file, index_file)
+
+    def get(self, namespace, artifact, digest):
+        """
+        @return: the cached artifact file, or None when it is not cached.
+        """
+        if not digest:
+            return None
+        key = self._key(namespace, artifact, digest)
+        with self._lock():
+            index = self._load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            path = self._entry_path(key, artifact)
+            if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+                logger.debug('The cached {} is missing or broken.'.format(path))
+                del index[key]
+                self._save_index(index)
+                return None
+            entry['last_used'] = time.time()
+            self._save_index(index)
+        logger.info('Found {} of {} in cache.'.format(artifact, namespace))
+        return path
+
+    def put(self, namespace, artifact, digest, source_file):
+        """
+        Link (or copy) the file into cache, then evict the least recently used artifacts if the cache is over max_size.
+        @return: the cached artifact file.
+        """
+        key = self._key(namespace, artifact, digest)
+        path = self._entry_path(key, artifact)
+        entry_dir = os.path.dirname(path)
+        ensure_dir(entry_dir)
+        # link or copy to temp file out of lock then rename, so the artifact is never half written
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(source_file, tmp_path)
+        except (AttributeError, OSError):
+            shutil.copyfile(source_file, tmp_path)
+            os.chmod(tmp_path, 0444)
+        with self._lock():
+            if os.path.isfile(path):
+                os.remove(tmp_path)
+            else:
+                os.rename(tmp_path, path)
+            index = self._load_index()
+            index[key] = {'namespace': namespace, 'artifact': artifact, 'digest': digest,
+                          'size': os.path.getsize(path), 'last_used': time.time()}
+            self._evict(index, keep=key)
+            self._save_index(index)
+        logger.info('Cached {} of {}.'.format(artifact, namespace))
+        return path
+
+    def _evict(self, index, keep=None):
+        """
+        Remove the least recently used artifacts until the total size is not over max_size.
+        The caller should hold the lock.
+        """
+        total_size = sum(entry['size'] for entry in index.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]['last_used']):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            logger.info('Evict {} of {} from cache.'.format(entry['artifact'], entry['namespace']))
+            entry_dir = os.path.dirname(self._entry_path(key, entry['artifact']))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= entry['size']
+            del index[key]
+
+    def total_size(self):
+        with self._lock():
+            return sum(entry['size'] for entry in self._load_index().values())
+
+    @staticmethod
+    def link(path, dest_file):
+        """
+        Hard link the cached artifact to dest_file, or copy it if it can not be linked.
+        """
+        if os.path.abspath(path) == os.path.abspath(dest_file):
+            return dest_file
+        if os.path.lexists(dest_file):
+            os.remove(dest_file)
+        dest_dir = os.path.dirname(dest_file)
+        if dest_dir:
+            ensure_dir(dest_dir)
+        try:
+            os.link(path, dest_file)
+        except (AttributeError, OSError):
+            shutil.copyfile(path, dest_file)
+        return dest_file
+
+
+class CachedArtifactDownloader(object):
+    """
+    Wrap the Taskcluster artifact downloader, which looks up L{ArtifactCache} by the TaskId before downloading.
+    The other methods are forwarded to the wrapped downloader.
+    """
+
+    def __init__(self, downloader, cache, namespace=None):
+        """
+        @param downloader: the Downloader of taskcluster_util.
+        @param cache: the L{ArtifactCache}.
+        @param namespace: the namespace of task. (optional)
+        """
+        self.downloader = downloader
+        self.cache = cache
+        self.namespace = namespace
+
+    def __getattr__(self, name):
+        return getattr(self.downloader, name)
+
+    def download_latest_artifact(self, task_id, full_filename, dest_dir):
+        """
+        @return: the downloaded file path.
+        """
+        abs_dest_dir = os.path.abspath(dest_dir) if dest_dir else os.getcwd()
+        dest_file = os.path.join(abs_dest_dir, os.path.basename(full_filename))
+        cached = self.cache.get(self.namespace, full_filename, task_id)
+        if cached:
+            return ArtifactCache.link(cached, dest_file)
+        # the old file may be hard linked to the cached file, do not overwrite it in place
+        if os.path.lexists(dest_file):
+            os.remove(dest_file)
+        local_file = self.downloader.download_latest_artifact(task_id, full_filename, dest_dir)
+        if local_file and os.path.isfile(local_file):
+            self.cache.put(self.namespace, full_filename, task_id, local_file)
+        return local_file
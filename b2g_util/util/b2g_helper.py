@@ -2,16 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import os
+import time
 import logging
-import tarfile
-import zipfile
 from adb_helper import AdbWrapper
+from adb_shell_session import AdbShellSession
+from package_inspector import PackageInspector
 
 logger = logging.getLogger(__name__)
 
 
 class B2GHelper(object):
+    # the inspector of B2G packages, which is shared by the check_* methods
+    package_inspector = None
+
+    BOOT_TIMEOUT = 300
+    # the first line is "1" when Android booted, the second line is "running" when the B2G service is running
+    _BOOT_CHECK_COMMAND = 'getprop sys.boot_completed; getprop init.svc.b2g'
+    _BOOT_POLL_MIN_INTERVAL = 0.25
+    _BOOT_POLL_MAX_INTERVAL = 2
+
     @classmethod
     def stop_b2g(cls, serial=None):
         """
@@ -32,47 +41,90 @@ class B2GHelper(object):
         output, retcode = AdbWrapper.adb_shell('start b2g', serial=serial)
         logger.debug('RetCode: {}, Stdout: {}'.format(retcode, output))
 
+    @classmethod
+    def _get_boot_state(cls, session, timeout):
+        """
+        @return: the state of boot check, e.g. ('1', 'running'), or None if the device is not reachable.
+        """
+        try:
+            output, retcode = session.execute(cls._BOOT_CHECK_COMMAND, timeout=timeout)
+        except Exception as e:
+            logger.debug('Can not check boot state: {}'.format(e))
+            # drop the half-read output, the next check reconnects
+            session.close()
+            return None
+        lines = [line.strip() for line in output.splitlines()]
+        return tuple(lines + [''] * (2 - len(lines)))[:2]
+
+    @classmethod
+    def wait_for_boot(cls, serial=None, deadline=None):
+        """
+        Block until the device booted and B2G is running.
+        It polls the boot state over one shell session, the interval grows while the state is not changed.
+        The caller should make sure the device has gone down, e.g. B2G was stopped before reboot.
+        @param serial: device serial number. (optional)
+        @param deadline: the time (in seconds since the epoch) to give up. Default is BOOT_TIMEOUT seconds later.
+        @return: the seconds of time to ready.
+        @raise exception: when the device is not ready before deadline.
+        """
+        start_time = time.time()
+        if deadline is None:
+            deadline = start_time + cls.BOOT_TIMEOUT
+        logger.info('Wait for boot, serial: {}'.format(serial))
+        AdbWrapper.adb_wait_for_device(timeout=max(deadline - time.time(), 0), serial=serial)
+        session = AdbShellSession(serial=serial, client=AdbWrapper.get_client())
+        interval = cls._BOOT_POLL_MIN_INTERVAL
+        last_state = None
+        try:
+            while True:
+                state = cls._get_boot_state(session, timeout=max(deadline - time.time(), 0.1))
+                if state == ('1', 'running'):
+                    break
+                if state != last_state:
+                    # the device is making progress, check it soon
+                    logger.debug('Boot state: {}, serial: {}'.format(state, serial))
+                    last_state = state
+                    interval = cls._BOOT_POLL_MIN_INTERVAL
+                else:
+                    interval = min(interval * 2, cls._BOOT_POLL_MAX_INTERVAL)
+                if time.time() + interval > deadline:
+                    raise Exception('Wait for boot timeout, serial: {}, state: {}'.format(serial, state))
+                time.sleep(interval)
+        finally:
+            session.close()
+        seconds = time.time() - start_time
+        logger.info('Device is ready in {:.1f} seconds, serial: {}'.format(seconds, serial))
+        return seconds
+
+    @classmethod
+    def get_package_inspector(cls):
+        """
+        @return: the shared L{PackageInspector}.
+        """
+        if cls.package_inspector is None:
+            cls.package_inspector = PackageInspector()
+        return cls.package_inspector
+
     @classmethod
     def check_b2g_image(cls, file_path):
-        image_magic_folder = 'b2g-distro/'
         logger.debug('check image: {}'.format(file_path))
-        if os.path.isfile(file_path) and file_path.endswith('.zip'):
-            try:
-                with zipfile.ZipFile(file_path, 'r') as f:
-                    if image_magic_folder in f.namelist():
-                        logger.info('Check B2G image passed: {}'.format(file_path))
-                        return True
-            except Exception as e:
-                logger.debug(e)
-                return False
+        if cls.get_package_inspector().check(file_path, PackageInspector.IMAGE):
+            logger.info('Check B2G image passed: {}'.format(file_path))
+            return True
         return False
 
     @classmethod
     def check_gaia_package(cls, file_path):
-        gaia_magic_folder = 'gaia/profile/'
         logger.debug('check gaia: {}'.format(file_path))
-        if os.path.isfile(file_path) and file_path.endswith('.zip'):
-            try:
-                with zipfile.ZipFile(file_path, 'r') as f:
-                    if gaia_magic_folder in f.namelist():
-                        logger.info('Check Gaia package passed: {}'.format(file_path))
-                        return True
-            except Exception as e:
-                logger.debug(e)
-                return False
+        if cls.get_package_inspector().check(file_path, PackageInspector.GAIA):
+            logger.info('Check Gaia package passed: {}'.format(file_path))
+            return True
         return False
 
     @classmethod
     def check_gecko_package(cls, file_path):
-        gecko_magic_folder = 'b2g'
         logger.debug('check gecko: {}'.format(file_path))
-        if os.path.isfile(file_path) and file_path.endswith('.tar.gz'):
-            try:
-                with tarfile.TarFile.open(file_path, 'r:gz') as f:
-                    if gecko_magic_folder in f.getnames():
-                        logger.info('Check Gecko package passed: {}'.format(file_path))
-                        return True
-            except Exception as e:
-                logger.debug(e)
-                return False
+        if cls.get_package_inspector().check(file_path, PackageInspector.GECKO):
+            logger.info('Check Gecko package passed: {}'.format(file_path))
+            return True
         return False
@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class BackupStore(object):
+    """
+    The backup repository which stores the file contents by MD5 once, and records each backup as one snapshot
+    manifest per device serial and timestamp.
+
+        repository/
+            objects/<md5[:2]>/<md5[2:]>
+            snapshots/<serial>/<YYYYmmdd-HHMMSS-ffffff>.json  (UTC time in microseconds, or the given name)
+
+        >>> store = BackupStore('/backup/b2g')
+        >>> name = store.commit('/tmp/backup_restore_xxx', serial='foo')
+        >>> store.checkout('foo', name, '/tmp/restore_xxx')
+    """
+
+    _DIR_OBJECTS = 'objects'
+    _DIR_SNAPSHOTS = 'snapshots'
+    _SNAPSHOT_FORMAT = '%Y%m%d-%H%M%S-%f'
+    UNKNOWN_SERIAL = 'unknown_serial'
+
+    def __init__(self, repository):
+        """
+        @param repository: the folder of backup repository, which will be created if it does not exist.
+        """
+        self.repository = repository
+        for folder in (self._DIR_OBJECTS, self._DIR_SNAPSHOTS):
+            path = os.path.join(repository, folder)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    @staticmethod
+    def _md5(path, block_size=1024 * 1024):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), ''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def _object_path(self, md5):
+        return os.path.join(self.repository, self._DIR_OBJECTS, md5[:2], md5[2:])
+
+    def _snapshot_dir(self, serial):
+        return os.path.join(self.repository, self._DIR_SNAPSHOTS, serial or self.UNKNOWN_SERIAL)
+
+    def _add_object(self, path):
+        """
+        Store the file content if it is not in repository yet.
+        @return: the MD5 of file, and whether the content is new. e.g. (md5, is_new)
+        """
+        md5 = self._md5(path)
+        object_path = self._object_path(md5)
+        if os.path.isfile(object_path):
+            return md5, False
+        if not os.path.isdir(os.path.dirname(object_path)):
+            os.makedirs(os.path.dirname(object_path))
+        # copy to temp file then rename, so the object is never half written
+        tmp_path = '{}.{}.tmp'.format(object_path, os.getpid())
+        shutil.copyfile(path, tmp_path)
+        os.chmod(tmp_path, 0444)
+        os.rename(tmp_path, object_path)
+        return md5, True
+
+    def commit(self, local_dir, serial=None, snapshot=None):
+        """
+        Store the files of local folder, and record the snapshot manifest.
+        @param local_dir: the local folder.
+        @param serial: device serial number. (optional)
+        @param snapshot: the snapshot name, default is the current UTC time in microseconds. (optional)
+        @return: the snapshot name.
+        @raise exception: when the snapshot already exists.
+        """
+        snapshot = snapshot or datetime.utcnow().strftime(self._SNAPSHOT_FORMAT)
+        entries = {}
+        new_objects = 0
+        new_bytes = 0
+        for root, dirs, files in os.walk(local_dir):
+            rel_root = os.path.relpath(root, local_dir).replace(os.sep, '/')
+            if not dirs and not files and rel_root != '.':
+                entries[rel_root] = {'type': 'dir'}
+            for name in files:
+                local_file = os.path.join(root, name)
+                if os.path.islink(local_file) or not os.path.isfile(local_file):
+                    logger.debug('Skip {}, which is not a regular file.'.format(local_file))
+                    continue
+                md5, is_new = self._add_object(local_file)
+                size = os.path.getsize(local_file)
+                if is_new:
+                    new_objects += 1
+                    new_bytes += size
+                rel_path = name if rel_root == '.' else rel_root + '/' + name
+                entries[rel_path] = {'type': 'file', 'md5': md5, 'size': size,
+                                     'mode': os.stat(local_file).st_mode & 0777}
+        manifest = {'serial': serial, 'snapshot': snapshot, 'files': entries}
+        snapshot_dir = self._snapshot_dir(serial)
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        snapshot_path = os.path.join(snapshot_dir, snapshot + '.json')
+        tmp_path = '{}.{}.tmp'.format(snapshot_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        try:
+            if hasattr(os, 'link'):
+                # unlike rename, link never replaces the existing snapshot
+                os.link(tmp_path, snapshot_path)
+            else:
+                os.rename(tmp_path, snapshot_path)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise Exception('Snapshot {} of {} already exists.'.format(snapshot, serial))
+            raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logger.info('Snapshot {} of {}: {} entries, {} new objects ({} bytes).'.format(
+            snapshot, serial, len(entries), new_objects, new_bytes))
+        return snapshot
+
+    def list_snapshots(self, serial=None):
+        """
+        @param serial: device serial number. (optional)
+        @return: the sorted snapshot names of device, the latest is the last.
+        """
+        snapshot_dir = self._snapshot_dir(serial)
+        if not os.path.isdir(snapshot_dir):
+            return []
+        return sorted(name[:-len('.json')] for name in os.listdir(snapshot_dir) if name.endswith('.json'))
+
+    def get_latest_snapshot(self, serial=None):
+        """
+        @param serial: device serial number. (optional)
+        @return: the latest snapshot name of device, or None when there is no snapshot.
+        """
+        snapshots = self.list_snapshots(serial)
+        return snapshots[-1] if snapshots else None
+
+    def get_manifest(self, serial, snapshot):
+        """
+        @return: the snapshot manifest dict, which "files" is {relative path: entry}.
+        @raise exception: When the snapshot does not exist.
+        """
+        snapshot_path = os.path.join(self._snapshot_dir(serial), snapshot + '.json')
+        if not os.path.isfile(snapshot_path):
+            raise Exception('Snapshot {} of {} does not exist.'.format(snapshot, serial))
+        with open(snapshot_path, 'r') as f:
+            return json.load(f)
+
+    def checkout(self, serial, snapshot, dest_dir):
+        """
+        Rebuild the folder of snapshot from the stored objects.
+        The files are copied, so the repository is not changed when they are modified.
+        @param serial: device serial number.
+        @param snapshot: the snapshot name.
+        @param dest_dir: the target local folder.
+        """
+        manifest = self.get_manifest(serial, snapshot)
+        for rel_path, entry in sorted(manifest['files'].items()):
+            target = os.path.join(dest_dir, *rel_path.split('/'))
+            if entry['type'] == 'dir':
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copyfile(self._object_path(entry['md5']), target)
+            os.chmod(target, entry['mode'])
+        logger.info('Checkout snapshot {} of {} into {}.'.format(snapshot, serial, dest_dir))
@@ -4,9 +4,12 @@
 
 import os
 import types
+import fnmatch
 import logging
 import tarfile
 import zipfile
+import multiprocessing
+from parallel import gather
 
 
 logger = logging.getLogger(__name__)
@@ -14,27 +17,115 @@ logger = logging.getLogger(__name__)
 
 class Decompressor(object):
 
+    # zlib releases the GIL, so the members can be inflated by threads in parallel
+    DEFAULT_JOBS = min(4, multiprocessing.cpu_count())
+
+    @staticmethod
+    def _match(name, patterns):
+        """
+        @param patterns: the member names, the folder prefixes (e.g. 'gaia/profile/webapps/'), or the glob patterns.
+        """
+        for pattern in patterns:
+            if name == pattern or name.startswith(pattern.rstrip('/') + '/') or fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    @staticmethod
+    def _split_by_size(infos, jobs):
+        """
+        Split the members into jobs groups, which have the similar total size.
+        """
+        groups = [[] for _ in range(jobs)]
+        sizes = [0] * jobs
+        for info in sorted(infos, key=lambda i: i.file_size, reverse=True):
+            index = sizes.index(min(sizes))
+            groups[index].append(info)
+            sizes[index] += info.file_size
+        return [group for group in groups if group]
+
+    @staticmethod
+    def _extract_members(source_file, infos, dest_folder):
+        # each thread has its own file handle, the ZipFile can not be shared by threads
+        with zipfile.ZipFile(source_file) as zip_file:
+            for info in infos:
+                zip_file.extract(info, dest_folder)
+
     @classmethod
-    def unzip(cls, source_file, dest_folder):
+    def unzip(cls, source_file, dest_folder, members=None, jobs=1):
+        """
+        Unzip the members of zip file.
+        @param source_file: the zip file.
+        @param dest_folder: the target local folder.
+        @param members: only unzip the members which match the names, folder prefixes or glob patterns. (optional)
+        @param jobs: the number of threads which unzip the members in parallel. (optional)
+        @return: the manifest of extracted files and sizes, e.g. {'gaia/profile/user.js': 1024, ...}, or None if failed.
+        """
         try:
             logger.info('Unzip {} to {}'.format(source_file, dest_folder))
-            zip_file = zipfile.ZipFile(source_file)
-            zip_file.extractall(dest_folder)
-            zip_file.close()
-            logger.info('Unzip done')
+            with zipfile.ZipFile(source_file) as zip_file:
+                infos = zip_file.infolist()
+            if members is not None:
+                infos = [info for info in infos if cls._match(info.filename, members)]
+            # create the folders first, so that the threads do not race on them
+            for info in infos:
+                path = os.path.join(dest_folder, *info.filename.split('/'))
+                folder = path if info.filename.endswith('/') else os.path.dirname(path)
+                cls.ensure_folder(folder)
+            files = [info for info in infos if not info.filename.endswith('/')]
+            groups = cls._split_by_size(files, max(1, jobs))
+            if len(groups) > 1:
+                gather([(cls._extract_members, {'source_file': source_file, 'infos': group,
+                                                'dest_folder': dest_folder}) for group in groups],
+                       max_workers=len(groups))
+            elif groups:
+                cls._extract_members(source_file, groups[0], dest_folder)
+            manifest = dict((info.filename, info.file_size) for info in files)
+            logger.info('Unzip done, {} files, {} bytes'.format(len(manifest), sum(manifest.values())))
+            return manifest
         except Exception as e:
+            logger.debug(e)
             logger.error('Unzip {} Error'.format(source_file))
 
     @classmethod
     def untar(cls, source_file, dest_folder):
+        """
+        @return: the names of members, or None if failed.
+        """
         try:
             logger.info('Untar {} to {}'.format(source_file, dest_folder))
             tar_file = tarfile.open(source_file)
             tar_file.extractall(dest_folder)
+            # the members are loaded by extractall
+            names = tar_file.getnames()
             tar_file.close()
             logger.info('Untar done')
+            return names
         except Exception as e:
-            logger.error('Unzip {} Error'.format(source_file))
+            logger.debug(e)
+            logger.error('Untar {} Error'.format(source_file))
+
+    @classmethod
+    def untar_stream(cls, fileobj, dest_folder, member_callback=None):
+        """
+        Untar the members on the fly when they arrive from the stream, e.g. the package which is being downloaded.
+        @param fileobj: the file object of tar stream, which can be compressed by gzip or bzip2.
+        @param dest_folder: the target local folder.
+        @param member_callback: called with the TarInfo and the local path after each member is extracted. (optional)
+        @return: the names of extracted members.
+        """
+        logger.info('Untar stream to {}'.format(dest_folder))
+        names = []
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tar_file:
+            for member in tar_file:
+                if os.path.isabs(member.name) or '..' in member.name.split('/'):
+                    logger.warning('Skip unsafe member {}'.format(member.name))
+                    continue
+                tar_file.extract(member, dest_folder)
+                names.append(member.name)
+                if member_callback:
+                    member_callback(member, os.path.join(dest_folder, member.name))
+        logger.info('Untar done')
+        return names
 
     @classmethod
     def ensure_folder(cls, folder):
@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import re
+import shutil
+import hashlib
+import logging
+import tempfile
+from adb_helper import AdbWrapper
+
+logger = logging.getLogger(__name__)
+
+
+class DeltaPusher(object):
+    """
+    Push only the new or changed files of one local folder into one device folder, by comparing the MD5 manifests.
+
+        >>> DeltaPusher.push('/tmp/shallowflash_xxx/b2g', '/system/b2g', excludes=['defaults', 'webapps'])
+    """
+
+    # list the files by "find", or by the shell function when the device has no "find",
+    # then hash them by "md5sum", or by the "md5" of toolbox
+    _DEVICE_MANIFEST_SCRIPT = ('if md5sum /dev/null >/dev/null 2>&1; then H=md5sum; else H=md5; fi; '
+                               'walk() {{ for f in "$1"/*; do '
+                               'if [ -d "$f" ]; then walk "$f"; elif [ -f "$f" ]; then echo "$f"; fi; '
+                               'done; }}; '
+                               '(find {0} -type f 2>/dev/null || walk {0}) | while read f; do $H "$f"; done')
+
+    _MANIFEST_LINE = re.compile(r'^([0-9a-fA-F]{32})\s+(.+)$')
+
+    @staticmethod
+    def _md5(path, block_size=1024 * 1024):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), ''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    @classmethod
+    def get_local_manifest(cls, local_dir):
+        """
+        Get the MD5 of each file under local folder.
+        @param local_dir: the local folder.
+        @return: the dict of relative path (with "/") and MD5. e.g. {'lib/libxul.so': '0123...', ...}
+        """
+        manifest = {}
+        for root, dirs, files in os.walk(local_dir):
+            for name in files:
+                local_file = os.path.join(root, name)
+                rel_path = os.path.relpath(local_file, local_dir).replace(os.sep, '/')
+                manifest[rel_path] = cls._md5(local_file)
+        return manifest
+
+    @classmethod
+    def get_device_manifest(cls, remote_dir, serial=None):
+        """
+        Get the MD5 of each file under device folder, by one shell command.
+        @param remote_dir: the device folder.
+        @param serial: device serial number. (optional)
+        @return: the dict of relative path and MD5. e.g. {'lib/libxul.so': '0123...', ...}
+        """
+        remote_dir = remote_dir.rstrip('/')
+        output, retcode = AdbWrapper.adb_shell(cls._DEVICE_MANIFEST_SCRIPT.format(remote_dir), serial=serial)
+        manifest = {}
+        for line in output.splitlines():
+            match = cls._MANIFEST_LINE.match(line.strip())
+            if match is None:
+                continue
+            md5, remote_file = match.groups()
+            if remote_file.startswith(remote_dir + '/'):
+                manifest[remote_file[len(remote_dir) + 1:]] = md5.lower()
+        return manifest
+
+    @staticmethod
+    def diff(local_manifest, device_manifest, excludes=None):
+        """
+        Compare the manifests.
+        @param excludes: the top-level names on device which are never removed. (optional)
+        @return: the sorted lists of changed (new or modified) files and stale files. e.g. (changed, stale)
+        """
+        excludes = set(excludes or [])
+        changed = sorted(path for path, md5 in local_manifest.items() if device_manifest.get(path) != md5)
+        stale = sorted(path for path in device_manifest
+                       if path not in local_manifest and path.split('/')[0] not in excludes)
+        return changed, stale
+
+    @classmethod
+    def push(cls, local_dir, remote_dir, serial=None, excludes=None):
+        """
+        Push the new or changed files into device, and remove the stale files from device.
+        @param local_dir: the local folder.
+        @param remote_dir: the device folder.
+        @param serial: device serial number. (optional)
+        @param excludes: the top-level names on device which are never removed. (optional)
+        @return: the lists of pushed files and removed files. e.g. (changed, stale)
+        """
+        remote_dir = remote_dir.rstrip('/')
+        local_manifest = cls.get_local_manifest(local_dir)
+        device_manifest = cls.get_device_manifest(remote_dir, serial=serial)
+        changed, stale = cls.diff(local_manifest, device_manifest, excludes=excludes)
+        logger.info('{}: {} files changed, {} files stale, {} files unchanged.'.format(
+            remote_dir, len(changed), len(stale), len(local_manifest) - len(changed)))
+        if stale:
+            logger.debug('Remove stale files: {}'.format(stale))
+            AdbWrapper.adb_shell_batch(['rm "{}/{}"'.format(remote_dir, path) for path in stale], serial=serial)
+        if changed:
+            logger.debug('Push changed files: {}'.format(changed))
+            cls._push_files(local_dir, remote_dir, changed, serial=serial)
+        return changed, stale
+
+    @staticmethod
+    def _push_files(local_dir, remote_dir, files, serial=None):
+        """
+        Link the files into one staging folder with the same layout, and then push it by one "adb push".
+        """
+        staging_dir = tempfile.mkdtemp(prefix='deltapush_')
+        try:
+            for path in files:
+                source = os.path.join(local_dir, *path.split('/'))
+                target = os.path.join(staging_dir, *path.split('/'))
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                try:
+                    os.link(source, target)
+                except (AttributeError, OSError):
+                    shutil.copy2(source, target)
+            AdbWrapper.adb_push(staging_dir, remote_dir, serial=serial)
+        finally:
+            shutil.rmtree(staging_dir)
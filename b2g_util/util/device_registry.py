@@ -0,0 +1,297 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import socket
+import logging
+import threading
+from adb_client import AdbClient
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceRegistry(object):
+    """
+    The in-memory device list, which is kept up to date by the "host:track-devices" stream of ADB server.
+
+    It subscribes once, answers devices() without spawning any process,
+    and lets callers wait for the device state changes.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    RECONNECT_INTERVAL = 1
+    POLL_INTERVAL = 0.5
+    STOP_TIMEOUT = 5
+
+    def __init__(self, client=None):
+        """
+        @param client: the L{AdbClient} object. (optional)
+        """
+        self.client = client or AdbClient()
+        self.devices_map = {}
+        self.tracking = False
+        self.stopped = threading.Event()
+        self.sock = None
+        self.thread = None
+        # only one party subscribes: start() while the thread is alive, or the thread itself after disconnection
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+
+    @classmethod
+    def get_instance(cls, client=None):
+        """
+        Get the shared registry, and start tracking if it is not tracking.
+        @param client: the L{AdbClient} object. The registry is recreated if the ADB server is changed. (optional)
+        @return: L{DeviceRegistry} object.
+        """
+        client = client or AdbClient()
+        with cls._instance_lock:
+            instance = cls._instance
+            if instance is not None and (instance.client.host, instance.client.port) != (client.host, client.port):
+                instance.stop()
+                instance = None
+            if instance is None:
+                instance = cls(client)
+                cls._instance = instance
+            if not instance.tracking:
+                instance.start()
+            return instance
+
+    def _subscribe(self, timeout=2):
+        """
+        Send host:track-devices, and then read the first device list.
+        @return: the socket of track-devices stream.
+        """
+        sock = self.client.connect()
+        try:
+            sock.settimeout(timeout)
+            AdbClient._send_request(sock, 'host:track-devices')
+            AdbClient._read_status(sock, 'host:track-devices')
+            devices = AdbClient.parse_devices(AdbClient._read_hex_payload(sock))
+            sock.settimeout(None)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+        self._update(devices)
+        return sock
+
+    def start(self):
+        """
+        Start tracking devices.
+        The tracking thread subscribes again by itself when the ADB server is restarted,
+        so it does nothing while the thread is alive.
+        @return: True if tracking, False if the ADB server is not reachable.
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return self.tracking
+            self.stopped.clear()
+            try:
+                sock = self._subscribe()
+            except Exception as e:
+                logger.debug('Can not track devices: {}'.format(e))
+                return False
+            self.thread = threading.Thread(target=self._track, args=(sock,))
+            self.thread.daemon = True
+            self.thread.start()
+            logger.debug('Start tracking devices: {}'.format(self.devices_map))
+            return True
+
+    def stop(self):
+        """
+        Stop tracking devices, and wait for the tracking thread to exit.
+        """
+        with self.lock:
+            self.stopped.set()
+            sock = self.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error as e:
+                    logger.debug(e)
+            thread = self.thread
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(self.STOP_TIMEOUT)
+            self.sock = None
+            with self.condition:
+                self.tracking = False
+                self.condition.notify_all()
+
+    def _update(self, devices):
+        with self.condition:
+            if devices != self.devices_map:
+                logger.debug('Devices: {}'.format(devices))
+            self.devices_map = devices
+            self.tracking = True
+            self.condition.notify_all()
+
+    def _track(self, sock):
+        while sock is not None:
+            try:
+                while not self.stopped.is_set():
+                    self._update(AdbClient.parse_devices(AdbClient._read_hex_payload(sock)))
+            except Exception as e:
+                logger.debug('Tracking devices stopped: {}'.format(e))
+            with self.condition:
+                self.tracking = False
+                self.condition.notify_all()
+            sock.close()
+            sock = None
+            # the ADB server was restarted or killed, then subscribe again
+            while sock is None and not self.stopped.wait(self.RECONNECT_INTERVAL):
+                try:
+                    sock = self._subscribe()
+                except Exception as e:
+                    logger.debug('Can not track devices: {}'.format(e))
+
+    def _poll_devices(self):
+        try:
+            return self.client.devices()
+        except Exception as e:
+            logger.debug('Can not list devices: {}'.format(e))
+            return {}
+
+    def devices(self):
+        """
+        Get the device list from cache.
+        @return: devices as dict {device_serial: device_status, ...}, or None if it is not tracking.
+        """
+        with self.condition:
+            if not self.tracking:
+                return None
+            return dict(self.devices_map)
+
+    def wait_for_state(self, serial=None, state='device', timeout=60):
+        """
+        Block until the device becomes the given state.
+        @param serial: device serial number. Wait for any device if it is None. (optional)
+        @param state: the expected state. Default is "device".
+        @param timeout: the timeout in seconds.
+        @return: True when the device becomes the state.
+        @raise exception: when running for more than timeout seconds, or the registry stopped tracking.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if self.tracking:
+                    devices = self.devices_map
+                elif self.stopped.is_set():
+                    raise Exception('Device registry is not tracking, serial: {}'.format(serial))
+                else:
+                    # the device list is stale until the tracking thread subscribes again, so poll the ADB server
+                    self.condition.release()
+                    try:
+                        devices = self._poll_devices()
+                    finally:
+                        self.condition.acquire()
+                if serial is None and state in devices.values():
+                    return True
+                if serial is not None and devices.get(serial) == state:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception('Wait for device timeout, timeout {}, serial: {}, state: {}'.format(
+                        timeout, serial, state))
+                self.condition.wait(remaining if self.tracking else min(remaining, self.POLL_INTERVAL))
+
+
+class _Waiter(object):
+    """
+    The state of one waiting call of L{DevicePoller}.
+    """
+
+    def __init__(self, serial, state):
+        self.serial = serial
+        self.state = state
+        self.event = threading.Event()
+
+    def is_ready(self, devices):
+        if self.serial is None:
+            return self.state in devices.values()
+        return devices.get(self.serial) == self.state
+
+
+class DevicePoller(object):
+    """
+    The shared poller of device list, for waiting when the ADB server can not be tracked by L{DeviceRegistry}.
+
+    One thread polls the devices while there are waiters, and wakes each waiter when its device becomes the state.
+    The waiters keep their own state, so the timeout of one waiter does not affect the others.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, list_devices, interval=None):
+        """
+        @param list_devices: the function which returns the devices as dict {device_serial: device_status, ...}.
+        @param interval: the seconds between polls. (optional)
+        """
+        self.list_devices = list_devices
+        self.interval = self.POLL_INTERVAL if interval is None else interval
+        self.lock = threading.Lock()
+        self.waiters = []
+        self.thread = None
+
+    @classmethod
+    def get_instance(cls, list_devices):
+        """
+        Get the shared poller, which is recreated if list_devices is changed.
+        @param list_devices: the function which returns the devices as dict {device_serial: device_status, ...}.
+        @return: L{DevicePoller} object.
+        """
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.list_devices != list_devices:
+                cls._instance = cls(list_devices)
+            return cls._instance
+
+    def _poll(self):
+        while True:
+            with self.lock:
+                if not self.waiters:
+                    # the next waiter starts a new thread
+                    self.thread = None
+                    return
+            try:
+                devices = self.list_devices()
+            except Exception as e:
+                logger.debug('Can not list devices: {}'.format(e))
+                devices = {}
+            with self.lock:
+                for waiter in [waiter for waiter in self.waiters if waiter.is_ready(devices)]:
+                    self.waiters.remove(waiter)
+                    waiter.event.set()
+            time.sleep(self.interval)
+
+    def wait_for_state(self, serial=None, state='device', timeout=60):
+        """
+        Block until the device becomes the given state.
+        @param serial: device serial number. Wait for any device if it is None. (optional)
+        @param state: the expected state. Default is "device".
+        @param timeout: the timeout in seconds.
+        @return: True when the device becomes the state.
+        @raise exception: when running for more than timeout seconds.
+        """
+        waiter = _Waiter(serial, state)
+        with self.lock:
+            self.waiters.append(waiter)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._poll)
+                self.thread.daemon = True
+                self.thread.start()
+        try:
+            if not waiter.event.wait(timeout):
+                raise Exception('Wait for device timeout, timeout {}, serial: {}, state: {}'.format(
+                    timeout, serial, state))
+            return True
+        finally:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
@@ -3,43 +3,302 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import re
+import json
+import time
+import socket
 import logging
 import urllib2
+import urlparse
+import threading
 import console_utilities
+from parallel import gather
+from artifact_cache import ArtifactCache
 
 
 logger = logging.getLogger(__name__)
 
 
 class Downloader(object):
+    """
+    Download the file by parallel "Range" requests over several connections into one preallocated file.
+    The progress is kept in the sidecar state file "<file>.download", so the interrupted download can be resumed.
+    When the server does not support "Range", the file is downloaded by one stream.
+    With L{ArtifactCache}, the file is looked up by the URL and the digest (or the ETag) before downloading.
 
-    def download(self, source_url, dest_folder, status_callback=None, progress_callback=None):
+        >>> Downloader().download('https://foo/b2g-image.zip', '/tmp/images', connections=4)
+        '/tmp/images/b2g-image.zip'
+    """
+
+    DEFAULT_CONNECTIONS = 4
+    # the file smaller than it is downloaded by less connections
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+    RETRIES = 3
+    TIMEOUT = 60
+    STATE_SUFFIX = '.download'
+    # the interval of saving the state file, in seconds
+    _STATE_SAVE_INTERVAL = 1
+
+    _CONTENT_RANGE = re.compile(r'^bytes\s+(\d+)-(\d+)/(\d+)$')
+
+    def __init__(self, cache=None):
+        """
+        @param cache: the L{ArtifactCache}. (optional)
+        """
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.last_saved = 0
+
+    def download(self, source_url, dest_folder, status_callback=None, progress_callback=None,
+                 connections=DEFAULT_CONNECTIONS, digest=None):
+        """
+        @param source_url: the URL of file.
+        @param dest_folder: the local folder.
+        @param status_callback: not used. (optional)
+        @param progress_callback: the callback function, progress_callback(current_byte=..., total_size=...). (optional)
+        @param connections: the max number of parallel connections. (optional)
+        @param digest: the identity of file content, the cache is checked without network if it is given. (optional)
+        @return: the downloaded file, or None when download failed.
+        """
         try:
             console_utilities.hide_cursor()
-            f = urllib2.urlopen(source_url)
-            logger.info('Downloading {} ...'.format(os.path.basename(source_url)))
+            # the query string of signed URL is not a part of the file name and the cache key
+            url_path = urlparse.urlparse(source_url).path
+            cache_namespace = urlparse.urljoin(source_url, url_path)
+            logger.info('Downloading {} ...'.format(os.path.basename(url_path)))
             self.ensure_folder(dest_folder)
-            filename_with_path = os.path.join(dest_folder, os.path.basename(source_url))
-            with open(filename_with_path, "wb") as local_file:
-                total_size = int(f.info().getheader('Content-Length').strip())
-                pc = 0
-                chunk_size = 8192
-                while 1:
-                    chunk = f.read(chunk_size)
-                    pc += len(chunk)
-                    if not chunk:
-                        break
-                    if progress_callback:
-                        progress_callback(current_byte=pc, total_size=total_size)
-                    local_file.write(chunk)
+            filename_with_path = os.path.join(dest_folder, os.path.basename(url_path))
+            if self.cache and self._from_cache(cache_namespace, digest, filename_with_path):
+                return filename_with_path
+            try:
+                f = self._open(source_url, 0, 0)
+            except urllib2.HTTPError as e:
+                # 416 Requested Range Not Satisfiable, the file is empty
+                if e.code != 416:
+                    raise
+                f = self._open(source_url)
+            content_range = self._CONTENT_RANGE.match(f.info().getheader('Content-Range', '').strip())
+            if f.getcode() == 206 and content_range:
+                total_size = int(content_range.group(3))
+                validator = f.info().getheader('ETag') or f.info().getheader('Last-Modified')
+                f.close()
+                digest = digest or validator
+                if self.cache and self._from_cache(cache_namespace, digest, filename_with_path):
+                    return filename_with_path
+                self._download_ranges(source_url, filename_with_path, total_size, validator,
+                                      connections, progress_callback)
+            else:
+                logger.debug('{} does not support Range, download by one stream.'.format(source_url))
+                digest = digest or f.info().getheader('ETag') or f.info().getheader('Last-Modified')
+                self._download_stream(f, filename_with_path, progress_callback)
+            if self.cache and digest:
+                self.cache.put(cache_namespace, os.path.basename(filename_with_path), digest, filename_with_path)
             logger.info('Download to {}'.format(filename_with_path))
-            console_utilities.show_cursor()
             return filename_with_path
         except urllib2.HTTPError as e:
             logger.error(e)
         except urllib2.URLError as e:
             logger.error(e)
+        except (IOError, socket.error) as e:
+            logger.error('Download {} failed, it will be resumed next time: {}'.format(source_url, e))
+        finally:
+            console_utilities.show_cursor()
+
+    def open_stream(self, source_url, progress_callback=None):
+        """
+        Open the URL as one stream, which can be read on the fly. e.g. by tarfile.open(fileobj=f, mode='r|gz')
+        @param source_url: the URL of file.
+        @param progress_callback: the callback function, progress_callback(current_byte=..., total_size=...). (optional)
+        @return: the file-like object.
+        """
+        logger.info('Streaming {} ...'.format(os.path.basename(urlparse.urlparse(source_url).path)))
+        f = self._open(source_url)
+        total_size = int(f.info().getheader('Content-Length', '0').strip())
+        return _ProgressReader(f, total_size, progress_callback)
+
+    def _from_cache(self, cache_namespace, digest, filename_with_path):
+        """
+        @return: True if the file is linked from cache.
+        """
+        cached = self.cache.get(cache_namespace, os.path.basename(filename_with_path), digest)
+        if cached is None:
+            return False
+        ArtifactCache.link(cached, filename_with_path)
+        logger.info('Download to {} from cache'.format(filename_with_path))
+        return True
+
+    def _open(self, source_url, start=None, end=None):
+        """
+        Open the URL, with the "Range" header when start is given.
+        """
+        request = urllib2.Request(source_url)
+        if start is not None:
+            request.add_header('Range', 'bytes={}-{}'.format(start, end))
+        return urllib2.urlopen(request, timeout=self.TIMEOUT)
+
+    def _download_stream(self, f, filename_with_path, progress_callback=None):
+        """
+        Download the opened response by one stream, from the beginning.
+        """
+        self._remove(filename_with_path)
+        with open(filename_with_path, 'wb') as local_file:
+            total_size = int(f.info().getheader('Content-Length', '0').strip())
+            pc = 0
+            while 1:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                pc += len(chunk)
+                local_file.write(chunk)
+                if progress_callback:
+                    progress_callback(current_byte=pc, total_size=total_size)
+        f.close()
+        state_file = filename_with_path + self.STATE_SUFFIX
+        if os.path.isfile(state_file):
+            os.remove(state_file)
+
+    @staticmethod
+    def _remove(filename_with_path):
+        """
+        Remove the old file before writing, it may be hard linked to the cached file.
+        """
+        if os.path.lexists(filename_with_path):
+            os.remove(filename_with_path)
+
+    def _load_state(self, filename_with_path, source_url, total_size, validator):
+        """
+        @return: the state of previous download of the same file, or None.
+        """
+        state_file = filename_with_path + self.STATE_SUFFIX
+        if not os.path.isfile(state_file) or not os.path.isfile(filename_with_path):
+            return None
+        try:
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            logger.debug('Ignore the broken state file {}.'.format(state_file))
+            return None
+        if (state.get('url'), state.get('size'), state.get('validator')) != (source_url, total_size, validator) or \
+                os.path.getsize(filename_with_path) != total_size:
+            logger.debug('The state file {} is out of date.'.format(state_file))
+            return None
+        return state
+
+    def _save_state(self, filename_with_path, state, force=False):
+        """
+        Save the state into temp file then rename, at most once per second unless force is True.
+        The caller should hold the lock.
+        """
+        now = time.time()
+        if not force and now - self.last_saved < self._STATE_SAVE_INTERVAL:
+            return
+        self.last_saved = now
+        state_file = filename_with_path + self.STATE_SUFFIX
+        tmp_file = '{}.{}.tmp'.format(state_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_file, state_file)
+
+    def _split(self, total_size, connections):
+        """
+        @return: the list of segments [start, end, offset], which end is inclusive, and offset is the next byte.
+        """
+        count = max(1, min(connections, total_size // self.MIN_SEGMENT_SIZE))
+        segment_size = -(-total_size // count)
+        return [[start, min(start + segment_size, total_size) - 1, start]
+                for start in xrange(0, total_size, segment_size)]
+
+    def _download_ranges(self, source_url, filename_with_path, total_size, validator, connections,
+                         progress_callback=None):
+        state = self._load_state(filename_with_path, source_url, total_size, validator)
+        if state is None:
+            state = {'url': source_url, 'size': total_size, 'validator': validator,
+                     'segments': self._split(total_size, connections)}
+            # preallocate the file, the segments are written in place
+            self._remove(filename_with_path)
+            with open(filename_with_path, 'wb') as f:
+                f.truncate(total_size)
+            with self.lock:
+                self._save_state(filename_with_path, state, force=True)
+        else:
+            logger.info('Resume {} from the state file.'.format(filename_with_path))
+        segments = [segment for segment in state['segments'] if segment[2] <= segment[1]]
+        progress = {'current_byte': total_size - sum(end + 1 - offset for _, end, offset in segments)}
+        logger.debug('Download {} by {} connections, {} bytes done.'.format(
+            source_url, len(segments), progress['current_byte']))
+
+        def download_segment(segment):
+            retries = self.RETRIES
+            while True:
+                try:
+                    return self._download_segment(source_url, filename_with_path, state, segment, progress,
+                                                  progress_callback)
+                except (IOError, socket.error) as e:
+                    if retries <= 0:
+                        raise
+                    retries -= 1
+                    logger.debug('Retry the range from {}: {}'.format(segment[2], e))
+
+        try:
+            gather([(download_segment, {'segment': segment}) for segment in segments],
+                   max_workers=max(1, len(segments)))
+        finally:
+            with self.lock:
+                self._save_state(filename_with_path, state, force=True)
+        os.remove(filename_with_path + self.STATE_SUFFIX)
+
+    def _download_segment(self, source_url, filename_with_path, state, segment, progress, progress_callback=None):
+        """
+        Download the rest of one segment into its place, and update the segment offset.
+        """
+        start, end, offset = segment
+        if offset > end:
+            return
+        f = self._open(source_url, offset, end)
+        try:
+            content_range = self._CONTENT_RANGE.match(f.info().getheader('Content-Range', '').strip())
+            if f.getcode() != 206 or not content_range or int(content_range.group(1)) != offset:
+                raise IOError('Unexpected response of range {}-{}.'.format(offset, end))
+            # unbuffered, so the bytes recorded in state file are always written to the file
+            with open(filename_with_path, 'r+b', 0) as local_file:
+                local_file.seek(offset)
+                while segment[2] <= end:
+                    chunk = f.read(min(self.CHUNK_SIZE, end + 1 - segment[2]))
+                    if not chunk:
+                        raise IOError('Connection closed at {} of range {}-{}.'.format(segment[2], start, end))
+                    local_file.write(chunk)
+                    with self.lock:
+                        segment[2] += len(chunk)
+                        progress['current_byte'] += len(chunk)
+                        self._save_state(filename_with_path, state)
+                        if progress_callback:
+                            progress_callback(current_byte=progress['current_byte'], total_size=state['size'])
+        finally:
+            f.close()
 
     def ensure_folder(self, folder):
         if not os.path.isdir(folder):
             os.makedirs(folder)
+
+
+class _ProgressReader(object):
+    """
+    The file-like object of HTTP response, which reports the progress of reading.
+    """
+
+    def __init__(self, f, total_size, progress_callback=None):
+        self.f = f
+        self.total_size = total_size
+        self.progress_callback = progress_callback
+        self.current_byte = 0
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        self.current_byte += len(chunk)
+        if chunk and self.progress_callback:
+            self.progress_callback(current_byte=self.current_byte, total_size=self.total_size)
+        return chunk
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,238 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import stat
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+import contextlib
+from artifact_cache import CacheLock, ensure_dir
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionCache(object):
+    """
+    The persistent cache of extracted package trees, which is keyed by the SHA-1 of package content.
+    The trees should not be modified, and are reference-counted by the processes which are using them,
+    so the same package is extracted once for many runs and devices.
+    The file modes are kept for pushing, so the tree is checked by its file count and size instead,
+    and the modified tree is extracted again.
+    The least recently used trees which are not in use are evicted when the total size is over max_size.
+
+        cache_dir/
+            index.json
+            lock
+            trees/<sha1 of package and variant>/
+
+        >>> cache = ExtractionCache()
+        >>> with cache.open('/tmp/b2g.tar.gz', lambda dest: Decompressor.untar('/tmp/b2g.tar.gz', dest)) as tree:
+        ...     AdbWrapper.adb_push_archive(os.path.join(tree, 'b2g'), '/system/b2g/')
+    """
+
+    DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.b2g_util', 'extraction_cache')
+    DEFAULT_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+    _DIR_TREES = 'trees'
+    _FILE_INDEX = 'index.json'
+    _FILE_LOCK = 'lock'
+
+    def __init__(self, cache_dir=None, max_size=None):
+        """
+        @param cache_dir: the cache folder, which will be created if it does not exist. (optional)
+        @param max_size: the max total size of extracted trees in bytes. (optional)
+        """
+        self.cache_dir = os.path.abspath(cache_dir or self.DEFAULT_CACHE_DIR)
+        self.max_size = self.DEFAULT_MAX_SIZE if max_size is None else max_size
+        trees_dir = os.path.join(self.cache_dir, self._DIR_TREES)
+        ensure_dir(trees_dir)
+
+    def _lock(self):
+        return CacheLock(os.path.join(self.cache_dir, self._FILE_LOCK))
+
+    def _load_index(self):
+        index_file = os.path.join(self.cache_dir, self._FILE_INDEX)
+        index = {'digests': {}, 'trees': {}}
+        if os.path.isfile(index_file):
+            try:
+                with open(index_file, 'r') as f:
+                    index.update(json.load(f))
+            except ValueError:
+                logger.warning('The cache index {} is broken, reset it.'.format(index_file))
+        return index
+
+    def _save_index(self, index):
+        index_file = os.path.join(self.cache_dir, self._FILE_INDEX)
+        tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        if os.name == 'nt' and os.path.isfile(index_file):
+            os.remove(index_file)
+        os.rename(tmp_file, index_file)
+
+    @staticmethod
+    def _sha1(path, block_size=1024 * 1024):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), ''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def _get_digest(self, package):
+        """
+        Get the SHA-1 of package, which is remembered by the path, size and mtime.
+        """
+        package = os.path.abspath(package)
+        st = os.stat(package)
+        with self._lock():
+            entry = self._load_index()['digests'].get(package)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            return entry['sha1']
+        digest = self._sha1(package)
+        with self._lock():
+            index = self._load_index()
+            index['digests'][package] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': digest}
+            # forget the packages which do not exist
+            index['digests'] = dict((path, entry) for path, entry in index['digests'].items() if os.path.isfile(path))
+            self._save_index(index)
+        return digest
+
+    def _tree_path(self, key):
+        return os.path.join(self.cache_dir, self._DIR_TREES, key)
+
+    @staticmethod
+    def _is_alive(pid):
+        # os.kill(pid, 0) terminates the process on Windows, assume it is alive
+        if pid == os.getpid() or os.name == 'nt':
+            return True
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    @staticmethod
+    def _remove_tree(folder):
+        if not os.path.isdir(folder):
+            return
+        # the package can have the read-only folders
+        for root, dirs, _ in os.walk(folder):
+            for path in [root] + [os.path.join(root, name) for name in dirs]:
+                if not os.path.islink(path):
+                    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) | stat.S_IRWXU)
+        shutil.rmtree(folder, ignore_errors=True)
+
+    @staticmethod
+    def _scan(folder):
+        """
+        @return: the file count and the total size of folder, e.g. (files, size).
+        """
+        paths = [os.path.join(root, name) for root, _, files in os.walk(folder) for name in files]
+        return len(paths), sum(os.path.getsize(path) for path in paths if not os.path.islink(path))
+
+    def acquire(self, package, extract, variant=''):
+        """
+        Get the extracted tree of package, or extract it into cache if it is not cached.
+        The tree is in use until it is released by L{release}.
+        @param package: the package file.
+        @param extract: the function which extracts the package into the given folder, extract(dest_folder).
+        @param variant: the name of extraction, e.g. the member filter, for the different trees of one package.
+        @return: the folder of extracted tree, which should not be modified.
+        """
+        key = hashlib.sha1('{}\n{}'.format(self._get_digest(package), variant)).hexdigest()
+        tree = self._tree_path(key)
+        with self._lock():
+            index = self._load_index()
+            entry = index['trees'].get(key)
+            if entry and os.path.isdir(tree):
+                refs = [pid for pid in entry['refs'] if self._is_alive(pid)]
+                if refs or self._scan(tree) == (entry.get('files'), entry['size']):
+                    entry['refs'] = refs + [os.getpid()]
+                    entry['last_used'] = time.time()
+                    self._save_index(index)
+                    logger.info('Found the extracted {} in cache: {}'.format(package, tree))
+                    return tree
+                logger.warning('The extracted {} in cache was modified, extract it again.'.format(package))
+                self._remove_tree(tree)
+                del index['trees'][key]
+                self._save_index(index)
+        # extract out of lock, then rename, so the tree is never half extracted
+        tmp_tree = '{}.{}.{}.tmp'.format(tree, os.getpid(), threading.current_thread().ident)
+        self._remove_tree(tmp_tree)
+        os.makedirs(tmp_tree)
+        try:
+            extract(tmp_tree)
+            files, size = self._scan(tmp_tree)
+        except:
+            self._remove_tree(tmp_tree)
+            raise
+        with self._lock():
+            index = self._load_index()
+            if os.path.isdir(tree):
+                # extracted by other process at the same time
+                self._remove_tree(tmp_tree)
+            else:
+                os.rename(tmp_tree, tree)
+            entry = index['trees'].setdefault(key, {'package': os.path.abspath(package), 'variant': variant,
+                                                    'files': files, 'size': size, 'refs': []})
+            entry['refs'].append(os.getpid())
+            entry['last_used'] = time.time()
+            self._evict(index)
+            self._save_index(index)
+        logger.info('Extracted {} into cache: {}'.format(package, tree))
+        return tree
+
+    def release(self, tree):
+        """
+        Release the tree which is acquired by this process.
+        """
+        key = os.path.basename(tree)
+        with self._lock():
+            index = self._load_index()
+            entry = index['trees'].get(key)
+            if entry and os.getpid() in entry['refs']:
+                entry['refs'].remove(os.getpid())
+                entry['last_used'] = time.time()
+            self._evict(index)
+            self._save_index(index)
+
+    @contextlib.contextmanager
+    def open(self, package, extract, variant=''):
+        """
+        The context manager of L{acquire} and L{release}.
+        """
+        tree = self.acquire(package, extract, variant)
+        try:
+            yield tree
+        finally:
+            self.release(tree)
+
+    def _evict(self, index):
+        """
+        Remove the least recently used trees, which are not in use, until the total size is not over max_size.
+        The caller should hold the lock.
+        """
+        trees = index['trees']
+        for entry in trees.values():
+            # the processes which are killed can not release their trees
+            entry['refs'] = [pid for pid in entry['refs'] if self._is_alive(pid)]
+        total_size = sum(entry['size'] for entry in trees.values())
+        for key, entry in sorted(trees.items(), key=lambda item: item[1]['last_used']):
+            if total_size <= self.max_size:
+                break
+            if entry['refs']:
+                continue
+            logger.info('Evict the extracted {} from cache.'.format(entry['package']))
+            self._remove_tree(self._tree_path(key))
+            total_size -= entry['size']
+            del trees[key]
+
+    def total_size(self):
+        with self._lock():
+            return sum(entry['size'] for entry in self._load_index()['trees'].values())
@@ -0,0 +1,155 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import logging
+import tarfile
+import zipfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PackageInspector(object):
+    """
+    Check the B2G image, Gaia package, and Gecko package, by the magic member of the requested type.
+    The results are kept in one small index file keyed by the path, size, mtime and type,
+    so the same files are not opened again.
+
+        >>> inspector = PackageInspector()
+        >>> inspector.check('/tmp/b2g-45.0a1.en-US.android-arm.tar.gz', PackageInspector.GECKO)
+        True
+    """
+
+    IMAGE = 'image'
+    GAIA = 'gaia'
+    GECKO = 'gecko'
+
+    # the package type, the file extension, and the magic member
+    _RULES = [(IMAGE, '.zip', 'b2g-distro/'),
+              (GAIA, '.zip', 'gaia/profile/'),
+              (GECKO, '.tar.gz', 'b2g')]
+
+    DEFAULT_INDEX_FILE = os.path.join(os.path.expanduser('~'), '.b2g_util', 'package_index.json')
+    MAX_ENTRIES = 1000
+
+    def __init__(self, index_file=None):
+        """
+        @param index_file: the index file, which will be created if it does not exist. (optional)
+        """
+        self.index_file = index_file or self.DEFAULT_INDEX_FILE
+        self.lock = threading.Lock()
+        self.index = None
+
+    @classmethod
+    def _get_rule(cls, package_type):
+        for rule in cls._RULES:
+            if rule[0] == package_type:
+                return rule
+        raise ValueError('Unknown package type {}.'.format(package_type))
+
+    @staticmethod
+    def _has_zip_member(file_path, magic):
+        with zipfile.ZipFile(file_path, 'r') as f:
+            # only the central directory is read, and no member is inflated
+            try:
+                f.getinfo(magic)
+                return True
+            except KeyError:
+                return False
+
+    @staticmethod
+    def _has_tar_member(file_path, magic):
+        # read the tar as stream, and stop at the matching member instead of decompressing the whole file
+        with tarfile.open(file_path, 'r|*') as f:
+            for tarinfo in f:
+                if tarinfo.name == magic:
+                    return True
+        return False
+
+    def _inspect(self, file_path, package_type):
+        """
+        @param file_path: the package file.
+        @param package_type: PackageInspector.IMAGE, GAIA, or GECKO.
+        @return: True if the file has the magic member of the package type.
+        """
+        _, extension, magic = self._get_rule(package_type)
+        if not file_path.endswith(extension):
+            return False
+        has_member = self._has_zip_member if extension == '.zip' else self._has_tar_member
+        try:
+            return has_member(file_path, magic)
+        except Exception as e:
+            logger.debug('cannot open {}: {}'.format(file_path, e))
+            return False
+
+    def _load_index(self):
+        if self.index is None:
+            self.index = {}
+            if os.path.isfile(self.index_file):
+                try:
+                    with open(self.index_file, 'r') as f:
+                        self.index = json.load(f)
+                except ValueError:
+                    logger.debug('Ignore the broken index {}.'.format(self.index_file))
+        return self.index
+
+    def _save_index(self):
+        # keep the recent entries of the files which still exist
+        entries = sorted(((path, entry) for path, entry in self.index.items() if os.path.isfile(path)),
+                         key=lambda item: item[1]['mtime'], reverse=True)
+        self.index = dict(entries[:self.MAX_ENTRIES])
+        try:
+            index_dir = os.path.dirname(self.index_file)
+            if index_dir and not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            tmp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(self.index, f, indent=4, sort_keys=True)
+            if os.name == 'nt' and os.path.isfile(self.index_file):
+                os.remove(self.index_file)
+            os.rename(tmp_file, self.index_file)
+        except (IOError, OSError) as e:
+            logger.debug('Can not save the index {}: {}'.format(self.index_file, e))
+
+    def check(self, file_path, package_type):
+        """
+        @param file_path: the package file.
+        @param package_type: PackageInspector.IMAGE, GAIA, or GECKO.
+        @return: True if the file is the package of the given type.
+        """
+        if not os.path.isfile(file_path):
+            return False
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self.lock:
+            entry = self._load_index().get(file_path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and \
+                    package_type in entry.get('types', {}):
+                logger.debug('{} is {}{} in index.'.format(file_path, '' if entry['types'][package_type] else 'not ',
+                                                           package_type))
+                return entry['types'][package_type]
+        result = self._inspect(file_path, package_type)
+        with self.lock:
+            entry = self._load_index().get(file_path)
+            if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime or 'types' not in entry:
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'types': {}}
+                self.index[file_path] = entry
+            entry['types'][package_type] = result
+            self._save_index()
+        return result
+
+    def classify(self, file_path):
+        """
+        A file may match more than one type, e.g. an image zip which also has the Gaia profile,
+        then the first one of IMAGE, GAIA and GECKO is returned. Use L{check} for the given type.
+
+        @param file_path: the package file.
+        @return: PackageInspector.IMAGE, GAIA, GECKO, or None if it is not B2G package.
+        """
+        for package_type, _, _ in self._RULES:
+            if self.check(file_path, package_type):
+                return package_type
+        return None
@@ -0,0 +1,231 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sys
+import Queue
+import logging
+import time
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class Future(object):
+    """
+    The result of the task which is running in L{WorkerPool}.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self, timeout=None):
+        """
+        @return: the exception raised by the task, or None.
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def result(self, timeout=None):
+        """
+        Wait for the task.
+        @param timeout: the timeout in seconds. Default is None (blocking).
+        @return: the return value of the task.
+        @raise exception: the exception raised by the task, or when running for more than timeout seconds.
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _wait(self, timeout):
+        # Event.wait(None) cannot be interrupted by Ctrl+C on Python 2, so wait in short periods
+        if timeout is None:
+            while not self._event.wait(1):
+                pass
+        elif not self._event.wait(timeout):
+            raise Exception('Task timeout, timeout {}'.format(timeout))
+
+
+class WorkerPool(object):
+    """
+    The pool of worker threads with bounded concurrency.
+    The ADB commands spend most of time on subprocess and socket I/O, which release the GIL.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        @param max_workers: the max number of running tasks.
+        """
+        if max_workers < 1:
+            raise Exception('max_workers should be larger than 0, not {}.'.format(max_workers))
+        self.max_workers = max_workers
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in worker thread.
+        @return: L{Future} object.
+        """
+        future = Future()
+        self.tasks.put((future, func, args, kwargs))
+        with self.lock:
+            if len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        return future
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            future, func, args, kwargs = task
+            try:
+                future.set_result(func(*args, **kwargs))
+            except:
+                logger.debug('Task {} failed: {}'.format(func, sys.exc_info()[1]))
+                future.set_exc_info(sys.exc_info())
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads after all submitted tasks are done.
+        """
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for _ in threads:
+            self.tasks.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def gather(tasks, max_workers=DEFAULT_MAX_WORKERS, return_exceptions=False):
+    """
+    Run the tasks concurrently with bounded worker threads.
+
+        >>> gather([lambda: 1, lambda: 2])
+        [1, 2]
+        >>> gather([(VersionChecker.get_device_info, {'serial': s}) for s in serials], max_workers=4)
+
+    @param tasks: the list of callable, or (callable, kwargs) tuple.
+    @param max_workers: the max number of running tasks.
+    @param return_exceptions: put the exception into results instead of raising it.
+    @return: the results in the same order of tasks.
+    @raise exception: the first exception raised by tasks, if return_exceptions is False.
+    """
+    pool = WorkerPool(max_workers=max_workers)
+    try:
+        futures = []
+        for task in tasks:
+            if isinstance(task, tuple):
+                func, kwargs = task
+            else:
+                func, kwargs = task, {}
+            futures.append(pool.submit(func, **kwargs))
+        results = []
+        for future in futures:
+            if return_exceptions:
+                exception = future.exception()
+                results.append(exception if exception is not None else future.result())
+            else:
+                results.append(future.result())
+        return results
+    finally:
+        pool.shutdown(wait=False)
+
+
+class Pipeline(object):
+    """
+    Run the stages concurrently, each stage starts when the stages it depends on are done.
+    The stage function gets the results of its dependencies as keyword arguments.
+
+        >>> pipeline = Pipeline()
+        >>> pipeline.add_stage('extract', lambda: extract(package))
+        >>> pipeline.add_stage('clean', clean_device)
+        >>> pipeline.add_stage('push', lambda extract, clean: push(extract), depends=['extract', 'clean'])
+        >>> pipeline.run()
+        >>> pipeline.timings
+        {'extract': 3.2, 'clean': 1.1, 'push': 20.5}
+    """
+
+    def __init__(self):
+        # the list of (name, func, depends)
+        self.stages = []
+        # {name: result} of the stages which are done
+        self.results = {}
+        # {name: seconds} of the stages which were run, without waiting for dependencies
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, func, depends=None):
+        """
+        @param name: the stage name.
+        @param func: the function of stage, func(**results_of_depends).
+        @param depends: the names of stages which should be done before this stage, and were added before.
+        """
+        depends = depends or []
+        names = [stage[0] for stage in self.stages]
+        if name in names:
+            raise Exception('Stage {} exists.'.format(name))
+        for depend in depends:
+            if depend not in names:
+                raise Exception('Stage {} depends on unknown stage {}.'.format(name, depend))
+        self.stages.append((name, func, depends))
+
+    def _run_stage(self, futures, name, func, depends):
+        # the stage fails when its dependency fails
+        kwargs = dict((depend, futures[depend].result()) for depend in depends)
+        start_time = time.time()
+        try:
+            result = func(**kwargs)
+        finally:
+            with self.lock:
+                self.timings[name] = time.time() - start_time
+        with self.lock:
+            self.results[name] = result
+        return result
+
+    def run(self):
+        """
+        Run all stages, and wait for them.
+        @return: the results of stages as dict {name: result}.
+        @raise exception: the exception of the first failed stage, after all stages are done or skipped.
+        """
+        # every stage has its own worker, since it blocks on the dependencies
+        pool = WorkerPool(max_workers=max(len(self.stages), 1))
+        try:
+            futures = {}
+            for name, func, depends in self.stages:
+                futures[name] = pool.submit(self._run_stage, futures, name, func, depends)
+            exceptions = [futures[name].exception() for name, _, _ in self.stages]
+            # the dependencies are added before, so the first failed stage is the cause
+            for (name, _, _), exception in zip(self.stages, exceptions):
+                if exception is not None:
+                    futures[name].result()
+            return dict(self.results)
+        finally:
+            pool.shutdown(wait=False)
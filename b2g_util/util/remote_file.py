@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import os
+import logging
+from adb_helper import AdbWrapper
+
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteFile(object):
+    """
+    The read-only, seekable file object of one device file.
+
+    It reads the byte ranges on demand by "dd skip= count=" over "exec-out", and caches the blocks,
+    so zipfile can read the central directory and one member without pulling the whole file.
+    When the device can not serve the ranged reads, or the size of file can not be read,
+    it pulls the whole file into memory once.
+
+        >>> with RemoteFile('/system/b2g/webapps/settings.gaiamobile.org/application.zip') as f:
+        ...     zipfile.ZipFile(f).read('resources/gaia_commit.txt')
+    """
+
+    DEFAULT_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, path, serial=None, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        @param path: the remote file path.
+        @param serial: device serial number. (optional)
+        @param block_size: the size of each ranged read.
+        @raise exception: When the remote file does not exist.
+        """
+        self.path = path
+        self.serial = serial
+        self.block_size = block_size
+        self.position = 0
+        self.blocks = {}
+        # the whole file content, when the ranged read is not available
+        self.content = None
+        # the bytes transferred from device
+        self.transferred = 0
+        self.closed = False
+        try:
+            self.size = AdbWrapper.adb_file_size(path, serial=serial)
+        except Exception as e:
+            logger.debug(e)
+            logger.debug('Can not get the size of {}, pull the whole file.'.format(path))
+            self._pull_content()
+            self.size = len(self.content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.blocks = {}
+        self.content = None
+        self.closed = True
+        logger.debug('Close {}, transferred {} of {} bytes.'.format(self.path, self.transferred, self.size))
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise IOError('Invalid whence ({}).'.format(whence))
+        if position < 0:
+            raise IOError('Invalid offset ({}).'.format(offset))
+        self.position = position
+        return self.position
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        if self.position >= end:
+            return ''
+        if self.content is None:
+            try:
+                data = self._read_range(self.position, end)
+            except Exception as e:
+                logger.debug(e)
+                logger.debug('Can not read {} by range, pull the whole file.'.format(self.path))
+                self._pull_content()
+        if self.content is not None:
+            data = self.content[self.position:end]
+        self.position = end
+        return data
+
+    def _read_range(self, start, end):
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+        missing = [index for index in range(first_block, last_block + 1) if index not in self.blocks]
+        # fetch each run of contiguous missing blocks by one command
+        while missing:
+            run_start = missing[0]
+            run_length = 1
+            while run_length < len(missing) and missing[run_length] == run_start + run_length:
+                run_length += 1
+            self._fetch_blocks(run_start, run_length)
+            missing = missing[run_length:]
+        data = ''.join(self.blocks[index] for index in range(first_block, last_block + 1))
+        offset = first_block * self.block_size
+        return data[start - offset:end - offset]
+
+    def _fetch_blocks(self, first_block, count):
+        command = 'dd if={} bs={} skip={} count={} 2>/dev/null'.format(self.path, self.block_size, first_block, count)
+        data = AdbWrapper.adb_exec_out(command, serial=self.serial)
+        self.transferred += len(data)
+        expected_size = min(count * self.block_size, self.size - first_block * self.block_size)
+        if len(data) != expected_size:
+            raise Exception('Ranged read of {} returns {} bytes, expected {} bytes.'.format(
+                self.path, len(data), expected_size))
+        for index in range(count):
+            self.blocks[first_block + index] = data[index * self.block_size:(index + 1) * self.block_size]
+
+    def _pull_content(self):
+        f = io.BytesIO()
+        self.transferred += AdbWrapper.adb_pull_fileobj(self.path, f, serial=self.serial)
+        self.content = f.getvalue()
+        self.blocks = {}
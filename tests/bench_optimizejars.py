@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmark the wall-clock and peak RSS of optimizejars.py on a large synthetic jar.
+
+    $ python tests/bench_optimizejars.py --members 20000 --size 200
+    $ python tests/bench_optimizejars.py --script /path/to/old/optimizejars.py
+
+Each mode runs the script in a child process, so the peak RSS of one run is not affected by others.
+"""
+
+import os
+import sys
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import subprocess
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCRIPT = os.path.normpath(os.path.join(CURRENT_DIR, os.pardir, 'b2g_util', 'misc', 'optimizejars.py'))
+
+
+def make_jar(path, members, size_mb):
+    """
+    Create the jar with stored random members, which total size is about size_mb MB.
+    @return: the names of members.
+    """
+    member_size = max(1, size_mb * 1024 * 1024 // members)
+    names = []
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        for index in range(members):
+            name = 'chrome/content/{}/file_{}.js'.format(index % 100, index)
+            z.writestr(name, os.urandom(member_size))
+            names.append(name)
+    return names
+
+
+def run(script, mode, log_dir, in_dir, out_dir):
+    """
+    Run optimizejars.py in child process.
+    @return: the wall-clock seconds, and the peak RSS in MB.
+    """
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen([sys.executable, script, mode, log_dir, in_dir, out_dir], stdout=devnull)
+        _, status, rusage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise Exception('{} {} exits with {}.'.format(script, mode, status))
+    # ru_maxrss is in KB on Linux
+    return elapsed, rusage.ru_maxrss / 1024.0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark optimizejars.py on a large synthetic jar.')
+    arg_parser.add_argument('--script', action='store', dest='script', default=DEFAULT_SCRIPT,
+                            help='The optimizejars.py to benchmark.')
+    arg_parser.add_argument('--members', action='store', type=int, dest='members', default=20000,
+                            help='The number of members in jar.')
+    arg_parser.add_argument('--size', action='store', type=int, dest='size', default=200,
+                            help='The total size (MB) of members.')
+    args = arg_parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_optimizejars_')
+    try:
+        dirs = {}
+        for name in ('in', 'log', 'optimized', 'deoptimized', 'deoptimized_log'):
+            dirs[name] = os.path.join(tmp_dir, name)
+            os.makedirs(dirs[name])
+        names = make_jar(os.path.join(dirs['in'], 'omni.ja'), args.members, args.size)
+        # the first 10% members are the startup data
+        with open(os.path.join(dirs['log'], 'omni.ja.log'), 'w') as f:
+            f.write('\n'.join(names[::10]))
+        jar_size = os.path.getsize(os.path.join(dirs['in'], 'omni.ja')) / 1024.0 / 1024.0
+        print('{}: {} members, {:.1f} MB'.format(args.script, args.members, jar_size))
+        elapsed, rss = run(args.script, '--optimize', dirs['log'], dirs['in'], dirs['optimized'])
+        print('--optimize    {:8.2f} s  {:8.1f} MB peak RSS'.format(elapsed, rss))
+        elapsed, rss = run(args.script, '--deoptimize', dirs['deoptimized_log'], dirs['optimized'],
+                           dirs['deoptimized'])
+        print('--deoptimize  {:8.2f} s  {:8.1f} MB peak RSS'.format(elapsed, rss))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
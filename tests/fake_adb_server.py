@@ -0,0 +1,331 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import stat
+import select
+import socket
+import struct
+import threading
+import subprocess
+import SocketServer
+
+
+class FakeDevice(object):
+    """
+    The fake device of FakeAdbServer, which has an in-memory file system.
+    """
+
+    def __init__(self, serial, state='device'):
+        self.serial = serial
+        self.state = state
+        # {path: (mode, data)}
+        self.files = {}
+        self.shell_commands = []
+        # shell_handler(command) => output
+        self.shell_handler = lambda command: '0\r\n'
+        # exec_handler(command) => raw output, the "exec:" service is not supported when it is None
+        self.exec_handler = None
+        # exec_in_handler(command, stdin) => raw output, the "exec:" service reads stdin when it is not None
+        self.exec_in_handler = None
+        # the interactive shell is backed by /bin/sh of host
+        self.shell_sessions = 0
+        self.shell_sockets = []
+
+    def reboot(self):
+        """
+        Close all streams of interactive shell, like the device was rebooted.
+        """
+        for sock in self.shell_sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.shell_sockets = []
+
+    def add_file(self, path, data, mode=0644):
+        self.files[path] = (stat.S_IFREG | mode, data)
+
+    def is_dir(self, path):
+        prefix = path.rstrip('/') + '/'
+        return path == '/' or any(f.startswith(prefix) for f in self.files)
+
+    def stat(self, path):
+        if path in self.files:
+            return self.files[path][0], len(self.files[path][1])
+        if self.is_dir(path):
+            return stat.S_IFDIR | 0755, 0
+        return 0, 0
+
+    def list(self, path):
+        prefix = path.rstrip('/') + '/'
+        entries = {}
+        for f in self.files:
+            if f.startswith(prefix):
+                name = f[len(prefix):].split('/')[0]
+                entries[name] = self.stat(prefix + name)
+        return entries
+
+
+class FakeAdbServer(SocketServer.ThreadingTCPServer):
+    """
+    The fake ADB server for testing, listens on localhost with random port.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeAdbHandler)
+        self.port = self.server_address[1]
+        self.devices = {}
+        self.forwards = []
+        self.requests = []
+        # the track-devices streams are closed when the generation changes, and refused if not allowed
+        self.track_generation = 0
+        self.allow_tracking = True
+        self.lock = threading.Condition()
+        self.thread = None
+
+    def add_device(self, serial, state='device'):
+        device = FakeDevice(serial, state)
+        with self.lock:
+            self.devices[serial] = device
+            self.lock.notify_all()
+        return device
+
+    def set_state(self, serial, state):
+        with self.lock:
+            self.devices[serial].state = state
+            self.lock.notify_all()
+
+    def remove_device(self, serial):
+        with self.lock:
+            del self.devices[serial]
+            self.lock.notify_all()
+
+    def drop_trackers(self, allow_tracking=True):
+        with self.lock:
+            self.track_generation += 1
+            self.allow_tracking = allow_tracking
+            self.lock.notify_all()
+
+    def devices_payload(self):
+        return ''.join('{}\t{}\n'.format(s, d.state) for s, d in sorted(self.devices.items()))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeAdbHandler(SocketServer.BaseRequestHandler):
+
+    def _read(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _read_request(self):
+        length = int(self._read(4), 16)
+        request = self._read(length)
+        self.server.requests.append(request)
+        return request
+
+    def _okay(self, payload=None):
+        if payload is None:
+            self.request.sendall('OKAY')
+        else:
+            self.request.sendall('OKAY%04x%s' % (len(payload), payload))
+
+    def _fail(self, message):
+        self.request.sendall('FAIL%04x%s' % (len(message), message))
+
+    def handle(self):
+        try:
+            request = self._read_request()
+            if request == 'host:version':
+                self._okay('%04x' % 31)
+            elif request == 'host:devices':
+                self._okay(self.server.devices_payload())
+            elif request == 'host:track-devices':
+                self._track_devices()
+            elif request == 'host:list-forward':
+                self._okay(''.join('{} {} {}\n'.format(*f) for f in self.server.forwards))
+            elif request == 'host:killforward-all':
+                del self.server.forwards[:]
+                self.request.sendall('OKAYOKAY')
+            elif ':forward:' in request or ':killforward:' in request:
+                self._forward(request)
+            elif request.startswith('host:transport'):
+                self._transport(request)
+            else:
+                self._fail('unknown host service')
+        except EOFError:
+            pass
+
+    def _track_devices(self):
+        with self.server.lock:
+            if not self.server.allow_tracking:
+                self._fail('cannot track devices')
+                return
+            generation = self.server.track_generation
+        self._okay()
+        last = None
+        while True:
+            # stop when the client closed the connection
+            if select.select([self.request], [], [], 0)[0] and not self.request.recv(1):
+                return
+            with self.server.lock:
+                if generation != self.server.track_generation:
+                    return
+                payload = self.server.devices_payload()
+                if payload == last:
+                    self.server.lock.wait(0.1)
+                    continue
+            last = payload
+            try:
+                self.request.sendall('%04x%s' % (len(payload), payload))
+            except Exception:
+                return
+
+    def _forward(self, request):
+        prefix, service = request.split(':forward:', 1) if ':forward:' in request else (None, None)
+        if service is not None:
+            serial = prefix.split(':')[1] if prefix.startswith('host-serial') else 'any'
+            if service.startswith('norebind:'):
+                service = service[len('norebind:'):]
+            local, remote = service.split(';')
+            self.server.forwards.append((serial, local, remote))
+        else:
+            local = request.split(':killforward:', 1)[1]
+            self.server.forwards[:] = [f for f in self.server.forwards if f[1] != local]
+        self.request.sendall('OKAYOKAY')
+
+    def _transport(self, request):
+        devices = self.server.devices
+        if request == 'host:transport-any':
+            online = [d for d in devices.values() if d.state == 'device']
+            device = online[0] if len(online) == 1 else None
+            if device is None:
+                return self._fail('more than one device/emulator' if online else 'device not found')
+        else:
+            device = devices.get(request.split(':', 2)[2])
+            if device is None:
+                return self._fail('device \'{}\' not found'.format(request.split(':', 2)[2]))
+        self._okay()
+        service = self._read_request()
+        if service == 'shell:':
+            self._okay()
+            self._interactive_shell(device)
+        elif service.startswith('shell:'):
+            self._okay()
+            command = service[len('shell:'):]
+            device.shell_commands.append(command)
+            self.request.sendall(device.shell_handler(command))
+        elif service.startswith('exec:') and device.exec_in_handler is not None:
+            self._okay()
+            command = service[len('exec:'):]
+            device.shell_commands.append(command)
+            chunks = []
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            output = device.exec_in_handler(command, ''.join(chunks))
+            try:
+                self.request.sendall(output)
+            except socket.error:
+                pass
+        elif service.startswith('exec:') and device.exec_handler is not None:
+            self._okay()
+            command = service[len('exec:'):]
+            device.shell_commands.append(command)
+            self.request.sendall(device.exec_handler(command))
+        elif service == 'root:':
+            self._okay()
+            self.request.sendall('adbd is already running as root\n')
+        elif service == 'remount:':
+            self._okay()
+            self.request.sendall('remount succeeded\n')
+        elif service == 'sync:':
+            self._okay()
+            self._sync(device)
+        else:
+            self._fail('unknown service')
+
+    def _interactive_shell(self, device):
+        device.shell_sessions += 1
+        device.shell_sockets.append(self.request)
+        p = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        def pump_output():
+            while True:
+                data = p.stdout.readline()
+                if not data:
+                    break
+                try:
+                    self.request.sendall(data)
+                except socket.error:
+                    break
+        thread = threading.Thread(target=pump_output)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                data = self.request.recv(4096)
+                if not data:
+                    break
+                p.stdin.write(data)
+                p.stdin.flush()
+        except socket.error:
+            pass
+        finally:
+            p.stdin.close()
+            p.wait()
+            thread.join()
+
+    def _sync(self, device):
+        while True:
+            request_id = self._read(4)
+            length = struct.unpack('<I', self._read(4))[0]
+            path = self._read(length) if request_id != 'QUIT' else ''
+            if request_id == 'QUIT':
+                return
+            elif request_id == 'STAT':
+                mode, size = device.stat(path)
+                self.request.sendall('STAT' + struct.pack('<III', mode, size, 0))
+            elif request_id == 'LIST':
+                for name, (mode, size) in sorted(device.list(path).items()):
+                    self.request.sendall('DENT' + struct.pack('<IIII', mode, size, 0, len(name)) + name)
+                self.request.sendall('DONE' + struct.pack('<IIII', 0, 0, 0, 0))
+            elif request_id == 'RECV':
+                if path not in device.files:
+                    message = 'No such file or directory'
+                    self.request.sendall('FAIL' + struct.pack('<I', len(message)) + message)
+                    continue
+                data = device.files[path][1]
+                for i in range(0, len(data), 65536):
+                    chunk = data[i:i + 65536]
+                    self.request.sendall('DATA' + struct.pack('<I', len(chunk)) + chunk)
+                self.request.sendall('DONE' + struct.pack('<I', 0))
+            elif request_id == 'SEND':
+                remote_path, mode = path.rsplit(',', 1)
+                chunks = []
+                while True:
+                    data_id = self._read(4)
+                    size = struct.unpack('<I', self._read(4))[0]
+                    if data_id == 'DONE':
+                        break
+                    chunks.append(self._read(size))
+                device.files[remote_path] = (int(mode), ''.join(chunks))
+                self.request.sendall('OKAY' + struct.pack('<I', 0))
@@ -0,0 +1,85 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+class FakeHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    The fake HTTP server for testing, listens on localhost with random port, and serves the in-memory files.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, support_range=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHttpHandler)
+        self.port = self.server_address[1]
+        self.support_range = support_range
+        # {path: data}
+        self.files = {}
+        # the list of (path, "Range" header)
+        self.requests = []
+        self.served_bytes = 0
+        # close the connection after sending this many bytes of body, then reset to None
+        self.fail_after = None
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.port, path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path.split('?')[0])
+        range_header = self.headers.getheader('Range')
+        with server.lock:
+            server.requests.append((self.path, range_header))
+        if data is None:
+            self.send_error(404)
+            return
+        match = re.match(r'^bytes=(\d+)-(\d*)$', range_header or '')
+        if server.support_range and match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_error(416)
+                return
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"{}"'.format(hash(data)))
+        self.end_headers()
+        with server.lock:
+            fail_after = server.fail_after
+            if fail_after is not None and fail_after < len(body):
+                server.fail_after = None
+                body = body[:fail_after]
+            else:
+                fail_after = None
+            server.served_bytes += len(body)
+        self.wfile.write(body)
+        if fail_after is not None:
+            self.close_connection = 1
@@ -0,0 +1,408 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import os
+import mock
+import stat
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+
+from b2g_util.util.adb_client import AdbClient
+from b2g_util.util.adb_helper import AdbWrapper
+from fake_adb_server import FakeAdbServer
+
+
+def run_local_script(script, stdin=None):
+    p = subprocess.Popen(['/bin/sh', '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return p.communicate(stdin)[0]
+
+
+class AdbClientTester(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.device = self.server.add_device('foo')
+        AdbWrapper.set_backend(AdbWrapper.BACKEND_SOCKET, port=self.server.port)
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+
+    def test_version(self):
+        """
+        Test version.
+        """
+        ret = AdbClient(port=self.server.port).version()
+        self.assertEqual(ret, 31, 'The result should be 31, not {}.'.format(ret))
+
+    def test_devices(self):
+        """
+        Test devices.
+        """
+        self.server.add_device('askeing', 'offline')
+        expected_ret = {'foo': 'device', 'askeing': 'offline'}
+        devices = AdbWrapper.adb_devices()
+        self.assertEqual(devices, expected_ret,
+                         'The result should be {}, not {}.'.format(expected_ret, devices))
+
+    def test_shell(self):
+        """
+        Test shell.
+        """
+        self.device.shell_handler = lambda command: 'test_result\r\n1\r\n'
+        ret, retcode = AdbWrapper.adb_shell('b2g-test', serial='foo')
+        self.assertEqual(ret, 'test_result', 'The result should be test_result, not {}.'.format(ret))
+        self.assertEqual(retcode, 1, 'The return code should be 1, not {}.'.format(retcode))
+        self.assertEqual(self.device.shell_commands, ['b2g-test; echo $?'])
+
+    def test_shell_fail(self):
+        """
+        Test shell on the device which does not exist.
+        """
+        with self.assertRaises(Exception):
+            AdbWrapper.adb_shell('b2g-test', serial='bar')
+
+    def test_root_and_remount(self):
+        """
+        Test root and remount.
+        """
+        self.assertTrue(AdbWrapper.adb_root(serial='foo'), 'The result should be True.')
+        self.assertTrue(AdbWrapper.adb_remount(serial='foo'), 'The result should be True.')
+
+    def test_push_pull_file(self):
+        """
+        Test push and pull one file.
+        """
+        local_file = os.path.join(self.tmp_dir, 'mozilla.test')
+        with open(local_file, 'wb') as f:
+            f.write('\x00\r\n' * 50000)
+        AdbWrapper.adb_push(local_file, '/b2g/', serial='foo')
+        self.assertEqual(self.device.files['/b2g/mozilla.test'][1], '\x00\r\n' * 50000)
+        pull_dir = os.path.join(self.tmp_dir, 'pull')
+        os.makedirs(pull_dir)
+        ret = AdbWrapper.adb_pull('/b2g/mozilla.test', pull_dir, serial='foo')
+        self.assertIn('150000 bytes', ret)
+        with open(os.path.join(pull_dir, 'mozilla.test'), 'rb') as f:
+            self.assertEqual(f.read(), '\x00\r\n' * 50000)
+
+    def test_push_pull_folder(self):
+        """
+        Test push and pull folder recursively.
+        """
+        source_dir = os.path.join(self.tmp_dir, 'b2g')
+        os.makedirs(os.path.join(source_dir, 'defaults', 'pref'))
+        with open(os.path.join(source_dir, 'b2g'), 'wb') as f:
+            f.write('elf')
+        with open(os.path.join(source_dir, 'defaults', 'pref', 'user.js'), 'wb') as f:
+            f.write('pref')
+        AdbWrapper.adb_push(source_dir, '/system/b2g/', serial='foo')
+        self.assertEqual(sorted(self.device.files.keys()),
+                         ['/system/b2g/b2g', '/system/b2g/defaults/pref/user.js'])
+        pull_dir = os.path.join(self.tmp_dir, 'pull')
+        ret = AdbWrapper.adb_pull('/system/b2g', pull_dir, serial='foo')
+        self.assertIn('2 files pulled', ret)
+        with open(os.path.join(pull_dir, 'defaults', 'pref', 'user.js'), 'rb') as f:
+            self.assertEqual(f.read(), 'pref')
+
+    def test_push_pull_fileobj_with_progress(self):
+        """
+        Test push and pull file object chunk by chunk with progress callback.
+        """
+        data = 'b2g' * 50000
+        push_progress = []
+        ret = AdbWrapper.adb_push_fileobj(io.BytesIO(data), '/system/b2g/application.ini', serial='foo',
+                                          progress_callback=lambda **kwargs: push_progress.append(kwargs),
+                                          total_size=len(data))
+        self.assertEqual(ret, len(data))
+        self.assertEqual(self.device.files['/system/b2g/application.ini'][1], data)
+        self.assertEqual(push_progress[0], {'current_byte': 65536, 'total_size': len(data)})
+        self.assertEqual(push_progress[-1], {'current_byte': len(data), 'total_size': len(data)})
+        pull_progress = []
+        f = io.BytesIO()
+        ret = AdbWrapper.adb_pull_fileobj('/system/b2g/application.ini', f, serial='foo',
+                                          progress_callback=lambda **kwargs: pull_progress.append(kwargs))
+        self.assertEqual(ret, len(data))
+        self.assertEqual(f.getvalue(), data)
+        self.assertEqual([p['current_byte'] for p in pull_progress], [65536, 131072, len(data)])
+        self.assertTrue(all(p['total_size'] == len(data) for p in pull_progress))
+
+    def test_pull_folder_with_progress(self):
+        """
+        Test the progress of pulling folder is the sum of all files.
+        """
+        self.device.add_file('/data/b2g/a', 'a' * 10)
+        self.device.add_file('/data/b2g/b', 'b' * 20)
+        progress = []
+        AdbWrapper.adb_pull('/data/b2g', self.tmp_dir, serial='foo',
+                            progress_callback=lambda **kwargs: progress.append(kwargs))
+        self.assertEqual(progress, [{'current_byte': 10, 'total_size': 30}, {'current_byte': 30, 'total_size': 30}])
+
+    def _run_on_host(self, device_dir):
+        """
+        Run the commands of device on host, the device folders are mapped into the host folders.
+        @return: the host folder of the temp files of device.
+        """
+        device_tmp_dir = os.path.join(self.tmp_dir, 'device_tmp')
+        os.makedirs(device_tmp_dir)
+
+        def to_host(command):
+            # the staged archives are pushed into the in-memory file system of fake device
+            for path in [path for path in self.device.files if path.startswith(AdbWrapper.REMOTE_ARCHIVE_DIR)]:
+                with open(os.path.join(device_tmp_dir, os.path.basename(path)), 'wb') as f:
+                    f.write(self.device.files[path][1])
+            return command.replace('/system/b2g/', device_dir).replace(AdbWrapper.REMOTE_ARCHIVE_DIR, device_tmp_dir)
+        self.device.shell_handler = lambda command: run_local_script(to_host(command))
+        self.device.exec_in_handler = lambda command, stdin: run_local_script(to_host(command), stdin)
+        return device_tmp_dir
+
+    def _push_archive(self, exec_in=True):
+        source_dir = os.path.join(self.tmp_dir, 'b2g')
+        os.makedirs(os.path.join(source_dir, 'defaults', 'pref'))
+        with open(os.path.join(source_dir, 'b2g'), 'wb') as f:
+            f.write('elf')
+        os.chmod(os.path.join(source_dir, 'b2g'), 0755)
+        with open(os.path.join(source_dir, 'defaults', 'pref', 'user.js'), 'wb') as f:
+            f.write('pref')
+        os.chmod(os.path.join(source_dir, 'defaults', 'pref', 'user.js'), 0444)
+        AdbWrapper.device_tar_commands['foo'] = 'tar'
+        AdbWrapper.device_exec_in['foo'] = exec_in
+        try:
+            return AdbWrapper.adb_push_archive(source_dir, '/system/b2g/', serial='foo')
+        finally:
+            del AdbWrapper.device_tar_commands['foo']
+            del AdbWrapper.device_exec_in['foo']
+
+    def _assert_pushed_archive(self, device_dir):
+        with open(os.path.join(device_dir, 'defaults', 'pref', 'user.js'), 'rb') as f:
+            self.assertEqual(f.read(), 'pref')
+        self.assertTrue(os.access(os.path.join(device_dir, 'b2g'), os.X_OK), 'The exec bit should be kept.')
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(device_dir, 'defaults', 'pref', 'user.js')).st_mode), 0644,
+                         'The owner should be able to write the pushed file.')
+
+    def test_push_archive(self):
+        """
+        Test push folder as one tar stream, which is unpacked by the tar of device as it arrives.
+        """
+        device_dir = os.path.join(self.tmp_dir, 'device')
+        device_tmp_dir = self._run_on_host(device_dir)
+        self.assertTrue(self._push_archive())
+        self._assert_pushed_archive(device_dir)
+        self.assertEqual(self.device.files, {}, 'The archive should not be staged on device.')
+        self.assertEqual(os.listdir(device_tmp_dir), [], 'The temp files of device should be removed.')
+
+    def test_push_archive_staged(self):
+        """
+        Test push folder as one tar, which is staged on device when the device does not accept exec-in.
+        """
+        device_dir = os.path.join(self.tmp_dir, 'device')
+        self._run_on_host(device_dir)
+        self.assertTrue(self._push_archive(exec_in=False))
+        self._assert_pushed_archive(device_dir)
+        archives = [path for path in self.device.files if path.startswith(AdbWrapper.REMOTE_ARCHIVE_DIR)]
+        self.assertEqual(len(archives), 1)
+        self.assertIn('rm -f {}; echo $?'.format(archives[0]), self.device.shell_commands,
+                      'The staged archive should be removed.')
+
+    def test_push_archive_staged_fail(self):
+        """
+        Test the staged archive is removed when the push fails, and the folder is pushed file by file without space.
+        """
+        self._run_on_host(os.path.join(self.tmp_dir, 'device'))
+        with mock.patch.object(AdbWrapper, 'adb_push_fileobj', side_effect=Exception('device offline')) as push:
+            with self.assertRaises(Exception):
+                self._push_archive(exec_in=False)
+        remote_archive = push.call_args[0][1]
+        self.assertIn('rm -f {}; echo $?'.format(remote_archive), self.device.shell_commands)
+        shutil.rmtree(os.path.join(self.tmp_dir, 'b2g'))
+        with mock.patch.object(AdbWrapper, 'adb_free_space', return_value=1024):
+            self.assertFalse(self._push_archive(exec_in=False))
+        self.assertEqual(sorted(self.device.files.keys()), ['/system/b2g/b2g', '/system/b2g/defaults/pref/user.js'])
+
+    def test_remote_temp_dir(self):
+        """
+        Test the temp files are not put into the folder which is being pushed.
+        """
+        self.assertEqual(AdbWrapper._remote_temp_dir('/system/b2g'), '/data/local/tmp')
+        self.assertEqual(AdbWrapper._remote_temp_dir('/data/local'), '/data')
+        self.assertEqual(AdbWrapper._remote_temp_dir('/data/local/'), '/data')
+
+    def test_push_tar_stream(self):
+        """
+        Test push the members of one tar.gz stream under the prefix into the tar of device, without staging them.
+        """
+        package = io.BytesIO()
+        with tarfile.open(fileobj=package, mode='w:gz') as tar:
+            for name, data, mode in (('b2g/b2g', 'elf', 0755), ('b2g/defaults/pref/user.js', 'pref', 0644),
+                                     ('crashreporter/foo', 'foo', 0644)):
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                tarinfo.mode = mode
+                tar.addfile(tarinfo, io.BytesIO(data))
+        package.seek(0)
+        device_dir = os.path.join(self.tmp_dir, 'device')
+        self._run_on_host(device_dir)
+        AdbWrapper.device_tar_commands['foo'] = 'tar'
+        try:
+            AdbWrapper.device_exec_in['foo'] = False
+            self.assertIsNone(AdbWrapper.adb_push_tar_stream(package, '/system/b2g/', strip_prefix='b2g/',
+                                                             serial='foo'))
+            AdbWrapper.device_exec_in['foo'] = True
+            ret = AdbWrapper.adb_push_tar_stream(package, '/system/b2g/', strip_prefix='b2g/', serial='foo')
+        finally:
+            del AdbWrapper.device_tar_commands['foo']
+            del AdbWrapper.device_exec_in['foo']
+        self.assertEqual(ret, 2, 'Only the members under b2g/ should be pushed, not {}.'.format(ret))
+        self.assertEqual(sorted(os.listdir(device_dir)), ['b2g', 'defaults'])
+        with open(os.path.join(device_dir, 'defaults', 'pref', 'user.js'), 'rb') as f:
+            self.assertEqual(f.read(), 'pref')
+        self.assertTrue(os.access(os.path.join(device_dir, 'b2g'), os.X_OK), 'The exec bit should be kept.')
+        self.assertEqual(self.device.files, {}, 'The members should not be staged on device.')
+
+    def test_has_exec_in(self):
+        """
+        Test checking the device accepts the stdin of "exec:" service.
+        """
+        try:
+            self.assertFalse(AdbWrapper.has_exec_in(serial='foo'))
+            del AdbWrapper.device_exec_in['foo']
+            self.device.exec_in_handler = lambda command, stdin: ''
+            self.assertTrue(AdbWrapper.has_exec_in(serial='foo'))
+        finally:
+            AdbWrapper.device_exec_in.pop('foo', None)
+
+    def test_push_archive_without_tar(self):
+        """
+        Test push folder file by file when device has no tar.
+        """
+        source_dir = os.path.join(self.tmp_dir, 'webapps')
+        os.makedirs(source_dir)
+        with open(os.path.join(source_dir, 'webapps.json'), 'wb') as f:
+            f.write('{}')
+        AdbWrapper.device_tar_commands['foo'] = None
+        try:
+            self.assertFalse(AdbWrapper.adb_push_archive(source_dir, '/system/b2g/webapps', serial='foo'))
+        finally:
+            del AdbWrapper.device_tar_commands['foo']
+        self.assertEqual(self.device.files.keys(), ['/system/b2g/webapps/webapps.json'])
+
+    def test_pull_archive(self):
+        """
+        Test pull folder as one tar stream by "exec-out", which is unpacked on the fly.
+        """
+        device_dir = os.path.join(self.tmp_dir, 'device')
+        os.makedirs(os.path.join(device_dir, 'storage'))
+        with open(os.path.join(device_dir, 'storage', 'data.sqlite'), 'wb') as f:
+            f.write('\x00\r\n' * 1000)
+        with open(os.path.join(device_dir, 'prefs.js'), 'wb') as f:
+            f.write('pref')
+        # the tar of device prints warnings, and the stderr is merged into the stream
+        self.device.exec_handler = lambda command: run_local_script(
+            'exec 2>&1; warn_tar() { echo "tar: warning" >&2; tar "$@"; }; ' +
+            command.replace('/data/b2g/mozilla', device_dir).replace('tar -cf', 'warn_tar -cf'))
+        pull_dir = os.path.join(self.tmp_dir, 'pull')
+        AdbWrapper.device_tar_commands['foo'] = 'tar'
+        try:
+            self.assertTrue(AdbWrapper.adb_pull_archive('/data/b2g/mozilla', pull_dir, serial='foo'))
+        finally:
+            del AdbWrapper.device_tar_commands['foo']
+        self.assertEqual(self.device.shell_commands,
+                         ['tar -cf - -C "/data/b2g/mozilla" . 2>/dev/null; echo __B2G_TAR_EXIT_$?'])
+        with open(os.path.join(pull_dir, 'storage', 'data.sqlite'), 'rb') as f:
+            self.assertEqual(f.read(), '\x00\r\n' * 1000, 'The binary data should not be mangled.')
+
+    def test_pull_archive_members(self):
+        """
+        Test pull only the given files by as few tar streams as the command length allows.
+        """
+        device_dir = os.path.join(self.tmp_dir, 'device')
+        names = ['storage/a b.sqlite', '-c.js', 'd"$e.js', 'f.js']
+        for name in names + ['skipped.js']:
+            path = os.path.join(device_dir, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(name)
+        self.device.exec_handler = lambda command: run_local_script(command.replace('/data/b2g/mozilla', device_dir))
+        pull_dir = os.path.join(self.tmp_dir, 'pull')
+        AdbWrapper.device_tar_commands['foo'] = 'tar'
+        try:
+            with mock.patch.object(AdbWrapper, 'MAX_ARCHIVE_COMMAND_MEMBERS', 40):
+                self.assertTrue(AdbWrapper.adb_pull_archive('/data/b2g/mozilla', pull_dir, serial='foo',
+                                                            members=names))
+        finally:
+            del AdbWrapper.device_tar_commands['foo']
+        self.assertEqual(len(self.device.shell_commands), 2, 'The members should be pulled by 2 tar streams.')
+        for name in names:
+            with open(os.path.join(pull_dir, *name.split('/')), 'rb') as f:
+                self.assertEqual(f.read(), name)
+        self.assertFalse(os.path.exists(os.path.join(pull_dir, 'skipped.js')))
+
+    def test_pull_archive_tar_failed(self):
+        """
+        Test pulling folder fails when the tar of device fails, e.g. some files can not be read.
+        """
+        device_dir = os.path.join(self.tmp_dir, 'device')
+        os.makedirs(device_dir)
+        with open(os.path.join(device_dir, 'prefs.js'), 'wb') as f:
+            f.write('pref')
+        self.device.exec_handler = lambda command: run_local_script(
+            'fail_tar() { tar "$@"; return 2; }; ' +
+            command.replace('/data/b2g/mozilla', device_dir).replace('tar -cf', 'fail_tar -cf'))
+        AdbWrapper.device_tar_commands['foo'] = 'tar'
+        try:
+            with self.assertRaises(Exception) as cm:
+                AdbWrapper.adb_pull_archive('/data/b2g/mozilla', os.path.join(self.tmp_dir, 'pull'), serial='foo')
+            self.assertIn('returned 2', str(cm.exception))
+            # the stream is cut before the return code
+            self.device.exec_handler = lambda command: run_local_script(
+                command.replace('/data/b2g/mozilla', device_dir).split(';')[0])
+            with self.assertRaises(Exception) as cm:
+                AdbWrapper.adb_pull_archive('/data/b2g/mozilla', os.path.join(self.tmp_dir, 'pull'), serial='foo')
+            self.assertIn('truncated', str(cm.exception))
+        finally:
+            del AdbWrapper.device_tar_commands['foo']
+
+    def test_pull_archive_without_exec_out(self):
+        """
+        Test pull folder file by file when device does not support "exec-out".
+        """
+        self.device.add_file('/data/b2g/mozilla/prefs.js', 'pref')
+        AdbWrapper.device_tar_commands['foo'] = 'tar'
+        try:
+            self.assertFalse(AdbWrapper.adb_pull_archive('/data/b2g/mozilla', self.tmp_dir, serial='foo'))
+        finally:
+            del AdbWrapper.device_tar_commands['foo']
+        with open(os.path.join(self.tmp_dir, 'prefs.js'), 'rb') as f:
+            self.assertEqual(f.read(), 'pref')
+
+    def test_pull_fail(self):
+        """
+        Test pull the file which does not exist.
+        """
+        with self.assertRaises(Exception):
+            AdbWrapper.adb_pull('/foo', self.tmp_dir, serial='foo')
+        with self.assertRaises(Exception):
+            AdbWrapper.adb_pull_fileobj('/foo', io.BytesIO(), serial='foo')
+
+    def test_forward(self):
+        """
+        Test forward, forward --list, and forward --remove.
+        """
+        self.assertTrue(AdbWrapper.adb_forward(local='tcp:2828', remote='tcp:2828', serial='foo'))
+        expected_ret = {'foo': {'source': 'tcp:2828', 'dest': 'tcp:2828'}}
+        fwd_list = AdbWrapper.adb_forward(command='list')
+        self.assertEqual(fwd_list, expected_ret,
+                         'The result should be {}, not {}.'.format(expected_ret, fwd_list))
+        self.assertTrue(AdbWrapper.adb_forward(command='remove', local='tcp:2828'))
+        self.assertEqual(AdbWrapper.adb_forward(command='list'), {})
+
+    def tearDown(self):
+        AdbWrapper.set_backend(AdbWrapper.BACKEND_SUBPROCESS)
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
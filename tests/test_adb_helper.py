@@ -2,8 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import io
 import tempfile
 import textwrap
+import subprocess
 import unittest
 import logging
 
@@ -12,6 +14,13 @@ from mock import patch, Mock
 from b2g_util.util.adb_helper import AdbWrapper
 from b2g_util.util.adb_helper import AdbHelper
 
+# keep the original Popen for running the script by local shell
+REAL_POPEN = subprocess.Popen
+
+
+def run_local_script(script):
+    return REAL_POPEN(['/bin/sh', '-c', script], stdout=subprocess.PIPE).communicate()[0]
+
 
 class AdbWrapperTester(unittest.TestCase):
 
@@ -86,6 +95,22 @@ class AdbWrapperTester(unittest.TestCase):
             self.mock_popen.return_value = self.mock_obj
             ret = AdbWrapper.adb_pull('foo', '')
 
+    def test_pull_fileobj(self):
+        """
+        Test pull into file object via temp file.
+        """
+        def fake_pull(cmd, **kwargs):
+            # cmd: adb pull 'source' 'dest'
+            with open(cmd.split("'")[3], 'wb') as f:
+                f.write('[App]\nBuildID=20151015030205\n')
+            return self.mock_obj
+        self.mock_obj.communicate.return_value = ['2 KB/s (29 bytes in 0.040s)', None]
+        self.mock_popen.side_effect = fake_pull
+        f = io.BytesIO()
+        ret = AdbWrapper.adb_pull_fileobj('/system/b2g/application.ini', f)
+        self.assertEqual(ret, 29, 'The result should be 29, not {}.'.format(ret))
+        self.assertEqual(f.getvalue(), '[App]\nBuildID=20151015030205\n')
+
     def test_push(self):
         """
         Test push.
@@ -183,6 +208,38 @@ class AdbWrapperTester(unittest.TestCase):
             self.mock_popen.return_value = self.mock_obj
             ret = AdbWrapper.adb_shell('foo')
 
+    def test_shell_batch(self):
+        """
+        Test shell batch.
+        """
+        def run_script(cmd, **kwargs):
+            # run the script of "adb shell '<script>'" by local shell
+            script = cmd.split("shell '", 1)[1][:-1]
+            self.mock_obj.communicate.return_value = [run_local_script(script), None]
+            return self.mock_obj
+        self.mock_popen.side_effect = run_script
+        ret = AdbWrapper.adb_shell_batch(['echo foo', 'false', 'echo 1; echo 2', 'true'])
+        expected_ret = [('foo', 0), ('', 1), ('1\n2', 0), ('', 0)]
+        self.assertEqual(ret, expected_ret,
+                         'The result should be {}, not {}.'.format(expected_ret, ret))
+        self.assertEqual(self.mock_popen.call_count, 1, 'All commands should run in one adb command.')
+
+    def test_shell_batch_stop_device(self):
+        """
+        Test shell batch, and the device was stopped by command.
+        """
+        def run_script(cmd, **kwargs):
+            # the output ends after the second command, like "reboot recovery"
+            script = cmd.split("shell '", 1)[1][:-1]
+            output = run_local_script(script)
+            self.mock_obj.communicate.return_value = [output[:output.index('rebooting') + 9], None]
+            return self.mock_obj
+        self.mock_popen.side_effect = run_script
+        ret = AdbWrapper.adb_shell_batch(['echo foo', 'echo rebooting', 'echo bar'])
+        expected_ret = [('foo', 0), ('rebooting', 0), ('', 0)]
+        self.assertEqual(ret, expected_ret,
+                         'The result should be {}, not {}.'.format(expected_ret, ret))
+
     def test_remount(self):
         """
         Test remount.
@@ -215,22 +272,55 @@ class AdbWrapperTester(unittest.TestCase):
             self.mock_popen.return_value = self.mock_obj
             ret = AdbWrapper.adb_remount()
 
+    def test_file_size(self):
+        """
+        test the size of remote file by stat, wc, and the "ls -l" of toolbox and busybox.
+        """
+        not_found = ('/system/bin/sh: stat: not found', 127)
+        cases = [([('12345', 0), ('12345', 0), ('', 0)], 12345),
+                 ([not_found, ('  12345 ', 0), ('', 0)], 12345),
+                 ([not_found, not_found, ('-rw-r--r-- root root 12345 2015-10-15 03:02 omni.ja', 0)], 12345),
+                 ([not_found, not_found, ('-rw-r--r--    1 root     root         12345 Oct 15 03:02 omni.ja', 0)],
+                  12345)]
+        for results, expected in cases:
+            with patch.object(AdbWrapper, 'adb_shell_batch', return_value=results):
+                self.assertEqual(AdbWrapper.adb_file_size('/system/b2g/omni.ja'), expected)
+        with patch.object(AdbWrapper, 'adb_shell_batch', return_value=[not_found, not_found, ('No such file', 1)]):
+            with self.assertRaises(Exception):
+                AdbWrapper.adb_file_size('/system/b2g/omni.ja')
+
+    def test_free_space(self):
+        """
+        test the free space from the "df" of old toolbox, toolbox, busybox, and toybox.
+        """
+        cases = [('/data: 5767168K total, 1258291K used, 4508877K available (block size 4096)', 4508877 * 1024),
+                 ('Filesystem             Size   Used   Free   Blksize\n/data                  5.5G   1.2G   4.3G   4096',
+                  int(4.3 * 1024 ** 3)),
+                 ('Filesystem           1K-blocks      Used Available Use% Mounted on\n'
+                  '/dev/block/platform/msm_sdcc.1/by-name/userdata\n'
+                  '                       5767168   1258291   4508877  22% /data', 4508877 * 1024),
+                 ('df: /data/local/tmp: No such file or directory', None)]
+        for output, expected in cases:
+            with patch.object(AdbWrapper, 'adb_shell', return_value=(output, 0 if expected else 1)):
+                self.assertEqual(AdbWrapper.adb_free_space('/data/local/tmp'), expected)
+
     def test_wait_for_device(self):
         """
-        test wait-fot-device.
+        test wait-fot-device, which polls "adb devices" when the ADB server can not be tracked.
         """
-        # wait 1 second
+        # the device is online after 1 second
         def func():
             import time
             time.sleep(1)
-            return ['', None]
+            return ['List of devices attached\nfoo\tdevice', None]
         self.mock_obj.communicate = func
         self.mock_popen.return_value = self.mock_obj
-        # test timeout is 0.1, should raise exception
-        with self.assertRaises(Exception) as cm:
-            ret = AdbWrapper.adb_wait_for_device(timeout=0.1)
-        # test timeout is 10, should pass
-        ret = AdbWrapper.adb_wait_for_device(timeout=10)
+        with patch('b2g_util.util.adb_helper.DeviceRegistry.get_instance', return_value=Mock(tracking=False)):
+            # test timeout is 0.1, should raise exception
+            with self.assertRaises(Exception) as cm:
+                ret = AdbWrapper.adb_wait_for_device(timeout=0.1)
+            # test timeout is 10, should pass
+            ret = AdbWrapper.adb_wait_for_device(timeout=10, serial='foo')
         self.assertTrue(ret, 'The result should be True.')
 
     def test_forward_list(self):
@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest
+import subprocess
+
+from b2g_util.util.adb_client import AdbClient
+from b2g_util.util.adb_helper import AdbWrapper
+from b2g_util.util.adb_shell_session import AdbShellSessionPool
+from fake_adb_server import FakeAdbServer
+
+
+class AdbShellSessionTester(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.device = self.server.add_device('foo')
+        self.client = AdbClient(port=self.server.port)
+        self.pool = AdbShellSessionPool(idle_timeout=60)
+
+    def test_execute(self):
+        """
+        Test running commands in one session.
+        """
+        ret, retcode = self.pool.execute('echo test_result', serial='foo', client=self.client)
+        self.assertEqual(ret, 'test_result', 'The result should be test_result, not {}.'.format(ret))
+        self.assertEqual(retcode, 0, 'The return code should be 0, not {}.'.format(retcode))
+        ret, retcode = self.pool.execute('echo first; echo second; exit 3', serial='foo', client=self.client)
+        self.assertEqual(ret, 'first\nsecond')
+        self.assertEqual(retcode, 3, 'The return code should be 3, not {}.'.format(retcode))
+        ret, retcode = self.pool.execute('true', serial='foo', client=self.client)
+        self.assertEqual((ret, retcode), ('', 0))
+        self.assertEqual(self.device.shell_sessions, 1, 'All commands should run in one session.')
+
+    def test_execute_long_script(self):
+        """
+        Test the script longer than the tty input line runs by non-interactive shell.
+        """
+        def run_on_host(command):
+            p = subprocess.Popen(['/bin/sh', '-c', command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            return p.communicate()[0]
+        self.device.shell_handler = run_on_host
+        command = '; '.join('echo {}'.format(i) for i in range(1000)) + '; exit 5'
+        self.assertGreater(len(command), 4096)
+        ret, retcode = self.pool.execute(command, serial='foo', client=self.client)
+        self.assertEqual(ret.split('\n'), [str(i) for i in range(1000)])
+        self.assertEqual(retcode, 5)
+        self.assertEqual(self.device.shell_sessions, 0, 'The interactive shell should not be used.')
+        self.assertEqual(len(self.device.shell_commands), 1)
+        # the short command still runs in the session
+        self.assertEqual(self.pool.execute('echo short', serial='foo', client=self.client), ('short', 0))
+        self.assertEqual(self.device.shell_sessions, 1)
+
+    def test_reconnect(self):
+        """
+        Test reconnecting after device reboot.
+        """
+        self.pool.execute('true', serial='foo', client=self.client)
+        self.device.reboot()
+        time.sleep(0.1)
+        ret, retcode = self.pool.execute('echo back', serial='foo', client=self.client)
+        self.assertEqual((ret, retcode), ('back', 0))
+        self.assertEqual(self.device.shell_sessions, 2, 'The session should be reconnected.')
+
+    def test_idle_eviction(self):
+        """
+        Test evicting the idle session.
+        """
+        self.pool.idle_timeout = 0
+        self.pool.execute('true', serial='foo', client=self.client)
+        time.sleep(0.01)
+        self.pool.evict_idle()
+        self.assertEqual(self.pool.sessions, {})
+
+    def test_no_eviction_while_checked_out(self):
+        """
+        Test the session handed out by the pool is not evicted before it is returned.
+        """
+        self.pool.idle_timeout = 0
+        with self.pool.checkout(serial='foo', client=self.client) as session:
+            session.execute('true')
+            time.sleep(0.01)
+            self.pool.evict_idle()
+            self.assertIs(self.pool.sessions.get('foo'), session)
+            self.assertTrue(session.is_open(), 'The checked out session should not be closed.')
+            self.assertEqual(session.execute('echo again'), ('again', 0))
+        self.assertEqual(self.device.shell_sessions, 1, 'The session should not be reopened.')
+        time.sleep(0.01)
+        self.pool.evict_idle()
+        self.assertEqual(self.pool.sessions, {})
+
+    def test_get_refresh_last_used(self):
+        """
+        Test the session returned by get() is not idle.
+        """
+        self.pool.idle_timeout = 10
+        session = self.pool.get(serial='foo', client=self.client)
+        session.last_used -= 9
+        now = time.time()
+        self.assertIs(self.pool.get(serial='foo', client=self.client), session)
+        self.assertGreaterEqual(session.last_used, now)
+
+    def test_adb_shell_with_session(self):
+        """
+        Test AdbWrapper.adb_shell with shell session.
+        """
+        AdbWrapper.set_backend(AdbWrapper.BACKEND_SOCKET, port=self.server.port)
+        AdbWrapper.set_shell_session(True)
+        try:
+            for i in range(5):
+                ret, retcode = AdbWrapper.adb_shell('echo {}'.format(i), serial='foo')
+                self.assertEqual((ret, retcode), (str(i), 0))
+            self.assertEqual(self.device.shell_sessions, 1, 'All commands should run in one session.')
+        finally:
+            AdbWrapper.set_shell_session(False)
+            AdbWrapper.set_backend(AdbWrapper.BACKEND_SUBPROCESS)
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from b2g_util.util.artifact_cache import ArtifactCache
+from b2g_util.util.artifact_cache import CachedArtifactDownloader
+from b2g_util.util.downloader import Downloader
+from fake_http_server import FakeHttpServer
+
+
+def put_artifact(cache_dir, index, source_file):
+    ArtifactCache(cache_dir).put('gecko.v2.try', 'private/build/gaia.zip', 'task{}'.format(index), source_file)
+
+
+class ArtifactCacheTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_file(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_put_and_get(self):
+        """
+        Test the artifact is found by namespace, artifact and digest.
+        """
+        cache = ArtifactCache(self.cache_dir)
+        source = self._make_file('aries.zip', 'image')
+        cache.put('gecko.v2.mozilla-central.latest.b2g.aries-opt', 'private/build/aries.zip', 'taskA', source)
+        path = cache.get('gecko.v2.mozilla-central.latest.b2g.aries-opt', 'private/build/aries.zip', 'taskA')
+        self.assertEqual(os.path.basename(path), 'aries.zip')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'image')
+        self.assertIsNone(cache.get('gecko.v2.mozilla-central.latest.b2g.aries-opt', 'private/build/aries.zip',
+                                    'taskB'), 'The other digest should not be found.')
+        self.assertIsNone(cache.get('gecko.v2.mozilla-central.latest.b2g.aries-eng-opt', 'private/build/aries.zip',
+                                    'taskA'), 'The other namespace should not be found.')
+
+    def test_evict_lru(self):
+        """
+        Test the least recently used artifacts are evicted when the cache is over max size.
+        """
+        cache = ArtifactCache(self.cache_dir, max_size=25)
+        source = self._make_file('gaia.zip', 'x' * 10)
+        for digest in ('task1', 'task2'):
+            cache.put('ns', 'gaia.zip', digest, source)
+            time.sleep(0.01)
+        # task1 is used recently, so task2 is the least recently used one
+        self.assertIsNotNone(cache.get('ns', 'gaia.zip', 'task1'))
+        time.sleep(0.01)
+        cache.put('ns', 'gaia.zip', 'task3', source)
+        self.assertIsNone(cache.get('ns', 'gaia.zip', 'task2'))
+        self.assertIsNotNone(cache.get('ns', 'gaia.zip', 'task1'))
+        self.assertIsNotNone(cache.get('ns', 'gaia.zip', 'task3'))
+        self.assertEqual(cache.total_size(), 20)
+
+    def test_shared_by_processes(self):
+        """
+        Test several processes insert into the same cache.
+        """
+        source = self._make_file('gaia.zip', 'gaia' * 1000)
+        processes = [multiprocessing.Process(target=put_artifact, args=(self.cache_dir, index, source))
+                     for index in range(8)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        cache = ArtifactCache(self.cache_dir)
+        for index in range(8):
+            self.assertIsNotNone(cache.get('gecko.v2.try', 'private/build/gaia.zip', 'task{}'.format(index)))
+        self.assertEqual(cache.total_size(), 8 * 4000)
+
+    def test_cached_artifact_downloader(self):
+        """
+        Test the Taskcluster downloader is skipped when the artifact of TaskId is cached.
+        """
+        source = self._make_file('b2g.tar.gz', 'gecko')
+
+        class FakeDownloader(object):
+            calls = []
+
+            def download_latest_artifact(self, task_id, full_filename, dest_dir):
+                self.calls.append(task_id)
+                return source
+
+        downloader = CachedArtifactDownloader(FakeDownloader(), ArtifactCache(self.cache_dir), namespace='ns')
+        dest_dir = os.path.join(self.tmp_dir, 'dest')
+        downloader.download_latest_artifact('taskA', 'public/build/b2g.tar.gz', dest_dir)
+        ret = downloader.download_latest_artifact('taskA', 'public/build/b2g.tar.gz', dest_dir)
+        self.assertEqual(FakeDownloader.calls, ['taskA'])
+        self.assertEqual(ret, os.path.join(dest_dir, 'b2g.tar.gz'))
+        with open(ret, 'rb') as f:
+            self.assertEqual(f.read(), 'gecko')
+
+    def test_downloader_with_cache(self):
+        """
+        Test Downloader does not touch the network when the digest is cached.
+        """
+        server = FakeHttpServer().start()
+        try:
+            server.files['/gaia.zip'] = 'gaia' * 1000
+            downloader = Downloader(cache=ArtifactCache(self.cache_dir))
+            first = downloader.download(server.url('/gaia.zip?sig=1'), os.path.join(self.tmp_dir, 'a'), digest='rev1')
+            requests = len(server.requests)
+            second = downloader.download(server.url('/gaia.zip?sig=2'), os.path.join(self.tmp_dir, 'b'), digest='rev1')
+            self.assertEqual(len(server.requests), requests)
+            with open(first, 'rb') as f1, open(second, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+            # without digest, the ETag of probe is the digest
+            downloader.download(server.url('/gaia.zip'), os.path.join(self.tmp_dir, 'c'))
+            requests = len(server.requests)
+            downloader.download(server.url('/gaia.zip'), os.path.join(self.tmp_dir, 'd'))
+            self.assertEqual(len(server.requests), requests + 1, 'Only the probe should be requested.')
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
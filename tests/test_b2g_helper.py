@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import mock
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from b2g_util.util.adb_helper import AdbWrapper
+from b2g_util.util.b2g_helper import B2GHelper
+from b2g_util.util.device_registry import DeviceRegistry
+from fake_adb_server import FakeAdbServer
+
+
+class B2GHelperTester(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.device = self.server.add_device('foo', 'offline')
+        AdbWrapper.set_backend(AdbWrapper.BACKEND_SOCKET, port=self.server.port)
+        # the shell of fake device is the shell of host, so the boot state is kept in files
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self._set_boot_state('0', 'stopped')
+        command = 'cat {0}/boot_completed; cat {0}/b2g'.format(self.tmp_dir)
+        self.command_patcher = mock.patch.object(B2GHelper, '_BOOT_CHECK_COMMAND', command)
+        self.command_patcher.start()
+
+    def tearDown(self):
+        self.command_patcher.stop()
+        AdbWrapper.set_backend(AdbWrapper.BACKEND_SUBPROCESS)
+        if DeviceRegistry._instance is not None:
+            DeviceRegistry._instance.stop()
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _set_boot_state(self, boot_completed, b2g):
+        for name, value in (('boot_completed', boot_completed), ('b2g', b2g)):
+            with open(os.path.join(self.tmp_dir, name), 'w') as f:
+                f.write(value + '\n')
+
+    def test_wait_for_boot(self):
+        """
+        Test waiting for the device is online, booted, and B2G is running, over one shell session.
+        """
+        def boot():
+            self.server.set_state('foo', 'device')
+            time.sleep(0.3)
+            self._set_boot_state('1', 'stopped')
+            time.sleep(0.3)
+            self._set_boot_state('1', 'running')
+        start_time = time.time()
+        threading.Timer(0.2, boot).start()
+        seconds = B2GHelper.wait_for_boot(serial='foo', deadline=time.time() + 10)
+        self.assertGreaterEqual(seconds, 0.8)
+        self.assertLessEqual(seconds, time.time() - start_time)
+        self.assertEqual(self.device.shell_sessions, 1, 'The boot state should be polled in one session.')
+
+    def test_wait_for_boot_timeout(self):
+        """
+        Test the device which is online but B2G is not running.
+        """
+        self.server.set_state('foo', 'device')
+        start_time = time.time()
+        with self.assertRaises(Exception):
+            B2GHelper.wait_for_boot(serial='foo', deadline=time.time() + 1)
+        self.assertLess(time.time() - start_time, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
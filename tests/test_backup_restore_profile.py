@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import mock
 import tempfile
 import textwrap
 import unittest
@@ -105,6 +106,55 @@ class BackupResotreTester(unittest.TestCase):
             with tempfile.NamedTemporaryFile(prefix='test_b2g_util_') as temp:
                 result = self.app._get_version_from_profile(temp.name)
 
+    def test_parse_size(self):
+        '''
+        test _parse_size of "du -sk" and "df"
+        '''
+        self.assertEqual(self.app._parse_size('1024'), 1024 * 1024)
+        self.assertEqual(self.app._parse_size('1.5G'), int(1.5 * 1024 ** 3))
+        self.assertEqual(self.app._parse_size('700.0M'), 700 * 1024 ** 2)
+        self.assertIsNone(self.app._parse_size('Free'))
+
+    @mock.patch('b2g_util.backup_restore_profile.AdbWrapper')
+    def test_stage_profile_on_device(self, mock_adb):
+        '''
+        test stage_profile_on_device moves the profile into staging folder when /data has enough space
+        '''
+        df_output = ('Filesystem               Size     Used     Free   Blksize\n'
+                     '/data                    1.0G   500.0M   524.0M   4096')
+        mock_adb.adb_shell.return_value = ('', 1)
+        mock_adb.adb_shell_batch.side_effect = [[('1024\t/data/b2g/mozilla\n2048\t/data/local', 0), (df_output, 0)],
+                                                [('', 0)] * 3]
+        self.assertTrue(self.app.stage_profile_on_device('/data/staging', serial='foo'))
+        commands = mock_adb.adb_shell_batch.call_args[0][0]
+        self.assertIn('mv /data/b2g/mozilla /data/staging/b2g-mozilla', commands)
+        self.assertIn('mv /data/local /data/staging/data-local', commands)
+        self.assertFalse([command for command in commands if command.startswith('rm')],
+                         'The staging folder should not be removed.')
+
+    @mock.patch('b2g_util.backup_restore_profile.AdbWrapper')
+    def test_stage_profile_on_device_staged(self, mock_adb):
+        '''
+        test stage_profile_on_device restores the profile which was left in staging folder by the last run
+        '''
+        mock_adb.adb_shell.return_value = ('', 0)
+        mock_adb.adb_shell_batch.return_value = [('', 1), ('', 1)]
+        with mock.patch.object(BackupRestoreHelper, 'restore_staged_profile') as restore:
+            self.assertFalse(self.app.stage_profile_on_device('/data/staging', serial='foo'))
+        restore.assert_called_once_with('/data/staging', serial='foo')
+
+    @mock.patch('b2g_util.backup_restore_profile.AdbWrapper')
+    def test_stage_profile_on_device_lack_space(self, mock_adb):
+        '''
+        test stage_profile_on_device does nothing when /data lacks space
+        '''
+        df_output = ('Filesystem     1K-blocks    Used Available Use% Mounted on\n'
+                     '/dev/block/mmcblk0p20   1000   900   100  90% /data')
+        mock_adb.adb_shell.return_value = ('', 1)
+        mock_adb.adb_shell_batch.return_value = [('1024\t/data/b2g/mozilla\n2048\t/data/local', 0), (df_output, 0)]
+        self.assertFalse(self.app.stage_profile_on_device('/data/staging', serial='foo'))
+        self.assertEqual(mock_adb.adb_shell_batch.call_count, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from mock import patch
+
+from b2g_util.util.backup_store import BackupStore
+from b2g_util.backup_restore_profile import BackupRestoreHelper
+
+
+class BackupStoreTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='backup_store_')
+        self.repository = os.path.join(self.tmp_dir, 'repository')
+        self.backup_dir = os.path.join(self.tmp_dir, 'backup')
+        os.makedirs(os.path.join(self.backup_dir, 'b2g-mozilla', 'storage'))
+        os.makedirs(os.path.join(self.backup_dir, 'data-local', 'empty'))
+        self._write('b2g-mozilla/prefs.js', 'pref')
+        self._write('b2g-mozilla/storage/idb.sqlite', 'idb' * 1000)
+        self._write('data-local/user.js', 'pref')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, path, data):
+        with open(os.path.join(self.backup_dir, *path.split('/')), 'wb') as f:
+            f.write(data)
+
+    def _count_objects(self):
+        return sum(len(files) for _, _, files in os.walk(os.path.join(self.repository, 'objects')))
+
+    def test_commit_and_checkout(self):
+        """
+        Test the same contents are stored once, and the snapshot is rebuilt from manifest.
+        """
+        store = BackupStore(self.repository)
+        first = store.commit(self.backup_dir, serial='foo', snapshot='20160101-000000')
+        self.assertEqual(self._count_objects(), 2, 'The same contents should be stored once.')
+        self._write('b2g-mozilla/storage/idb.sqlite', 'new idb')
+        os.chmod(os.path.join(self.backup_dir, 'data-local', 'user.js'), 0600)
+        second = store.commit(self.backup_dir, serial='foo', snapshot='20160102-000000')
+        store.commit(self.backup_dir, serial='bar', snapshot='20160102-000000')
+        self.assertEqual(self._count_objects(), 3, 'Only the changed content should be added.')
+        self.assertEqual(store.list_snapshots('foo'), [first, second])
+        self.assertEqual(store.get_latest_snapshot('foo'), second)
+        self.assertIsNone(store.get_latest_snapshot('askeing'))
+
+        restore_dir = os.path.join(self.tmp_dir, 'restore')
+        store.checkout('foo', first, restore_dir)
+        with open(os.path.join(restore_dir, 'b2g-mozilla', 'storage', 'idb.sqlite'), 'rb') as f:
+            self.assertEqual(f.read(), 'idb' * 1000)
+        self.assertTrue(os.path.isdir(os.path.join(restore_dir, 'data-local', 'empty')))
+        restore_dir = os.path.join(self.tmp_dir, 'restore2')
+        store.checkout('foo', second, restore_dir)
+        self.assertEqual(os.stat(os.path.join(restore_dir, 'data-local', 'user.js')).st_mode & 0777, 0600)
+        with self.assertRaises(Exception):
+            store.checkout('foo', '20150101-000000', restore_dir)
+
+    def test_snapshot_not_overwritten(self):
+        """
+        Test the backups in the same second get their own snapshots, and the existing snapshot is never replaced.
+        """
+        store = BackupStore(self.repository)
+        snapshots = [store.commit(self.backup_dir, serial='foo') for _ in range(3)]
+        self.assertEqual(len(set(snapshots)), 3)
+        self.assertEqual(store.list_snapshots('foo'), snapshots)
+        self._write('b2g-mozilla/storage/idb.sqlite', 'new idb')
+        with self.assertRaises(Exception):
+            store.commit(self.backup_dir, serial='foo', snapshot=snapshots[0])
+        manifest = store.get_manifest('foo', snapshots[0])
+        self.assertEqual(manifest['files']['b2g-mozilla/storage/idb.sqlite']['size'], 3000)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.repository, 'snapshots', 'foo'))),
+                         [name + '.json' for name in snapshots], 'The temp file should be removed.')
+
+    def test_pull_only_changed_files(self):
+        """
+        Test only the changed files are pulled when the previous backup is checked out.
+        """
+        local_dir = os.path.join(self.backup_dir, 'b2g-mozilla')
+        device_manifest = {'prefs.js': '0' * 32, 'storage/idb.sqlite': hashlib.md5('idb' * 1000).hexdigest()}
+        os.remove(os.path.join(local_dir, 'prefs.js'))
+        self._write('b2g-mozilla/stale.js', 'stale')
+
+        with patch('b2g_util.util.delta_push.DeltaPusher.get_device_manifest', return_value=device_manifest), \
+                patch('b2g_util.util.adb_helper.AdbWrapper.adb_pull_archive') as mock_pull:
+            BackupRestoreHelper._pull_folder('/data/b2g/mozilla', local_dir, serial='foo')
+        mock_pull.assert_called_once_with('/data/b2g/mozilla', local_dir, serial='foo', members=['prefs.js'])
+        self.assertFalse(os.path.exists(os.path.join(local_dir, 'stale.js')), 'The stale file should be removed.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import mock
+import shutil
+import tempfile
+import unittest
+
+from b2g_util.check_versions import VersionChecker
+
+
+class VersionCheckerTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self.app = VersionChecker()
+        self.app.set_log_json(os.path.join(self.tmp_dir, 'versions.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def _get_device_info(serial=None):
+        if serial == 'bad':
+            raise Exception('device offline')
+        return {'Serial': serial, 'Device Name': 'flame'}
+
+    def test_run_failed_device(self):
+        """
+        Test one failed device does not stop the report of others, and run() raises for it.
+        """
+        devices = {'good': 'device', 'bad': 'device', 'gone': 'offline'}
+        with mock.patch('b2g_util.check_versions.AdbHelper.get_devices', return_value=devices), \
+                mock.patch('b2g_util.check_versions.AdbHelper.get_serial', return_value=None), \
+                mock.patch.object(VersionChecker, 'get_device_info', side_effect=self._get_device_info), \
+                mock.patch.object(VersionChecker, 'print_device_info'):
+            with self.assertRaises(Exception) as cm:
+                self.app.run()
+        self.assertIn('bad', cm.exception.message)
+        self.assertNotIn('good', cm.exception.message)
+        with open(self.app.log_json) as f:
+            result = json.load(f)
+        self.assertEqual(result['good']['Device Name'], 'flame')
+        self.assertEqual(result['bad']['Error'], 'device offline')
+        self.assertTrue(result['gone']['Skip'])
+
+
+if __name__ == '__main__':
+    unittest.main()
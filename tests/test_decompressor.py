@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from b2g_util.util.decompressor import Decompressor
+
+
+class DecompressorTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self.members = {'gaia/profile/user.js': 'user_pref',
+                        'gaia/profile/settings.json': '{}',
+                        'gaia/profile/webapps/webapps.json': '{}',
+                        'gaia/profile/webapps/sms/application.zip': 'sms' * 10000,
+                        'gaia/profile/webapps/email/application.zip': 'email' * 10000,
+                        'gaia/profile/indexedDB/foo.sqlite': 'db',
+                        'gaia/README': 'readme'}
+        self.gaia = os.path.join(self.tmp_dir, 'gaia.zip')
+        with zipfile.ZipFile(self.gaia, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, data in sorted(self.members.items()):
+                z.writestr(name, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _list_files(self, folder):
+        files = []
+        for root, _, names in os.walk(folder):
+            files.extend(os.path.relpath(os.path.join(root, name), folder).replace(os.sep, '/') for name in names)
+        return sorted(files)
+
+    def test_unzip_members(self):
+        """
+        Test unzip the members which match the names and folder prefixes.
+        """
+        dest = os.path.join(self.tmp_dir, 'dest')
+        manifest = Decompressor.unzip(self.gaia, dest, members=['gaia/profile/user.js', 'gaia/profile/webapps/'])
+        expected = ['gaia/profile/user.js', 'gaia/profile/webapps/email/application.zip',
+                    'gaia/profile/webapps/sms/application.zip', 'gaia/profile/webapps/webapps.json']
+        self.assertEqual(self._list_files(dest), expected)
+        self.assertEqual(manifest, dict((name, len(self.members[name])) for name in expected))
+
+    def test_unzip_glob(self):
+        """
+        Test unzip the members which match the glob pattern.
+        """
+        dest = os.path.join(self.tmp_dir, 'dest')
+        Decompressor.unzip(self.gaia, dest, members=['gaia/profile/webapps/*/application.zip'])
+        self.assertEqual(self._list_files(dest), ['gaia/profile/webapps/email/application.zip',
+                                                  'gaia/profile/webapps/sms/application.zip'])
+
+    def test_unzip_parallel(self):
+        """
+        Test unzip by threads has the same result.
+        """
+        dest = os.path.join(self.tmp_dir, 'dest')
+        manifest = Decompressor.unzip(self.gaia, dest, jobs=3)
+        self.assertEqual(self._list_files(dest), sorted(self.members.keys()))
+        self.assertEqual(sum(manifest.values()), sum(len(data) for data in self.members.values()))
+        for name, data in self.members.items():
+            with open(os.path.join(dest, *name.split('/')), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_unzip_fail(self):
+        """
+        Test unzip the file which is not zip.
+        """
+        self.assertIsNone(Decompressor.unzip(__file__, os.path.join(self.tmp_dir, 'dest')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from mock import patch
+
+from b2g_util.util.delta_push import DeltaPusher
+
+
+class DeltaPusherTester(unittest.TestCase):
+
+    def setUp(self):
+        self.local_dir = tempfile.mkdtemp(prefix='deltapush_test_')
+        os.makedirs(os.path.join(self.local_dir, 'lib'))
+        self.files = {'b2g': 'b2g binary', 'lib/libxul.so': 'new libxul', 'application.ini': 'ini'}
+        for path, content in self.files.items():
+            with open(os.path.join(self.local_dir, path), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+
+    def test_device_manifest(self):
+        """
+        Test parsing the output of md5sum and toolbox md5.
+        """
+        output = ('d41d8cd98f00b204e9800998ecf8427e  /system/b2g/b2g\r\n'
+                  '0123456789ABCDEF0123456789ABCDEF /system/b2g/lib/libxul.so\r\n'
+                  'md5: /system/b2g/broken: Permission denied\r\n')
+        with patch('b2g_util.util.adb_helper.AdbWrapper.adb_shell', return_value=(output, 0)):
+            manifest = DeltaPusher.get_device_manifest('/system/b2g/')
+        self.assertEqual(manifest, {'b2g': 'd41d8cd98f00b204e9800998ecf8427e',
+                                    'lib/libxul.so': '0123456789abcdef0123456789abcdef'})
+
+    def test_diff(self):
+        """
+        Test the changed and stale files.
+        """
+        local_manifest = {'b2g': 'a', 'lib/libxul.so': 'b', 'new.so': 'c'}
+        device_manifest = {'b2g': 'a', 'lib/libxul.so': 'x', 'old.so': 'd', 'defaults/pref/user.js': 'e'}
+        changed, stale = DeltaPusher.diff(local_manifest, device_manifest, excludes=['defaults'])
+        self.assertEqual(changed, ['lib/libxul.so', 'new.so'])
+        self.assertEqual(stale, ['old.so'])
+
+    def test_push(self):
+        """
+        Test only the changed files are pushed, and the stale files are removed by one batch.
+        """
+        device_manifest = {'b2g': hashlib.md5('b2g binary').hexdigest(),
+                           'lib/libxul.so': hashlib.md5('old libxul').hexdigest(),
+                           'old.so': '0' * 32,
+                           'webapps/foo/application.zip': '1' * 32}
+        pushed = []
+
+        def fake_push(source, dest, serial=None):
+            for root, dirs, files in os.walk(source):
+                for name in files:
+                    pushed.append(os.path.relpath(os.path.join(root, name), source).replace(os.sep, '/'))
+
+        with patch.object(DeltaPusher, 'get_device_manifest', return_value=device_manifest), \
+                patch('b2g_util.util.adb_helper.AdbWrapper.adb_push', side_effect=fake_push) as mock_push, \
+                patch('b2g_util.util.adb_helper.AdbWrapper.adb_shell_batch') as mock_batch:
+            changed, stale = DeltaPusher.push(self.local_dir, '/system/b2g/', excludes=['webapps'])
+        self.assertEqual(changed, ['application.ini', 'lib/libxul.so'])
+        self.assertEqual(stale, ['old.so'])
+        self.assertEqual(sorted(pushed), changed)
+        self.assertEqual(mock_push.call_count, 1, 'The changed files should be pushed by one push.')
+        mock_batch.assert_called_once_with(['rm "/system/b2g/old.so"'], serial=None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import random
+import threading
+import unittest
+
+from b2g_util.util.adb_client import AdbClient
+from b2g_util.util.adb_helper import AdbHelper
+from b2g_util.util.adb_helper import AdbWrapper
+from b2g_util.util.device_registry import DeviceRegistry
+from b2g_util.util.device_registry import DevicePoller
+from fake_adb_server import FakeAdbServer
+
+
+class DeviceRegistryTester(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.server.add_device('foo')
+        self.registry = DeviceRegistry(AdbClient(port=self.server.port))
+        self.assertTrue(self.registry.start(), 'The registry should be tracking.')
+
+    def test_devices(self):
+        """
+        Test the devices are updated by track-devices.
+        """
+        self.assertEqual(self.registry.devices(), {'foo': 'device'})
+        self.server.add_device('bar', 'offline')
+        self.registry.wait_for_state('bar', 'offline', timeout=5)
+        self.assertEqual(self.registry.devices(), {'foo': 'device', 'bar': 'offline'})
+        self.assertNotIn('host:devices', self.server.requests, 'The registry should not run host:devices.')
+
+    def test_wait_for_state(self):
+        """
+        Test waiting for device state.
+        """
+        self.server.add_device('bar', 'offline')
+        timer = threading.Timer(0.2, self.server.set_state, args=('bar', 'device'))
+        timer.start()
+        self.assertTrue(self.registry.wait_for_state('bar', timeout=5))
+        with self.assertRaises(Exception):
+            self.registry.wait_for_state('askeing', timeout=0.1)
+
+    def test_not_tracking(self):
+        """
+        Test the registry when ADB server is not reachable.
+        """
+        self.server.stop()
+        registry = DeviceRegistry(AdbClient(port=self.server.port, start_server=False))
+        self.assertFalse(registry.start())
+        self.assertIsNone(registry.devices())
+
+    def _wait_until(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_reconnect(self):
+        """
+        Test only the tracking thread subscribes again, and waiting polls the devices until it is tracking again.
+        """
+        thread = self.registry.thread
+        self.server.drop_trackers(allow_tracking=False)
+        self._wait_until(lambda: not self.registry.tracking)
+        # start() does not race with the reconnecting thread
+        for _ in range(3):
+            self.assertFalse(self.registry.start())
+        self.assertIs(self.registry.thread, thread)
+        self.server.add_device('bar', 'offline')
+        threading.Timer(0.2, self.server.set_state, args=('bar', 'device')).start()
+        self.assertTrue(self.registry.wait_for_state('bar', timeout=5))
+        self.assertIn('host:devices', self.server.requests, 'The stale devices should not be waited.')
+        self.assertFalse(self.registry.tracking)
+        self.server.drop_trackers(allow_tracking=True)
+        self._wait_until(lambda: self.registry.tracking)
+        self.assertIs(self.registry.thread, thread)
+        self.assertEqual(self.registry.devices(), {'foo': 'device', 'bar': 'device'})
+        self.registry.stop()
+        self.assertFalse(thread.is_alive(), 'The tracking thread should exit.')
+        self.assertTrue(self.registry.start())
+        self.assertIsNot(self.registry.thread, thread)
+
+    def test_get_devices(self):
+        """
+        Test AdbHelper reads devices from the registry.
+        """
+        AdbWrapper.set_backend(AdbWrapper.BACKEND_SOCKET, port=self.server.port)
+        try:
+            self.assertEqual(AdbHelper.get_devices(), {'foo': 'device'})
+            self.assertEqual(AdbHelper.get_serial('foo'), 'foo')
+            self.assertNotIn('host:devices', self.server.requests, 'The registry should not run host:devices.')
+        finally:
+            AdbWrapper.set_backend(AdbWrapper.BACKEND_SUBPROCESS)
+            DeviceRegistry._instance.stop()
+
+    def _wait_concurrently(self, wait, serials, set_online):
+        """
+        Run many waiters at the same time, the devices become online in random order,
+        and the waiters of "ghost" device time out.
+        @return: the dict {serial: (result, return time)}, and the dict {serial: online time}.
+        """
+        lock = threading.Lock()
+        results = {}
+        online_times = {}
+
+        def waiter(serial, timeout):
+            try:
+                ret = wait(serial, timeout)
+            except Exception as e:
+                ret = e
+            with lock:
+                results.setdefault(serial, []).append((ret, time.time()))
+        threads = [threading.Thread(target=waiter, args=(serial, 10)) for serial in serials for _ in range(2)]
+        threads += [threading.Thread(target=waiter, args=('ghost', 0.3)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        for serial in random.sample(serials, len(serials)):
+            online_times[serial] = time.time()
+            set_online(serial)
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join(15)
+            self.assertFalse(thread.is_alive(), 'The waiter should be done.')
+        for serial in serials:
+            self.assertEqual(len(results[serial]), 2)
+            for ret, return_time in results[serial]:
+                self.assertIs(ret, True, 'The waiter of {} should get True, not {}.'.format(serial, ret))
+                self.assertGreaterEqual(return_time, online_times[serial])
+        self.assertEqual(len(results['ghost']), 5)
+        for ret, _ in results['ghost']:
+            self.assertIsInstance(ret, Exception)
+
+    def test_wait_for_device_concurrently(self):
+        """
+        Test many threads wait for different devices by the shared registry.
+        """
+        serials = ['device{}'.format(index) for index in range(30)]
+        for serial in serials:
+            self.server.add_device(serial, 'offline')
+        AdbWrapper.set_backend(AdbWrapper.BACKEND_SOCKET, port=self.server.port)
+        try:
+            self._wait_concurrently(lambda serial, timeout: AdbWrapper.adb_wait_for_device(timeout, serial=serial),
+                                    serials, lambda serial: self.server.set_state(serial, 'device'))
+            self.assertNotIn('host:devices', self.server.requests, 'The waiters should not poll host:devices.')
+        finally:
+            AdbWrapper.set_backend(AdbWrapper.BACKEND_SUBPROCESS)
+            DeviceRegistry._instance.stop()
+
+    def test_poller_concurrently(self):
+        """
+        Test many threads wait for different devices by one polling thread, and the timeout waiters are removed.
+        """
+        lock = threading.Lock()
+        devices = {}
+        state = {'running': 0, 'max': 0}
+
+        def list_devices():
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.005)
+            with lock:
+                state['running'] -= 1
+                return dict(devices)
+
+        def set_online(serial):
+            with lock:
+                devices[serial] = 'device'
+        poller = DevicePoller(list_devices, interval=0.01)
+        serials = ['device{}'.format(index) for index in range(30)]
+        self._wait_concurrently(lambda serial, timeout: poller.wait_for_state(serial, timeout=timeout),
+                                serials, set_online)
+        self.assertEqual(state['max'], 1, 'The devices should be polled by one thread.')
+        self.assertEqual(poller.waiters, [])
+        deadline = time.time() + 5
+        while poller.thread is not None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(poller.thread, 'The polling thread should stop without waiters.')
+
+    def tearDown(self):
+        self.registry.stop()
+        self.server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
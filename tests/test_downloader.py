@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from b2g_util.util.decompressor import Decompressor
+from b2g_util.util.downloader import Downloader
+from fake_http_server import FakeHttpServer
+
+
+class DownloaderTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self.data = os.urandom(Downloader.MIN_SEGMENT_SIZE * 4 + 12345)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_download_ranges(self):
+        """
+        Test download by parallel ranges with progress.
+        """
+        self.server = FakeHttpServer().start()
+        self.server.files['/b2g.zip'] = self.data
+        progress = []
+        ret = Downloader().download(self.server.url('/b2g.zip'), self.tmp_dir, connections=4,
+                                    progress_callback=lambda **kwargs: progress.append(kwargs))
+        self.assertEqual(ret, os.path.join(self.tmp_dir, 'b2g.zip'))
+        self.assertEqual(self._read(ret), self.data)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['b2g.zip'], 'The state file should be removed.')
+        ranges = sorted(r for _, r in self.server.requests)
+        self.assertEqual(len(ranges), 5, 'There should be one probe and four ranges, not {}.'.format(ranges))
+        self.assertEqual(progress[-1], {'current_byte': len(self.data), 'total_size': len(self.data)})
+
+    def test_download_resume(self):
+        """
+        Test the interrupted download is resumed from the state file.
+        """
+        self.server = FakeHttpServer().start()
+        self.server.files['/b2g.zip'] = self.data
+        downloader = Downloader()
+        downloader.RETRIES = 0
+        self.server.fail_after = Downloader.MIN_SEGMENT_SIZE // 2
+        self.assertIsNone(downloader.download(self.server.url('/b2g.zip'), self.tmp_dir, connections=2))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'b2g.zip' + Downloader.STATE_SUFFIX)))
+        served_bytes = self.server.served_bytes
+        ret = Downloader().download(self.server.url('/b2g.zip'), self.tmp_dir, connections=2)
+        self.assertEqual(self._read(ret), self.data)
+        resumed_bytes = self.server.served_bytes - served_bytes
+        self.assertLess(resumed_bytes, len(self.data), 'The done bytes should not be downloaded again.')
+        self.assertFalse(os.path.isfile(ret + Downloader.STATE_SUFFIX))
+
+    def test_download_without_range(self):
+        """
+        Test download by one stream when the server does not support range.
+        """
+        self.server = FakeHttpServer(support_range=False).start()
+        self.server.files['/gaia.zip'] = self.data
+        ret = Downloader().download(self.server.url('/gaia.zip'), self.tmp_dir, connections=4)
+        self.assertEqual(self._read(ret), self.data)
+        self.assertEqual(len(self.server.requests), 1, 'The probe response should be used as the stream.')
+
+    def test_untar_stream(self):
+        """
+        Test the members are extracted while the package is being downloaded.
+        """
+        package = io.BytesIO()
+        with tarfile.open(fileobj=package, mode='w:gz') as tar:
+            for name in ('b2g/b2g', 'b2g/libxul.so'):
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(name)
+                tar.addfile(tarinfo, io.BytesIO(name))
+        self.server = FakeHttpServer().start()
+        self.server.files['/b2g.tar.gz'] = package.getvalue()
+        progress = []
+        stream = Downloader().open_stream(self.server.url('/b2g.tar.gz'),
+                                          progress_callback=lambda **kwargs: progress.append(kwargs))
+        members = []
+        names = Decompressor.untar_stream(stream, self.tmp_dir,
+                                          member_callback=lambda member, path: members.append((member.name, path)))
+        stream.close()
+        self.assertEqual(names, ['b2g/b2g', 'b2g/libxul.so'])
+        self.assertEqual(members[1], ('b2g/libxul.so', os.path.join(self.tmp_dir, 'b2g/libxul.so')))
+        self.assertEqual(self._read(os.path.join(self.tmp_dir, 'b2g', 'libxul.so')), 'b2g/libxul.so')
+        self.assertEqual(progress[-1]['current_byte'], len(package.getvalue()))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'b2g.tar.gz')),
+                         'The package should not be written into disk.')
+
+    def test_download_not_found(self):
+        """
+        Test download the file which does not exist.
+        """
+        self.server = FakeHttpServer().start()
+        self.assertIsNone(Downloader().download(self.server.url('/foo.zip'), self.tmp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import stat
+import time
+import shutil
+import tempfile
+import unittest
+
+from b2g_util.util.extraction_cache import ExtractionCache
+
+
+class ExtractionCacheTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.extracted = []
+
+    def tearDown(self):
+        ExtractionCache._remove_tree(self.tmp_dir)
+
+    def _make_package(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _extract(self, size=10):
+        def extract(dest_folder):
+            self.extracted.append(dest_folder)
+            os.makedirs(os.path.join(dest_folder, 'b2g'))
+            with open(os.path.join(dest_folder, 'b2g', 'libxul.so'), 'wb') as f:
+                f.write('x' * size)
+        return extract
+
+    def test_reuse_tree(self):
+        """
+        Test the same package content is extracted once, even if the path is different.
+        """
+        cache = ExtractionCache(self.cache_dir)
+        first = self._make_package('b2g.tar.gz', 'gecko')
+        second = self._make_package('b2g-copy.tar.gz', 'gecko')
+        with cache.open(first, self._extract()) as tree:
+            self.assertTrue(os.path.isfile(os.path.join(tree, 'b2g', 'libxul.so')))
+        with cache.open(second, self._extract()) as tree_again:
+            self.assertEqual(tree_again, tree)
+        self.assertEqual(len(self.extracted), 1)
+        # the other variant has its own tree
+        with cache.open(first, self._extract(), variant='b2g/') as tree_variant:
+            self.assertNotEqual(tree_variant, tree)
+        self.assertEqual(len(self.extracted), 2)
+
+    def test_modified_tree(self):
+        """
+        Test the file modes of tree are kept, and the modified tree is extracted again.
+        """
+        cache = ExtractionCache(self.cache_dir)
+        package = self._make_package('b2g.tar.gz', 'gecko')
+        with cache.open(package, self._extract()) as tree:
+            libxul = os.path.join(tree, 'b2g', 'libxul.so')
+            self.assertTrue(stat.S_IMODE(os.stat(libxul).st_mode) & stat.S_IWUSR, 'The file mode should be kept.')
+            with open(libxul, 'ab') as f:
+                f.write('modified')
+        with cache.open(package, self._extract()) as tree:
+            self.assertEqual(os.path.getsize(os.path.join(tree, 'b2g', 'libxul.so')), 10)
+        self.assertEqual(len(self.extracted), 2)
+        self.assertEqual(cache.total_size(), 10)
+
+    def test_evict_lru_not_in_use(self):
+        """
+        Test the trees in use are not evicted, and the least recently used ones are evicted after release.
+        """
+        cache = ExtractionCache(self.cache_dir, max_size=25)
+        packages = [self._make_package('b2g{}.tar.gz'.format(index), 'gecko{}'.format(index)) for index in range(3)]
+        first = cache.acquire(packages[0], self._extract())
+        time.sleep(0.01)
+        with cache.open(packages[1], self._extract()):
+            pass
+        time.sleep(0.01)
+        # over max size, but the first tree is in use, so the second one is evicted
+        third = cache.acquire(packages[2], self._extract())
+        self.assertTrue(os.path.isdir(first))
+        self.assertEqual(cache.total_size(), 20)
+        cache.release(first)
+        cache.release(third)
+        self.assertTrue(os.path.isdir(third))
+        # the first one is the least recently used one after release
+        with cache.open(packages[1], self._extract()):
+            pass
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(cache.total_size(), 20)
+
+    def test_extract_fail(self):
+        """
+        Test the failed extraction leaves nothing in cache.
+        """
+        cache = ExtractionCache(self.cache_dir)
+        package = self._make_package('b2g.tar.gz', 'gecko')
+
+        def extract(dest_folder):
+            self._extract()(dest_folder)
+            raise Exception('broken package')
+
+        with self.assertRaises(Exception):
+            cache.acquire(package, extract)
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, 'trees')), [])
+        self.assertEqual(cache.total_size(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
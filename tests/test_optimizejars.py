@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from mock import patch
+
+from b2g_util.misc import optimizejars
+
+
+class OptimizeJarsTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='optimizejars_')
+        self.members = {'chrome/toolkit/content/global/buildconfig.html': '<p>Built from <a href="foo">bar</a></p>\n',
+                        'components/foo.js': 'foo' * 1000,
+                        'res/bar.css': 'bar' * 1000}
+        self.jar = os.path.join(self.tmp_dir, 'omni.ja')
+        with zipfile.ZipFile(self.jar, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, data in sorted(self.members.items()):
+                z.writestr(name, data)
+        # optimize the jar with the startup log
+        log = os.path.join(self.tmp_dir, 'omni.ja.log')
+        with open(log, 'w') as f:
+            f.write('res/bar.css\n')
+        self.optimized_jar = os.path.join(self.tmp_dir, 'optimized.ja')
+        optimizejars.optimizejar(self.jar, self.optimized_jar, log)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_zipfile_can_not_read_optimized_jar(self):
+        """
+        Test the stock zipfile can not read the optimized jar.
+        """
+        with self.assertRaises(zipfile.BadZipfile):
+            zipfile.ZipFile(self.optimized_jar).namelist()
+
+    def test_open_optimized_jar(self):
+        """
+        Test reading the members of optimized jar in-process.
+        """
+        z = optimizejars.open_optimized_jar(self.optimized_jar)
+        self.assertEqual(sorted(z.namelist()), sorted(self.members.keys()))
+        self.assertEqual(z.namelist()[0], 'res/bar.css', 'The logged member should be reordered to the front.')
+        self.assertGreater(z.readahead, 0)
+        for name, data in self.members.items():
+            self.assertEqual(z.read(name), data)
+        self.assertIsNone(z.testzip())
+
+    def test_open_optimized_jar_fileobj(self):
+        """
+        Test reading the optimized jar from file object.
+        """
+        with open(self.optimized_jar, 'rb') as f:
+            z = optimizejars.open_optimized_jar(io.BytesIO(f.read()))
+        name = 'chrome/toolkit/content/global/buildconfig.html'
+        self.assertEqual(z.read(name), self.members[name])
+
+    def test_open_normal_jar(self):
+        """
+        Test reading the jar which is not optimized.
+        """
+        z = optimizejars.open_optimized_jar(self.jar)
+        self.assertEqual(z.readahead, 0)
+        self.assertEqual(z.read('components/foo.js'), self.members['components/foo.js'])
+
+    def test_close_broken_jar(self):
+        """
+        Test the mapped jar is closed even when optimizing fails.
+        """
+        broken_jar = os.path.join(self.tmp_dir, 'broken.ja')
+        with open(self.jar, 'rb') as f:
+            data = f.read()
+        with open(broken_jar, 'wb') as f:
+            f.write(data[:-4])
+        with patch.object(optimizejars.BinaryBlob, 'close', autospec=True,
+                          side_effect=optimizejars.BinaryBlob.close) as mock_close:
+            with self.assertRaises(Exception):
+                optimizejars.optimizejar(broken_jar, os.path.join(self.tmp_dir, 'out.ja'))
+        self.assertEqual(mock_close.call_count, 1)
+        self.assertIsNone(mock_close.call_args[0][0].mapped_file)
+
+    def test_log_destination(self):
+        """
+        Test the messages name the destination jar instead of the temp file.
+        """
+        in_dir = os.path.join(self.tmp_dir, 'in')
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        os.makedirs(in_dir)
+        os.makedirs(out_dir)
+        shutil.copyfile(self.jar, os.path.join(in_dir, 'app.jar'))
+        with patch.object(sys, 'stdout', io.BytesIO()) as stdout:
+            optimizejars.optimize(self.tmp_dir, in_dir, out_dir)
+        output = stdout.getvalue()
+        self.assertIn('in {}\n'.format(os.path.join(out_dir, 'app.jar')), output)
+        self.assertNotIn('.tmp', output)
+
+    def test_optimize_jobs(self):
+        """
+        Test optimizing and deoptimizing a directory of jars by process pool.
+        """
+        in_dir = os.path.join(self.tmp_dir, 'in')
+        os.makedirs(in_dir)
+        for index in range(4):
+            shutil.copyfile(self.jar, os.path.join(in_dir, 'app{}.jar'.format(index)))
+        for jobs in (1, 3):
+            out_dir = os.path.join(self.tmp_dir, 'out{}'.format(jobs))
+            deopt_dir = os.path.join(self.tmp_dir, 'deopt{}'.format(jobs))
+            log_dir = os.path.join(self.tmp_dir, 'log{}'.format(jobs))
+            os.makedirs(out_dir)
+            os.makedirs(deopt_dir)
+            timings = optimizejars.optimize(self.tmp_dir, in_dir, out_dir, jobs=jobs)
+            self.assertEqual(sorted(name for name, _ in timings), ['app0.jar', 'app1.jar', 'app2.jar', 'app3.jar'])
+            optimizejars.deoptimize(log_dir, out_dir, deopt_dir, jobs=jobs)
+            self.assertEqual(sorted(os.listdir(out_dir)), sorted(os.listdir(in_dir)),
+                             'There should be no temp file left.')
+            self.assertEqual(sorted(os.listdir(log_dir)), ['app{}.jar.log'.format(i) for i in range(4)])
+        for index in range(4):
+            name = 'app{}.jar'.format(index)
+            with open(os.path.join(self.tmp_dir, 'out1', name), 'rb') as f1, \
+                    open(os.path.join(self.tmp_dir, 'out3', name), 'rb') as f3:
+                self.assertEqual(f1.read(), f3.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+from mock import patch
+
+from b2g_util.util.package_inspector import PackageInspector
+
+
+class PackageInspectorTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self.inspector = PackageInspector(index_file=os.path.join(self.tmp_dir, 'index.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_zip(self, name, members):
+        path = os.path.join(self.tmp_dir, name)
+        with zipfile.ZipFile(path, 'w') as z:
+            for member in members:
+                z.writestr(member, '' if member.endswith('/') else member)
+        return path
+
+    def _make_tar(self, name, members):
+        path = os.path.join(self.tmp_dir, name)
+        with tarfile.open(path, 'w:gz') as tar:
+            for member in members:
+                tarinfo = tarfile.TarInfo(member)
+                if member.endswith('/'):
+                    tarinfo.type = tarfile.DIRTYPE
+                    tar.addfile(tarinfo)
+                else:
+                    data = os.urandom(1024)
+                    tarinfo.size = len(data)
+                    tar.addfile(tarinfo, io.BytesIO(data))
+        return path
+
+    def test_classify(self):
+        """
+        Test classify the image, Gaia, Gecko and other files.
+        """
+        image = self._make_zip('aries.zip', ['b2g-distro/', 'b2g-distro/flash.sh'])
+        gaia = self._make_zip('gaia.zip', ['gaia/profile/', 'gaia/profile/user.js'])
+        gecko = self._make_tar('b2g.tar.gz', ['b2g/', 'b2g/b2g'])
+        other = self._make_tar('tests.tar.gz', ['mochitest/', 'mochitest/a.js'])
+        self.assertEqual(self.inspector.classify(image), PackageInspector.IMAGE)
+        self.assertEqual(self.inspector.classify(gaia), PackageInspector.GAIA)
+        self.assertEqual(self.inspector.classify(gecko), PackageInspector.GECKO)
+        self.assertIsNone(self.inspector.classify(other))
+        self.assertIsNone(self.inspector.classify(os.path.join(self.tmp_dir, 'foo.zip')))
+
+    def test_check(self):
+        """
+        Test check the requested type only, by the exact magic member.
+        """
+        both = self._make_zip('both.zip', ['b2g-distro/', 'b2g-distro/flash.sh', 'gaia/profile/', 'gaia/profile/user.js'])
+        no_dir = self._make_zip('no_dir.zip', ['b2g-distro/flash.sh'])
+        self.assertTrue(self.inspector.check(both, PackageInspector.IMAGE))
+        self.assertTrue(self.inspector.check(both, PackageInspector.GAIA))
+        self.assertFalse(self.inspector.check(both, PackageInspector.GECKO))
+        self.assertEqual(self.inspector.classify(both), PackageInspector.IMAGE)
+        self.assertFalse(self.inspector.check(no_dir, PackageInspector.IMAGE))
+        self.assertIsNone(self.inspector.classify(no_dir))
+
+    def test_stop_at_first_member(self):
+        """
+        Test the Gecko package is classified without reading all members.
+        """
+        gecko = self._make_tar('b2g.tar.gz', ['b2g/', 'b2g/b2g'] + ['b2g/lib{}.so'.format(i) for i in range(200)])
+        read_members = []
+        original_next = tarfile.TarFile.next
+
+        def counting_next(tar):
+            tarinfo = original_next(tar)
+            read_members.append(tarinfo)
+            return tarinfo
+        with patch.object(tarfile.TarFile, 'next', counting_next):
+            self.assertEqual(self.inspector.classify(gecko), PackageInspector.GECKO)
+        self.assertLess(len(read_members), 5, 'Only the first members should be read.')
+
+    def test_index(self):
+        """
+        Test the result is loaded from index, until the file is changed.
+        """
+        gecko = self._make_tar('b2g.tar.gz', ['b2g/', 'b2g/b2g'])
+        self.assertTrue(self.inspector.check(gecko, PackageInspector.GECKO))
+        inspector = PackageInspector(index_file=self.inspector.index_file)
+        with patch.object(PackageInspector, '_inspect', return_value=False) as mock_inspect:
+            self.assertTrue(inspector.check(gecko, PackageInspector.GECKO))
+            self.assertFalse(mock_inspect.called, 'The result should be loaded from index.')
+            # the other type is not in index yet
+            self.assertFalse(inspector.check(gecko, PackageInspector.IMAGE))
+            mock_inspect.assert_called_once_with(os.path.abspath(gecko), PackageInspector.IMAGE)
+        # the changed file is inspected again
+        self._make_zip('b2g.tar.gz', ['gaia/profile/'])
+        os.utime(gecko, (0, 0))
+        self.assertFalse(inspector.check(gecko, PackageInspector.GECKO))
+
+
+if __name__ == '__main__':
+    unittest.main()
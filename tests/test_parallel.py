@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import threading
+import unittest
+
+from b2g_util.util.parallel import gather
+from b2g_util.util.parallel import Pipeline
+from b2g_util.util.parallel import WorkerPool
+
+
+class ParallelTester(unittest.TestCase):
+
+    def test_gather(self):
+        """
+        Test gather keeps the order of results.
+        """
+        def task(value):
+            time.sleep(0.01 * (5 - value))
+            return value
+        ret = gather([(task, {'value': i}) for i in range(5)], max_workers=5)
+        self.assertEqual(ret, range(5), 'The result should be {}, not {}.'.format(range(5), ret))
+
+    def test_gather_bounded(self):
+        """
+        Test gather runs no more than max_workers tasks at the same time.
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def task():
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+        gather([task] * 12, max_workers=3)
+        self.assertEqual(state['max'], 3, 'The max concurrency should be 3, not {}.'.format(state['max']))
+
+    def test_gather_exception(self):
+        """
+        Test gather with the failed task.
+        """
+        def fail():
+            raise Exception('device offline')
+        with self.assertRaises(Exception) as cm:
+            gather([lambda: 1, fail])
+        self.assertEqual(cm.exception.message, 'device offline')
+        ret = gather([lambda: 1, fail], return_exceptions=True)
+        self.assertEqual(ret[0], 1)
+        self.assertEqual(ret[1].message, 'device offline')
+
+    def test_future_timeout(self):
+        """
+        Test the timeout of future.
+        """
+        pool = WorkerPool(max_workers=1)
+        future = pool.submit(time.sleep, 0.5)
+        with self.assertRaises(Exception):
+            future.result(timeout=0.01)
+        self.assertIsNone(future.result())
+        pool.shutdown()
+
+    def test_pipeline(self):
+        """
+        Test the independent stages run at the same time, and the stage gets the results of its dependencies.
+        """
+        events = []
+
+        def stage(name, seconds, result=None):
+            def run(**kwargs):
+                events.append(('start', name))
+                time.sleep(seconds)
+                events.append(('end', name))
+                return result if result is not None else kwargs
+            return run
+        pipeline = Pipeline()
+        pipeline.add_stage('extract', stage('extract', 0.2, result='/tmp/gaia'))
+        pipeline.add_stage('clean', stage('clean', 0.1, result='cleaned'))
+        pipeline.add_stage('push', stage('push', 0), depends=['extract', 'clean'])
+        results = pipeline.run()
+        self.assertEqual(results['push'], {'extract': '/tmp/gaia', 'clean': 'cleaned'})
+        self.assertLess(events.index(('start', 'clean')), events.index(('end', 'extract')),
+                        'The clean stage should run with the extract stage.')
+        self.assertEqual(events[-2:], [('start', 'push'), ('end', 'push')])
+        self.assertGreaterEqual(pipeline.timings['extract'], 0.2)
+        self.assertLess(pipeline.timings['push'], 0.1, 'The waiting for dependencies should not be timed.')
+
+    def test_pipeline_exception(self):
+        """
+        Test the stages which depend on the failed stage are skipped, and the others are done.
+        """
+        done = []
+
+        def fail():
+            raise Exception('device offline')
+        pipeline = Pipeline()
+        pipeline.add_stage('clean', fail)
+        pipeline.add_stage('extract', lambda: done.append('extract'))
+        pipeline.add_stage('push', lambda clean, extract: done.append('push'), depends=['clean', 'extract'])
+        with self.assertRaises(Exception) as cm:
+            pipeline.run()
+        self.assertEqual(cm.exception.message, 'device offline')
+        self.assertEqual(done, ['extract'])
+        self.assertEqual(sorted(pipeline.results.keys()), ['extract'])
+        self.assertEqual(sorted(pipeline.timings.keys()), ['clean', 'extract'])
+        with self.assertRaises(Exception):
+            pipeline.add_stage('restore', lambda: None, depends=['backup'])
+
+
+if __name__ == '__main__':
+    unittest.main()
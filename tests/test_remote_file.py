@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import os
+import re
+import zipfile
+import unittest
+
+from mock import patch
+
+from b2g_util.util.remote_file import RemoteFile
+
+
+class RemoteFileTester(unittest.TestCase):
+
+    def setUp(self):
+        # prepare one zip file with a large padding member and one small member
+        f = io.BytesIO()
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as z:
+            z.writestr('padding.bin', os.urandom(512 * 1024))
+            z.writestr('resources/gaia_commit.txt', 'abcdef\n1445000000\n')
+        self.content = f.getvalue()
+        self.size_patcher = patch('b2g_util.util.adb_helper.AdbWrapper.adb_file_size', return_value=len(self.content))
+        self.size_patcher.start()
+        self.exec_out_patcher = patch('b2g_util.util.adb_helper.AdbWrapper.adb_exec_out', side_effect=self._fake_dd)
+        self.mock_exec_out = self.exec_out_patcher.start()
+
+    def tearDown(self):
+        self.size_patcher.stop()
+        self.exec_out_patcher.stop()
+
+    def _fake_dd(self, command, serial=None):
+        bs, skip, count = [int(value) for value in re.search(r'bs=(\d+) skip=(\d+) count=(\d+)', command).groups()]
+        return self.content[bs * skip:bs * (skip + count)]
+
+    def test_read_zip_member(self):
+        """
+        Test reading one zip member only transfers the needed blocks.
+        """
+        with RemoteFile('/foo/application.zip', block_size=4096) as f:
+            z = zipfile.ZipFile(f)
+            self.assertEqual(z.read('resources/gaia_commit.txt'), 'abcdef\n1445000000\n')
+            self.assertLess(f.transferred, len(self.content) / 10,
+                            'Transferred {} bytes, should be much less than {}.'.format(f.transferred,
+                                                                                        len(self.content)))
+
+    def test_read_range(self):
+        """
+        Test seek and read return the same bytes as the file content.
+        """
+        with RemoteFile('/foo/application.zip', block_size=1000) as f:
+            f.seek(1500)
+            self.assertEqual(f.read(3000), self.content[1500:4500])
+            self.assertEqual(f.tell(), 4500)
+            f.seek(-10, os.SEEK_END)
+            self.assertEqual(f.read(), self.content[-10:])
+            self.assertEqual(f.read(), '')
+
+    def test_fallback_to_pull(self):
+        """
+        Test pulling the whole file when the ranged read fails.
+        """
+        self.mock_exec_out.side_effect = Exception('exec: not supported')
+
+        def fake_pull(source, fileobj, serial=None):
+            fileobj.write(self.content)
+            return len(self.content)
+
+        with patch('b2g_util.util.adb_helper.AdbWrapper.adb_pull_fileobj', side_effect=fake_pull):
+            with RemoteFile('/foo/application.zip') as f:
+                f.seek(100)
+                self.assertEqual(f.read(50), self.content[100:150])
+                self.assertEqual(f.transferred, len(self.content))
+
+    def test_unknown_size(self):
+        """
+        Test pulling the whole file when the size can not be read.
+        """
+        self.size_patcher.stop()
+
+        def fake_pull(source, fileobj, serial=None):
+            fileobj.write(self.content)
+            return len(self.content)
+
+        with patch('b2g_util.util.adb_helper.AdbWrapper.adb_file_size', side_effect=Exception('unknown ls')), \
+                patch('b2g_util.util.adb_helper.AdbWrapper.adb_pull_fileobj', side_effect=fake_pull) as pull:
+            with RemoteFile('/foo/application.zip') as f:
+                self.assertEqual(f.size, len(self.content))
+                self.assertEqual(zipfile.ZipFile(f).read('resources/gaia_commit.txt'), 'abcdef\n1445000000\n')
+        self.assertEqual(pull.call_count, 1)
+        self.assertEqual(self.mock_exec_out.call_count, 0)
+        self.size_patcher.start()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import mock
+import time
+import shutil
+import zipfile
+import tempfile
+import unittest
+import threading
+
+from b2g_util.shallow_flash import ShallowFlashHelper
+
+
+class ShallowFlashTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='test_b2g_util_')
+        self.gaia = os.path.join(self.tmp_dir, 'gaia.zip')
+        with zipfile.ZipFile(self.gaia, 'w') as z:
+            z.writestr('gaia/profile/user.js', 'user_pref("a", 1);')
+            z.writestr('gaia/profile/settings.json', '{}')
+            z.writestr('gaia/profile/webapps/webapps.json', '{}')
+        self.lock = threading.Lock()
+        self.pushed = []
+        self.app = ShallowFlashHelper()
+        self.app.set_gaia(self.gaia)
+        self.app.set_max_workers(2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _push_gaia(self, helper, source_dir):
+        self.assertTrue(os.path.isfile(os.path.join(source_dir, 'gaia', 'profile', 'user.js')))
+        with self.lock:
+            self.pushed.append((helper.serial, source_dir))
+
+    def _prepare_step(self, helper):
+        if helper.serial == 'bad':
+            raise Exception('No root permission for shallow flashing.')
+
+    def _run_fleet(self, devices):
+        with mock.patch('b2g_util.shallow_flash.AdbHelper.get_devices', return_value=devices), \
+                mock.patch.object(ShallowFlashHelper, 'prepare_step', autospec=True, side_effect=self._prepare_step), \
+                mock.patch.object(ShallowFlashHelper, 'final_step', autospec=True), \
+                mock.patch.object(ShallowFlashHelper, '_clean_gaia', autospec=True), \
+                mock.patch.object(ShallowFlashHelper, '_push_gaia', autospec=True, side_effect=self._push_gaia), \
+                mock.patch.object(ShallowFlashHelper, '_unzip_gaia', autospec=True,
+                                  side_effect=ShallowFlashHelper._unzip_gaia) as unzip:
+            results = self.app.run_fleet()
+        return results, unzip
+
+    def test_run_fleet_extract_once(self):
+        """
+        Test all online devices are flashed from one extraction.
+        """
+        self.app.set_all_devices(True)
+        results, unzip = self._run_fleet({'a': 'device', 'b': 'device', 'c': 'device', 'd': 'offline'})
+        self.assertEqual(unzip.call_count, 1)
+        self.assertEqual(sorted(serial for serial, _ in self.pushed), ['a', 'b', 'c'])
+        self.assertEqual(len(set(source_dir for _, source_dir in self.pushed)), 1)
+        self.assertFalse(os.path.exists(self.pushed[0][1]), 'The extracted folder should be removed.')
+        self.assertEqual([result['serial'] for result in results], ['a', 'b', 'c'])
+        for result in results:
+            self.assertIsNone(result['error'])
+            self.assertEqual(sorted(step for step in result['timings'].keys() if '.' not in step),
+                             ['final', 'gaia', 'prepare'])
+
+    def test_run_fleet_failed_devices(self):
+        """
+        Test the failed and offline devices do not stop others, and run() raises for them.
+        """
+        self.app.set_serials(['good', 'bad', 'gone'])
+        results, _ = self._run_fleet({'good': 'device', 'bad': 'device'})
+        self.assertEqual([result['serial'] for result in results], ['good', 'bad', 'gone'])
+        self.assertIsNone(results[0]['error'])
+        self.assertIn('No root permission', results[1]['error'])
+        self.assertIn('not online', results[2]['error'])
+        self.assertEqual([serial for serial, _ in self.pushed], ['good'])
+        with mock.patch.object(ShallowFlashHelper, 'run_fleet', return_value=results), \
+                mock.patch.object(ShallowFlashHelper, 'print_fleet_results') as print_results:
+            with self.assertRaises(Exception) as cm:
+                self.app.run()
+        print_results.assert_called_once_with(results)
+        self.assertIn('bad, gone', cm.exception.message)
+
+    def test_gaia_stages(self):
+        """
+        Test the Gaia package is extracted while the profile is kept and the device is cleaned.
+        """
+        events = []
+
+        def record(name, seconds=0, result=None):
+            def func(*args):
+                with self.lock:
+                    events.append(('start', name))
+                time.sleep(seconds)
+                with self.lock:
+                    events.append(('end', name))
+                return result
+            return func
+
+        unzip_gaia = ShallowFlashHelper._unzip_gaia
+
+        def unzip(helper, dest_folder):
+            record('extract', 0.2)()
+            unzip_gaia(helper, dest_folder)
+
+        self.app.set_keep_profile(True)
+        with mock.patch.object(ShallowFlashHelper, '_unzip_gaia', autospec=True, side_effect=unzip), \
+                mock.patch.object(ShallowFlashHelper, '_backup_profile', side_effect=record('backup', 0.05, '/tmp/p')), \
+                mock.patch.object(ShallowFlashHelper, '_clean_gaia', side_effect=record('clean', 0.05)), \
+                mock.patch.object(ShallowFlashHelper, '_push_gaia', side_effect=record('push')) as push, \
+                mock.patch.object(ShallowFlashHelper, '_restore_profile', side_effect=record('restore')) as restore:
+            self.app.shallow_flash_gaia()
+        self.assertLess(events.index(('end', 'clean')), events.index(('end', 'extract')),
+                        'The device should be cleaned while extracting.')
+        self.assertLess(events.index(('end', 'backup')), events.index(('start', 'clean')))
+        self.assertEqual(events[-4:], [('start', 'push'), ('end', 'push'), ('start', 'restore'), ('end', 'restore')])
+        restore.assert_called_once_with('/tmp/p')
+        self.assertFalse(os.path.exists(push.call_args[0][0]), 'The extracted folder should be removed.')
+        self.assertEqual(sorted(self.app.timings.keys()),
+                         ['gaia.backup', 'gaia.clean', 'gaia.extract', 'gaia.push', 'gaia.restore'])
+
+    def test_gaia_restore_profile_on_failure(self):
+        """
+        Test the kept profile is restored when pushing Gaia failed.
+        """
+        self.app.set_keep_profile(True)
+        with mock.patch.object(ShallowFlashHelper, '_backup_profile', return_value=None), \
+                mock.patch.object(ShallowFlashHelper, '_clean_gaia'), \
+                mock.patch.object(ShallowFlashHelper, '_push_gaia', side_effect=Exception('device offline')), \
+                mock.patch.object(ShallowFlashHelper, '_restore_profile') as restore:
+            with self.assertRaises(Exception) as cm:
+                self.app.shallow_flash_gaia()
+        self.assertEqual(cm.exception.message, 'device offline')
+        restore.assert_called_once_with(None)
+
+    def _stream_gecko(self, push):
+        self.events = events = []
+        self.app.gecko = 'https://example.com/b2g.linux-gnueabi-arm.tar.gz'
+        with mock.patch('b2g_util.shallow_flash.Downloader.open_stream', return_value=mock.MagicMock()), \
+                mock.patch('b2g_util.shallow_flash.AdbWrapper.adb_push_tar_stream', side_effect=push) as push_stream, \
+                mock.patch('b2g_util.shallow_flash.AdbWrapper.get_device_tar', return_value='tar'), \
+                mock.patch('b2g_util.shallow_flash.AdbWrapper.adb_shell_batch',
+                           side_effect=lambda commands, serial: events.append('move') or [('', 0)] * len(commands)), \
+                mock.patch('b2g_util.shallow_flash.AdbWrapper.adb_shell',
+                           side_effect=lambda command, serial: events.append(command)), \
+                mock.patch.object(ShallowFlashHelper, '_clean_gecko', side_effect=lambda: events.append('clean')):
+            try:
+                return self.app._stream_gecko(), events
+            finally:
+                staging_dir = push_stream.call_args[0][1]
+                self.assertTrue(staging_dir.startswith('/data/local/tmp/'))
+                self.assertEqual(events[-1], 'rm -r {}'.format(staging_dir), 'The staging folder should be removed.')
+
+    def test_stream_gecko(self):
+        """
+        Test the device files are replaced only after the Gecko package has fully arrived.
+        """
+        ret, events = self._stream_gecko(lambda *args, **kwargs: 2)
+        self.assertTrue(ret)
+        self.assertEqual(events[:2], ['clean', 'move'])
+
+    def test_stream_gecko_fail(self):
+        """
+        Test the device keeps its Gecko when the download fails.
+        """
+        with self.assertRaises(Exception):
+            self._stream_gecko(Exception('connection reset'))
+        self.assertNotIn('clean', self.events)
+        ret, events = self._stream_gecko(lambda *args, **kwargs: None)
+        self.assertFalse(ret, 'The package should be extracted when the device does not accept exec-in.')
+        self.assertEqual(len(events), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()